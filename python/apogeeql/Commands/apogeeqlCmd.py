@@ -57,6 +57,15 @@ class apogeeqlCmd(object):
 
       cmd.inform('rootURL=%s' % (self.actor.rootURL))
       cmd.inform('snrAxisRange=%s,%s' % (self.actor.snrAxisRange[0],self.actor.snrAxisRange[1]))
+      cmd.inform('annotateInFlight=%d,%d,%d' % (self.actor.annotatePool.running, self.actor.annotatePool.queued(),
+                                                self.actor.annotatePool.dropped))
+      for job in self.actor.finalizer.jobs():
+         cmd.inform('finalizeState=%s,%s' % (job.filebase, job.stage))
+      for prefix, queue in [('ql', getattr(self.actor, 'ql_in_queue', None)),
+                            ('bundle', getattr(self.actor, 'bundlePool', None))]:
+         if queue is not None:
+            for keyword in queue.keywords(prefix):
+               cmd.inform(keyword)
       # keyStrings = ['text="nothing to say, really"']
       # keyMsg = '; '.join(keyStrings)
 
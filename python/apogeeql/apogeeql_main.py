@@ -2,7 +2,8 @@
 
 from twisted.internet.protocol import Protocol, Factory, ClientFactory
 from twisted.protocols.basic import LineReceiver
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
+from twisted.python.failure import Failure
 from twisted.internet.protocol import Protocol, Factory
 
 # from sdss.internal.database.connections.APODatabaseAdminLocalConnection import db # access to engine, metadata, Session
@@ -22,6 +23,7 @@ import actorkeys
 import traceback
 
 import apogeeql
+from apogeeql import bundlePool, cardCache, confSummary, exposureRecorder, fileCache, fileTransfer, finalize, frameRing, fitsChecksum, opsdb, orderedPool, parFile, plateDb, plugMap, readDecimation, readManifest, readStats, snrEstimate, utrAnnotate, utrRamp, workQueue
 
 #
 # Import sdss3logging before logging if you want to use it
@@ -30,51 +32,17 @@ import logging
 import os, sys, signal, subprocess, tempfile, shutil, glob
 import time
 import types
-from sdss.utilities import yanny
 import RO.Astro.Tm.MJDFromPyTuple as astroMJD
 from astropy.time import Time
 
-from apogee_mountain import quicklookThread, bundleThread
+from apogee_mountain import quicklookThread
 
 # python threading code
-from Queue import Queue
+from Queue import Queue, Full, Empty
 from threading import Thread
 
 import datetime
 
-from peewee import PostgresqlDatabase, Model
-from peewee import AutoField, BigIntegerField, TextField, DateTimeField, FloatField, IntegerField
-
-database = PostgresqlDatabase('sdss5db', user='sdss', host='sdss5-db')
-#database = PostgresqlDatabase('sdss5db', user='sdss', host='10.25.1.130')
-database.connect()
-
-
-class Exposure(Model):
-
-    pk = AutoField()
-    configuration_id = BigIntegerField()
-    survey_pk = IntegerField()
-    exposure_no = BigIntegerField()
-    comment = TextField(null=True)
-    start_time = DateTimeField(default=datetime.datetime.now())
-    exposure_time = FloatField()
-    # exposure_status = ForeignKeyField(column_name='exposure_status_pk',
-    #                                   field='pk',
-    #                                   model=ExposureStatus)
-    exposure_flavor_pk = IntegerField()
-
-    class Meta:
-        database = database
-        # schema = 'opsdb'
-        observatory = os.getenv("OBSERVATORY")
-        if observatory == "APO":
-            schema = 'opsdb_apo'
-        else:
-            schema = 'opsdb_lco'
-        table_name = 'exposure'
-
-
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 #class QuickLookLineServer(LineReceiver):
@@ -212,6 +180,11 @@ class Apogeeql(actorcore.Actor.Actor):
    expState=''
    expType=''
    numReadsCommanded=0
+   registeredExpNo=None
+   exptimePending=None   # (expnum, exp_pk) of an exposure registered before its first read
+   expPks={}   # expnum -> exp_pk (provisional id until inserted) of the last exposures registered
+   keepExpPks=8   # the late reads of the previous exposures still find their pk
+   readManifests={}   # filebase -> readManifest.ReadManifest of the reads already annotated
    actor=''
    obs_pk = 0
    exp_pk = 0
@@ -224,6 +197,9 @@ class Apogeeql(actorcore.Actor.Actor):
    # setup the variables for the watchdog to the IDL code
    watchDogStatus=True  # if True, the idl code is stil responding
    watchDogTimer=2.0    # should return a reply within this time if still alive
+   pingSeq=0            # number of the last PING sent to the quicklook thread
+   pongSeq=0            # number of the last PING answered
+   pings={}             # PING number -> Deferred, for the PINGs waiting for their answer
 
    def __init__(self, name, productName=None, configFile=None, debugLevel=20):
       actorcore.Actor.Actor.__init__(self, name, productName=productName, configFile=configFile)
@@ -260,6 +236,10 @@ class Apogeeql(actorcore.Actor.Actor):
       self.ics_datadir = self.config.get('apogeeql','ics_datadir')
       self.cdr_dir = self.config.get('apogeeql','cdr_dir')
       self.summary_dir = self.config.get('apogeeql','summary_dir')
+      # EXPTIME of a UTR read, used to register an exposure before its first read gives the actual one
+      self.utrReadTime = 10.6
+      if self.config.has_option('apogeeql', 'utrReadTime'):
+         self.utrReadTime = self.config.getfloat('apogeeql', 'utrReadTime')
       self.delFile = self.config.get('apogeeql','delFile')
       self.qlPort = self.config.getint('apogeeql', 'qlPort')
       self.qlHost = self.config.get('apogeeql', 'qlHost')
@@ -268,6 +248,31 @@ class Apogeeql(actorcore.Actor.Actor):
       self.criticalDiskSpace = self.config.get('apogeeql', 'criticalDiskSpace')
       self.seriousDiskSpace = self.config.get('apogeeql', 'seriousDiskSpace')
       self.warningDiskSpace = self.config.get('apogeeql', 'warningDiskSpace')
+      # 'header' only rewrites the header of the UTR reads, 'pyfits' decodes and rewrites the whole file
+      self.annotateMode = 'header'
+      if self.config.has_option('apogeeql', 'annotateMode'):
+         self.annotateMode = self.config.get('apogeeql', 'annotateMode')
+
+      #
+      # bundling processes, and the chips bundled separately (none: the whole exposure in one job)
+      # (forked here, before any thread of the actor is started)
+      #
+      self.bundleWorkers = 3
+      if self.config.has_option('apogeeql', 'bundleWorkers'):
+         self.bundleWorkers = self.config.getint('apogeeql', 'bundleWorkers')
+      self.bundleChips = []
+      if self.config.has_option('apogeeql', 'bundleChips'):
+         self.bundleChips = [c.strip() for c in self.config.get('apogeeql', 'bundleChips').split(',') if c.strip()]
+      bundleJobTimeout = 1800.0
+      if self.config.has_option('apogeeql', 'bundleJobTimeout'):
+         bundleJobTimeout = self.config.getfloat('apogeeql', 'bundleJobTimeout')
+      self.bundlePool = bundlePool.BundlePool(self.bundleWorkers, self.bundleChips,
+                                              onChange=self.bundleInFlightChanged, jobTimeout=bundleJobTimeout)
+      try:
+         self.bundlePool.start()
+      except:
+         self.logger.error("Failed to start the Bundle processes")
+         traceback.print_exc()
 
       #
       # Explicitly load other actor models. We usually need these for FITS headers.
@@ -280,10 +285,24 @@ class Apogeeql(actorcore.Actor.Actor):
       for actor in ["mcp", "guider", "cherno", "platedb", tcc, "apogee", "apogeecal", "hal", "jaeger"]:
          self.models[actor] = opscore.actor.model.Model(actor)
 
+      #
+      # the telemetry cards of the UTR headers are rebuilt only when one of these keywords changes:
+      # the ones read by telemetryCards and by actorcore.utility.fits mcpCards, (lco)tccCards and plateCards
+      #
+      watched = {"mcp": ["ffsStatus", "ffLamp", "neLamp", "hgCdLamp", "apogeeGang"],
+                 tcc: ["objSys", "objNetPos", "objArcOff", "boresight", "calibOff", "guideOff", "rotType",
+                       "rotPos", "axePos", "spiderInstAng", "scaleFac", "secFocus", "primOrient", "secOrient"],
+                 "guider": ["cartridgeLoaded", "survey"],
+                 "apogeecal": ["calSourceStatus", "calShutter", "calBoxController"],
+                 "apogee": ["shutterLimitSwitch"],
+                 "cherno": ["astrometry_fit", "default_offset", "offset"]}
+      self.cardCache = cardCache.CardCache(self.telemetryCards, cardCache.watchedKeyVars(self.models, watched))
+
       #
       # register the keywords that we want to pay attention to
       #
       self.models[tcc].keyVarDict["inst"].addCallback(self.TCCInstCB, callNow=False)
+      # plates only (PointingInfoCB): the FPS configurations come from jaeger.configuration_loaded
       #self.models["platedb"].keyVarDict["pointingInfo"].addCallback(self.PointingInfoCB, callNow=True)
       self.models["apogee"].keyVarDict["exposureState"].addCallback(self.ExposureStateCB, callNow=False)
       self.models["apogee"].keyVarDict["exposureWroteFile"].addCallback(self.exposureWroteFileCB, callNow=False)
@@ -292,13 +311,200 @@ class Apogeeql(actorcore.Actor.Actor):
       self.models["jaeger"].keyVarDict["configuration_loaded"].addCallback(self.configurationLoadedCB, callNow=True)
 
       #
-      # Connect to the platedb
+      # Connect to the platedb (on the first plugmap; empty: no platedb)
       #
       # self.mysession = db.Session()
+      platedbUrl = None
+      if self.config.has_option('apogeeql', 'platedbUrl'):
+         platedbUrl = self.config.get('apogeeql', 'platedbUrl') or None
+      platedbSqlite = None
+      if self.config.has_option('apogeeql', 'platedbSqlite'):
+         platedbSqlite = self.config.get('apogeeql', 'platedbSqlite') or None
+      self.plateDb = plateDb.PlateDb(platedbUrl, sqlite=platedbSqlite)
 
       self.ql_running = False
+      self.qlHeld = None   # Deferred the quicklook messages wait behind (see qlHold)
+      self.qlRestarting = False
+      self.ql_thread = None
+      self.qlHolds = 0
       self.bndl_running = False
 
+      #
+      # the UTR reads are annotated in worker threads, the results come back in read order
+      #
+      nWorkers = 2
+      maxInFlight = 8
+      maxBacklog = 200
+      self.annotateBacklogWarn = 16
+      if self.config.has_option('apogeeql', 'annotateWorkers'):
+         nWorkers = self.config.getint('apogeeql', 'annotateWorkers')
+      if self.config.has_option('apogeeql', 'annotateMaxInFlight'):
+         maxInFlight = self.config.getint('apogeeql', 'annotateMaxInFlight')
+      if self.config.has_option('apogeeql', 'annotateMaxBacklog'):
+         maxBacklog = self.config.getint('apogeeql', 'annotateMaxBacklog')
+      if self.config.has_option('apogeeql', 'annotateBacklogWarn'):
+         self.annotateBacklogWarn = self.config.getint('apogeeql', 'annotateBacklogWarn')
+      self.annotateBacklogWarned = False
+      self.annotatePool = orderedPool.OrderedPool('annotate', nWorkers, maxInFlight,
+                                                  onChange=self.annotateInFlightChanged, maxBacklog=maxBacklog)
+
+      #
+      # the opsdb is only connected to when the first exposure row is written
+      #
+      dbParams = {}
+      for option, param in [('dbName', 'name'), ('dbUser', 'user'), ('dbHost', 'host'), ('dbSqlite', 'sqlite')]:
+         if self.config.has_option('apogeeql', option):
+            dbParams[param] = self.config.get('apogeeql', option)
+      opsdb.configure(**dbParams)
+
+      #
+      # the exposure rows are written behind, with a local journal for when the opsdb is down
+      #
+      journal = os.path.join(getattr(self, 'datadir', '.'), 'exposureJournal.log')
+      if self.config.has_option('apogeeql', 'exposureJournal'):
+         journal = self.config.get('apogeeql', 'exposureJournal')
+      # how long the end of an exposure waits for its pk before the stages that need it fail
+      # (they are done again when the pk comes)
+      self.exposurePkTimeout = 60.0
+      if self.config.has_option('apogeeql', 'exposurePkTimeout'):
+         self.exposurePkTimeout = self.config.getfloat('apogeeql', 'exposurePkTimeout')
+      self.exposures = exposureRecorder.ExposureRecorder(Apogeeql.insertExposure, Apogeeql.updateExposure, journal,
+                                                         onResolved=Apogeeql.exposureResolved,
+                                                         permanent=opsdb.PERMANENT,
+                                                         onRejected=Apogeeql.exposureRejected,
+                                                         delete=Apogeeql.deleteExposure)
+
+      #
+      # end-of-exposure processing, off the reactor
+      #
+      self.finalizer = finalize.Pipeline([('reconcile', self.finalizeReconcile),
+                                          ('recover', self.finalizeRecover),
+                                          ('notify', self.finalizeNotify),
+                                          ('bundle', self.finalizeBundle)],
+                                         onStage=self.finalizeStageChanged,
+                                         onDone=self.finalizeDone)
+
+      #
+      # plPlugMapA files already made, by (plate, fscan_mjd, fscan_id)
+      # (only used by PointingInfoCB, the plate path, which is not registered with the FPS)
+      #
+      cachedir = os.path.join(self.plugmap_dir, '.cache')
+      if self.config.has_option('apogeeql', 'plugmapCacheDir'):
+         cachedir = self.config.get('apogeeql', 'plugmapCacheDir')
+      try:
+         self.plugMapCache = fileCache.FileCache(cachedir)
+      except (IOError, OSError) as e:
+         self.logger.warn('APOGEEQL -> no plugmap cache in %s: %s' % (cachedir, e))
+         self.plugMapCache = None
+
+      #
+      # APOGEE fibers of the recent FPS configurations, parsed when they are loaded
+      #
+      size = 8
+      if self.config.has_option('apogeeql', 'confSummaryCacheSize'):
+         size = self.config.getint('apogeeql', 'confSummaryCacheSize')
+      self.confSummaries = confSummary.ConfSummaryCache(size)
+
+      #
+      # bound of the queue to the quicklook thread (0: unbounded)
+      # quicklook drops its oldest UTR reads when it falls behind
+      #
+      self.qlQueueSize = 200
+      if self.config.has_option('apogeeql', 'qlQueueSize'):
+         self.qlQueueSize = self.config.getint('apogeeql', 'qlQueueSize')
+      self.qlQueuePolicy = workQueue.DROPOLDEST
+      if self.config.has_option('apogeeql', 'qlQueuePolicy'):
+         self.qlQueuePolicy = self.config.get('apogeeql', 'qlQueuePolicy')
+
+      #
+      # quicklook watchdog: a PING every watchDogInterval seconds (0: never), answered within watchDogTimer
+      #
+      if self.config.has_option('apogeeql', 'watchDogTimer'):
+         self.watchDogTimer = self.config.getfloat('apogeeql', 'watchDogTimer')
+      self.watchDogInterval = 0
+      if self.config.has_option('apogeeql', 'watchDogInterval'):
+         self.watchDogInterval = self.config.getfloat('apogeeql', 'watchDogInterval')
+      self.pings = {}
+
+      #
+      # UTR reads forwarded to quicklook: all of them unless it falls behind
+      #
+      milestone = 6
+      if self.config.has_option('apogeeql', 'qlMilestone'):
+         milestone = self.config.getint('apogeeql', 'qlMilestone')
+      maxStride = 6
+      if self.config.has_option('apogeeql', 'qlMaxStride'):
+         maxStride = self.config.getint('apogeeql', 'qlMaxStride')
+      self.readDecimator = readDecimation.ReadDecimator(milestone, maxStride, readTime=self.utrReadTime)
+
+      #
+      # shared-memory ring of the last qlFrameRingSlots reads given to quicklook with their message
+      # (0: none, and the UTR messages keep their 6 fields; with a ring they carry the handle and header too)
+      #
+      ringPath = '/dev/shm/apogeeql-frames'
+      if self.config.has_option('apogeeql', 'qlFrameRing'):
+         ringPath = self.config.get('apogeeql', 'qlFrameRing')
+      ringSlots = 0
+      if self.config.has_option('apogeeql', 'qlFrameRingSlots'):
+         ringSlots = self.config.getint('apogeeql', 'qlFrameRingSlots')
+      self.frameRing = frameRing.FrameRing(ringPath, ringSlots) if ringSlots > 0 else None
+
+      #
+      # running up-the-ramp fit of the last utrRampExposures exposures, for quicklook (0: none)
+      #
+      rampExposures = 0
+      if self.config.has_option('apogeeql', 'utrRampExposures'):
+         rampExposures = self.config.getint('apogeeql', 'utrRampExposures')
+      saturation = 65000.0
+      if self.config.has_option('apogeeql', 'utrSaturation'):
+         saturation = self.config.getfloat('apogeeql', 'utrSaturation')
+      # jumps: differences above the running mean by more than utrJumpSigma times the noise expected
+      noise = {'utrReadNoise': 10.0, 'utrGain': 1.9, 'utrJumpSigma': 5.0}
+      for option in noise:
+         if self.config.has_option('apogeeql', option):
+            noise[option] = self.config.getfloat('apogeeql', option)
+      self.ramps = None
+      if rampExposures > 0:
+         self.ramps = utrRamp.RampCache(rampExposures, saturation, noise['utrReadNoise'], noise['utrGain'],
+                                        noise['utrJumpSigma'])
+
+      #
+      # statistics of every read, from one pixel every readStatsStride rows and columns (0: none)
+      #
+      self.readStatsStride = 0
+      if self.config.has_option('apogeeql', 'readStatsStride'):
+         self.readStatsStride = self.config.getint('apogeeql', 'readStatsStride')
+      self.readStatsThreshold = saturation
+      if self.config.has_option('apogeeql', 'readStatsThreshold'):
+         self.readStatsThreshold = self.config.getfloat('apogeeql', 'readStatsThreshold')
+
+      #
+      # quick S/N of the science exposures from their CDS summary (fastSNR), with fixed trace windows
+      #
+      self.snrTraces = None
+      if self.config.has_option('apogeeql', 'fastSNR') and self.config.getboolean('apogeeql', 'fastSNR'):
+         snr = {'snrTraceFirst': 2040.0, 'snrTraceSpacing': -6.8, 'snrTraceHalfWidth': 2,
+                'snrGain': 1.9, 'snrReadNoise': 10.0, 'snrRefHmag': 11.0}
+         for option in snr:
+            if self.config.has_option('apogeeql', option):
+               snr[option] = self.config.getfloat('apogeeql', option)
+         chip = 'b'
+         if self.config.has_option('apogeeql', 'snrChip'):
+            chip = self.config.get('apogeeql', 'snrChip')
+         self.snrTraces = snrEstimate.TraceModel(snr['snrTraceFirst'], snr['snrTraceSpacing'],
+                                                 int(snr['snrTraceHalfWidth']), 'abc'.index(chip))
+         self.snrGain = snr['snrGain']
+         self.snrReadNoise = snr['snrReadNoise']
+         self.snrRefHmag = snr['snrRefHmag']
+
+   def annotateInFlightChanged(self, running, queued):
+      '''publish the number of UTR reads being annotated and waiting for a worker'''
+      self.bcast.inform('annotateInFlight=%d,%d,%d' % (running, queued, self.annotatePool.dropped))
+      # warn once each time the backlog goes above the threshold
+      if queued > self.annotateBacklogWarn and not self.annotateBacklogWarned:
+         self.logger.warn('APOGEEQL -> %d UTR reads waiting to be annotated' % (queued))
+      self.annotateBacklogWarned = queued > self.annotateBacklogWarn
+
    @staticmethod
    def TCCInstCB(keyVar):
       '''callback routine for tcc.inst'''
@@ -309,6 +515,7 @@ class Apogeeql(actorcore.Actor.Actor):
    @staticmethod
    def PointingInfoCB(keyVar):
       '''callback routine for platedb.pointingInfo'''
+      # the plate path: not registered with the FPS (see configurationLoadedCB), kept for plate data
       # plate_id, cartridge_id, pointing_id, boresight_ra, boresight_dec, hour_angle, temperature, wavelength
       # print "PointingInfoCB=",keyVar
 
@@ -335,9 +542,9 @@ class Apogeeql(actorcore.Actor.Actor):
       # print Apogeeql.actor.models['platedb'].keyVarDict['activePlugging']
 
       # find the platedb.survey.pk corresponding to APOGEE (-2)
-      survey = Apogeeql.actor.mysession.query(Survey).filter(Survey.label=='APOGEE-2')
-      if survey.count() > 0:
-         Apogeeql.actor.apogeeSurveyPk = survey[0].pk
+      #survey = Apogeeql.actor.mysession.query(Survey).filter(Survey.label=='APOGEE-2')
+      #if survey.count() > 0:
+      #   Apogeeql.actor.apogeeSurveyPk = survey[0].pk
 
       if plate != Apogeeql.prevPlate or cartridge != Apogeeql.prevCartridge or pointing != Apogeeql.prevPointing:
          # we need to ignore all plates that are not for APOGEE or MANGA
@@ -348,7 +555,8 @@ class Apogeeql(actorcore.Actor.Actor):
          #           return
 
          # we need to extract and pass a new plugmap to QuickLook
-         pm = Apogeeql.actor.getPlPlugMapM(Apogeeql.actor.mysession, cartridge, plate, pointing)
+         # the newest plugmap and its fibers, in one query
+         pm = Apogeeql.actor.plateDb.plugMap(cartridge, plate, pointing)
 
          # routine returns a yanny par file
          # replace plPlugMapM-xxxx by plPlugMapA-xxxx
@@ -358,14 +566,23 @@ class Apogeeql(actorcore.Actor.Actor):
          fname  = os.path.join(Apogeeql.actor.plugmap_dir,fname[0:p+3]+'A'+fname[p+4:])
 
          # print 'fname=',fname
-         Apogeeql.actor.makeApogeePlugMap(pm, fname, plate)
+         # a plugging seen before (same scan of the plate) is linked from the cache
+         key = ('plate', plate, pm.fscan_mjd, pm.fscan_id)
+         cache = Apogeeql.actor.plugMapCache
+         if cache is not None and cache.install(key, fname):
+            Apogeeql.actor.logger.info('APOGEEQL -> %s from the plugmap cache' % (fname))
+         else:
+            Apogeeql.actor.makeApogeePlugMap(pm, fname, plate)
+            if cache is not None:
+               cache.put(key, fname)
+         Apogeeql.actor.archivePlugMap(fname)
 
          # pass the info to IDL QL
          #for s in Apogeeql.actor.qlSources:
          #    s.sendLine('plugMapInfo=%s,%s,%s,%s' % (plate, pm.fscan_mjd, pm.fscan_id, fname))
          #for s in Apogeeql.actor.qrSources:
          #    s.sendLine('plugMapInfo=%s,%s,%s,%s' % (plate, pm.fscan_mjd, pm.fscan_id, fname))
-         Apogeeql.actor.ql_in_queue.put(('plugMapInfo',plate, pm.fscan_mjd, pm.fscan_id, fname))
+         Apogeeql.actor.qlSend(('plugMapInfo',plate, pm.fscan_mjd, pm.fscan_id, fname))
 
          # print 'plugMapFilename=%s' % (fname)
          Apogeeql.prevPointing = pointing
@@ -419,9 +636,14 @@ class Apogeeql(actorcore.Actor.Actor):
       #if survey.count() > 0:
       #   Apogeeql.actor.apogeeSurveyPk = survey[0].pk
 
+      # parse the confSummary in the background, before the first exposure needs it
+      # (quicklook can take the parsed table from actor.confSummaries, by config_id)
+      d = Apogeeql.actor.confSummaries.prefetch(config_id, summary_file)
+      d.addErrback(lambda failure: None)   # logged by the cache, quicklook parses it again
+
       if config_id != Apogeeql.prevPlate:
-         # pass the info to IDL QL
-         Apogeeql.actor.ql_in_queue.put(('configInfo',config_id, summary_file))
+         # pass the info to IDL QL now, ahead of the reads of the new configuration
+         Apogeeql.actor.qlSend(('configInfo', config_id, summary_file))
 
          # print 'plugMapFilename=%s' % (fname)
          Apogeeql.config_id = config_id
@@ -431,6 +653,7 @@ class Apogeeql(actorcore.Actor.Actor):
          Apogeeql.prevPointing = config_id
          Apogeeql.prevPlate = config_id
          Apogeeql.prevCartridge = 'FPS'
+         Apogeeql.actor.cardCache.invalidate()
 
    @staticmethod
    def ExposureStateCB(keyVar):
@@ -462,6 +685,18 @@ class Apogeeql(actorcore.Actor.Actor):
          Apogeeql.endExp = False
          Apogeeql.expType = keyVar[1].upper()
          Apogeeql.numReadsCommanded = int(keyVar[2])
+         Apogeeql.actor.cardCache.invalidate()
+         # register the exposure now: its row is inserted while the first read is taken
+         # (if the exposure name can't be parsed, the first read registers it)
+         try:
+            expnum = int(keyVar[3].split('-')[1])
+         except:
+            expnum = None
+         if expnum is not None and Apogeeql.registeredExpNo != expnum:
+            Apogeeql.registeredExpNo = expnum
+            Apogeeql.registerExposure(expnum, Apogeeql.actor.exposures.record(
+               Apogeeql.exposureRow(expnum, Apogeeql.actor.utrReadTime, Apogeeql.expType, Apogeeql.config_id)))
+            Apogeeql.exptimePending = (expnum, Apogeeql.exp_pk)
          # we may have to do something special for QL at the start of a new exposure
       elif Apogeeql.expState.upper() in ['DONE', 'STOPPED', 'FAILED']:
          # ignore if we weren't actually exposing
@@ -470,19 +705,13 @@ class Apogeeql(actorcore.Actor.Actor):
             Apogeeql.endExp = True
             Apogeeql.expType = keyVar[1].upper()
             filebase = keyVar[3]
-            # make sure we have all the UTR files before bundling
-            Apogeeql.completeUTR(Apogeeql.actor,filebase)
+            nReads = Apogeeql.numReadsCommanded
             Apogeeql.numReadsCommanded = 0
-            res = keyVar[3].split('-')
-            Apogeeql.frameid = res[1][:8]
-            mjd5 = int(Apogeeql.frameid[:4]) + int(Apogeeql.actor.startOfSurvey)
-            # do something for the quickreduction at the end of an exposure
-            #for s in Apogeeql.qlSources:
-            #   s.sendLine('UTR=DONE')
-            #for s in Apogeeql.qrSources:
-            #   s.sendLine('UTR=DONE,%s,%d,%s' % (Apogeeql.frameid, mjd5, Apogeeql.exp_pk))
-            Apogeeql.actor.ql_in_queue.put(('UTRDONE',Apogeeql.actor,Apogeeql.frameid, mjd5, Apogeeql.exp_pk),block=True)
-            Apogeeql.actor.bndl_in_queue.put(('BUNDLE',Apogeeql.frameid, mjd5, Apogeeql.exp_pk),block=True)
+            # the pk of this exposure, not of the one that may start before the barrier fires
+            # (None if it is registered by its first read, still being annotated)
+            exp_pk = Apogeeql.exposurePk(filebase)
+            # wrap up once the reads still being annotated have been handed to quicklook
+            Apogeeql.actor.annotatePool.submit(None, callback=lambda result: Apogeeql.finishExposure(filebase, nReads, exp_pk))
 
       elif Apogeeql.expState.upper() != 'STOPPING':
          # when a stop was requested, a couple of images will still be coming in
@@ -490,6 +719,39 @@ class Apogeeql(actorcore.Actor.Actor):
          Apogeeql.startExp = False
 
 
+   @staticmethod
+   def registerExposure(expnum, exp_pk):
+      '''remember the (provisional) pk of an exposure, for its reads and its finalization'''
+      Apogeeql.exp_pk = exp_pk
+      Apogeeql.expPks[expnum] = exp_pk
+      for old in sorted(Apogeeql.expPks)[:-Apogeeql.keepExpPks]:
+         del Apogeeql.expPks[old]
+
+   @staticmethod
+   def exposurePk(filebase):
+      '''the (provisional) pk registered for apRaw-DDDDXXXX, None if it is not registered'''
+      try:
+         return Apogeeql.expPks.get(int(filebase.split('-')[1]))
+      except (IndexError, ValueError):
+         return None
+
+   @staticmethod
+   def finishExposure(filebase, nReads=0, exp_pk=None):
+      '''hand a finished exposure (all its reads delivered) to the finalization pipeline'''
+      if exp_pk is None:
+         # registered by its first read: known now that the read was delivered
+         exp_pk = Apogeeql.exposurePk(filebase) or 0
+      res = filebase.split('-')
+      Apogeeql.frameid = res[1][:8]
+      mjd5 = int(Apogeeql.frameid[:4]) + int(Apogeeql.actor.startOfSurvey)
+      # everything the stages need is captured now: the next exposure may start before they run
+      job = finalize.Finalization(filebase, nReads=nReads, frameid=Apogeeql.frameid, mjd5=mjd5,
+                                  exp_pk=exp_pk, manifest=Apogeeql.readManifests.pop(filebase, None),
+                                  missing=[], empty=False)
+      # UTRDONE goes to quicklook in the order the exposures ended, once the missing reads are recovered
+      job.notified = Apogeeql.actor.qlHold()
+      Apogeeql.actor.finalizer.submit(job)
+
    @staticmethod
    def exposureWroteFileCB(keyVar):
       '''callback routine for apogeeICC.exposureState '''
@@ -516,8 +778,14 @@ class Apogeeql(actorcore.Actor.Actor):
          print "exposureWroteFileCB  -> Null filename received"
          return
 
-      # create a new FITS file by appending the telescope fits keywords
-      newfilename, starttime, exptime = Apogeeql.appendFitsKeywords(Apogeeql.actor,filename)
+      # get the mjd from the filename
+      res=filename.split('-')
+      try:
+         mjd = int(res[1][:4]) + int(Apogeeql.actor.startOfSurvey)
+         readnum = int(res[2].split('.')[0])
+         expnum = int(res[1])
+      except:
+         raise RuntimeError( "The filename doesn't match expected format (%s)" % (filename))
 
       #Don't create a new exposure if the exposure is not an APOGEE or MANGA object
       #if Apogeeql.prevPlate == -1:
@@ -525,6 +793,122 @@ class Apogeeql(actorcore.Actor.Actor):
       #   return
       # COMMENTING THIS OUT. DLN 10/26/21
 
+      # only one read per exposure creates the exposure row (reads are annotated concurrently)
+      register = expnum not in Apogeeql.expPks and Apogeeql.registeredExpNo != expnum
+      if register:
+         Apogeeql.registeredExpNo = expnum
+      # the first read of an exposure registered at EXPOSING gives its actual exposure time
+      exptimeCheck = None
+      if Apogeeql.exptimePending and Apogeeql.exptimePending[0] == expnum:
+         exptimeCheck = Apogeeql.exptimePending
+         Apogeeql.exptimePending = None
+
+      # create a new FITS file by appending the telescope fits keywords, in a worker thread
+      # (everything the worker needs from the actor state is captured here, on the reactor)
+      version, telemetry = Apogeeql.actor.cardCache.snapshot()
+      numReadsCommanded = Apogeeql.numReadsCommanded
+      registration = (expnum, Apogeeql.expType, Apogeeql.config_id) if register else None
+      Apogeeql.actor.annotatePool.submit(Apogeeql.annotateRead, (Apogeeql.actor, filename, telemetry),
+            callback=lambda result: Apogeeql.utrAnnotated(result, res[0]+'-'+res[1], readnum, numReadsCommanded, registration, exptimeCheck),
+            errback=lambda excInfo: Apogeeql.utrFailed(excInfo, filename, register, exptimeCheck))
+
+   @staticmethod
+   def annotateRead(actor, filename, telemetry):
+      '''worker thread: annotate a UTR read (its pixels left in the frame ring, if any)'''
+      frame = {}
+      newfilename, starttime, exptime = actor.appendFitsKeywords(filename, telemetry, frame)
+      results = {}
+      if actor.ramps is not None or actor.readStatsStride > 0:
+         results = actor.examineRead(filename, newfilename, frame)
+      return newfilename, exptime, frame.get('handle'), frame.get('header'), results
+
+   def examineRead(self, filename, newfilename, frame):
+      '''worker thread: look at the pixels of an annotated read
+
+      The read is added to the running ramp fit of its exposure (for quicklook), giving
+      the jumps and newly saturated pixels of each chip ('flags', see utrRamp.RampCache.add),
+      and its chip statistics are computed ('stats', see readStats.chipStats).
+      '''
+      results = {}
+      try:
+         exposure, readnum = os.path.splitext(filename)[0].rsplit('-', 1)
+         if frame.get('handle') is not None:
+            # the pixels are still in the frame ring
+            data, bzero, bscale = self.frameRing.frame(frame['handle']), frame['bzero'], frame['bscale']
+         else:
+            data, bzero, bscale = utrRamp.readFrame(newfilename)
+         if self.readStatsStride > 0:
+            results['stats'] = readStats.chipStats(data, bzero, bscale, stride=self.readStatsStride,
+                                                   threshold=self.readStatsThreshold)
+         if self.ramps is not None:
+            results['flags'] = self.ramps.add(exposure, int(readnum), data, bzero, bscale)
+      except Exception as e:
+         self.logger.warn('APOGEEQL -> could not examine the pixels of %s: %s' % (filename, e))
+      return results
+
+   @staticmethod
+   def utrAnnotated(result, filebase, readnum, numReadsCommanded, registration=None, exptimeCheck=None):
+      '''pass an annotated read to quicklook (called on the reactor, in read order)'''
+      newfilename, exptime, handle, header, pixels = result
+      if pixels.get('stats'):
+         Apogeeql.actor.bcast.inform(readStats.keyword(filebase, readnum, pixels['stats']))
+      if pixels.get('flags'):
+         jumps, saturated = pixels['flags']
+         Apogeeql.actor.bcast.inform('utrFlags=%s,%d,%s,%s' % (filebase, readnum, ','.join(['%d' % n for n in jumps]),
+                                                               ','.join(['%d' % n for n in saturated])))
+      if registration:
+         # the row is inserted in the background: we get a provisional id right away
+         expnum, expType, configId = registration
+         Apogeeql.registerExposure(expnum, Apogeeql.actor.exposures.record(Apogeeql.exposureRow(expnum, exptime, expType, configId)))
+      elif exptimeCheck and exptime is not None and abs(float(exptime) - Apogeeql.actor.utrReadTime) > 0.01:
+         # registered at EXPOSING with the nominal read time
+         Apogeeql.actor.exposures.update(exptimeCheck[1], {'exposure_time': float(exptime)})
+      if filebase not in Apogeeql.readManifests:
+         Apogeeql.readManifests[filebase] = readManifest.ReadManifest(filebase)
+      Apogeeql.readManifests[filebase].add(readnum)
+
+      #for s in Apogeeql.qlSources:
+      #   s.sendLine('UTR=%s,%d,%d,%d' % (newfilename, Apogeeql.exp_pk, readnum, Apogeeql.numReadsCommanded))
+      #Apogeeql.actor.ql_in_queue.put(('UTR',newfilename, Apogeeql.exp_pk, readnum, Apogeeql.numReadsCommanded),block=True)
+      # the pk of the exposure of this read (the next one may be registered already);
+      # 0, as before any exposure is registered, while its row is not in the opsdb yet:
+      # a provisional id means nothing to quicklook (UTRDONE or UTRDONEPK has the pk)
+      exp_pk = Apogeeql.actor.exposures.resolve(Apogeeql.exposurePk(filebase) or 0)
+      if exp_pk is None or exp_pk < 0:
+         exp_pk = 0
+      # thin out the reads when quicklook falls behind
+      queue = Apogeeql.actor.ql_in_queue
+      lag = queue.oldest()
+      forward, stride = Apogeeql.actor.readDecimator.decide(filebase, readnum, numReadsCommanded, queue.serviceTime, lag)
+      Apogeeql.actor.bcast.inform('qlDecimation=%s,%d,%d,%d,%.2f,%.2f' %
+                                  (filebase, readnum, forward, stride, queue.serviceTime, lag))
+      if not forward:
+         if handle is not None:
+            Apogeeql.actor.frameRing.release(handle)
+      elif Apogeeql.actor.frameRing is None:
+         Apogeeql.actor.qlSend(('UTR', Apogeeql.actor, newfilename, exp_pk, readnum, numReadsCommanded))
+      else:
+         # the frame (None if it could not be put in the ring) is released when quicklook takes the message:
+         # frameRing.frame(handle) gives quicklook a copy, so the slot can be reused right away
+         Apogeeql.actor.qlSend(('UTR', Apogeeql.actor, newfilename, exp_pk, readnum, numReadsCommanded,
+                                handle, header))
+
+   @staticmethod
+   def utrFailed(excInfo, filename, register, exptimeCheck=None):
+      '''log a read that could not be annotated (called on the reactor, in read order)'''
+      Apogeeql.actor.logger.error('APOGEEQL -> failed to annotate %s: %s' % (filename, excInfo[1]))
+      traceback.print_exception(*excInfo)
+      if register:
+         # let the next read try to create the exposure row
+         Apogeeql.registeredExpNo = None
+      if exptimeCheck and Apogeeql.exptimePending is None:
+         # let the next read give the exposure time
+         Apogeeql.exptimePending = exptimeCheck
+
+   @staticmethod
+   def exposureRow(expnum, exptime, expType, configId):
+      '''Return the column values of a new row of the opsdb exposure table'''
+
       # Exposure flavor
       # pk |   label
       # ----+------------
@@ -550,55 +934,77 @@ class Apogeeql(actorcore.Actor.Actor):
                         'QUARTZFLAT':'QuartzFlat', 'DOMEFLAT':'DomeFlat',
                         'ARCLAMP':'ArcLamp', 'BLACKBODY':'Calib'}
 
-      # get the mjd from the filename
-      res=filename.split('-')
-      try:
-         mjd = int(res[1][:4]) + int(Apogeeql.actor.startOfSurvey)
-         readnum = int(res[2].split('.')[0])
-         expnum = int(res[1])
-      except:
-         raise RuntimeError( "The filename doesn't match expected format (%s)" % (filename))
+      #Create new exposure object
+      #currently hard-coded for survey=APOGEE-2
+
+      #if Apogeeql.prevPlate > 15000:
+      #    surveyLabel = 'MWM'
+      #else:
+      #    surveyLabel = 'APOGEE-2'
+      surveyLabel = 'MWM'
+
+      # exposure_flavor "label" value for this exposure
+      expflavorlabel = exptype2flavor.get(expType)
+      if expflavorlabel is None:
+         expflavorlabel = 'Object'
+      # get exposure_flavor_pk for this exposure
+      expflavorpk = expflavordict.get(expflavorlabel)
+      if expflavorpk is None:
+          expflavorpk = 5  # Object by default
+      Apogeeql.actor.logger.info('exptype = %s  expflavorpk = %s' % (expType, expflavorpk))
+      # survey_pk=2 is for MWM
+      return dict(configuration_id=configId, exposure_no=expnum,
+                  exposure_time=exptime, exposure_flavor_pk=expflavorpk,
+                  start_time=datetime.datetime.now(), survey_pk=2)
 
-      if readnum == 1 or Apogeeql.exp_pk == 0:
-
-         #Create new exposure object
-         #currently hard-coded for survey=APOGEE-2
+   @staticmethod
+   def insertExposure(row):
+      '''Insert a row in the opsdb exposure table, return its pk (runs in a thread)'''
+      try:
+         with opsdb.transaction():
+            new_exposure = opsdb.Exposure(**row)
+            new_exposure.save()
+            return new_exposure.pk
+      except Exception as e:
+         Apogeeql.actor.logger.error('Failed in call addExposure for exposureNo %d' % row['exposure_no'])
+         Apogeeql.actor.logger.error('Exception: %s'%e)
+         # the recorder retries or quarantines the row depending on the type of the error
+         raise
 
-          #if Apogeeql.prevPlate > 15000:
-          #    surveyLabel = 'MWM'
-          #else:
-          #    surveyLabel = 'APOGEE-2'
-          surveyLabel = 'MWM'
+   @staticmethod
+   def updateExposure(pk, fields):
+      '''Change some columns of a row of the opsdb exposure table (runs in a thread)'''
+      try:
+         with opsdb.transaction():
+            opsdb.Exposure.update(**fields).where(opsdb.Exposure.pk == pk).execute()
+      except Exception as e:
+         Apogeeql.actor.logger.error('Failed to update exposure pk %d with %s: %s' % (pk, fields, e))
+         raise
 
-          try:
-             with database.atomic():
-               # exposure_flavor "label" value for this exposure
-               expflavorlabel = exptype2flavor.get(Apogeeql.expType)
-               if expflavorlabel is None:
-                  expflavorlabel = 'Object'
-               # get exposure_flavor_pk for this exposure
-               expflavorpk = expflavordict.get(expflavorlabel)
-               if expflavorpk is None:
-                   expflavorpk = 5  # Object by default
-               print('exptype = ',Apogeeql.expType)
-               print('expflavorpk = ',expflavorpk)
-               # survey_pk=2 is for MWM
-               new_exposure = Exposure(configuration_id=Apogeeql.config_id, exposure_no=expnum,
-                                       exposure_time=exptime, exposure_flavor_pk=expflavorpk,
-                                       start_time=datetime.datetime.now(),survey_pk=2)
-               new_exposure.save()
-               Apogeeql.exp_pk = new_exposure.pk
-
-          except RuntimeError as e:
-             Apogeeql.actor.logger.error('Failed in call addExposure for exposureNo %d' %expnum)
-             Apogeeql.actor.logger.error('Exception: %s'%e)
-             raise RuntimeError('Failed in call addExposure for exposureNo %d' %expnum +'\n'+str(e))
+   @staticmethod
+   def deleteExposure(pk):
+      '''Remove a row of the opsdb exposure table (runs in a thread)'''
+      try:
+         with opsdb.transaction():
+            opsdb.Exposure.delete().where(opsdb.Exposure.pk == pk).execute()
+      except Exception as e:
+         Apogeeql.actor.logger.error('Failed to delete exposure pk %d: %s' % (pk, e))
+         raise
 
-      #for s in Apogeeql.qlSources:
-      #   s.sendLine('UTR=%s,%d,%d,%d' % (newfilename, Apogeeql.exp_pk, readnum, Apogeeql.numReadsCommanded))
-      #Apogeeql.actor.ql_in_queue.put(('UTR',newfilename, Apogeeql.exp_pk, readnum, Apogeeql.numReadsCommanded),block=True)
-      Apogeeql.actor.ql_in_queue.put(('UTR', Apogeeql.actor, newfilename, Apogeeql.exp_pk, readnum, Apogeeql.numReadsCommanded),block=True)
+   @staticmethod
+   def exposureResolved(localId, exp_pk):
+      '''a provisional exposure id got its database pk'''
+      Apogeeql.actor.logger.info('APOGEEQL -> exposure %d inserted as pk %d' % (localId, exp_pk))
+      if Apogeeql.exp_pk == localId:
+         Apogeeql.exp_pk = exp_pk
+      for expnum, pk in Apogeeql.expPks.items():
+         if pk == localId:
+            Apogeeql.expPks[expnum] = exp_pk
 
+   @staticmethod
+   def exposureRejected(kind, localId, data, error):
+      '''the opsdb refused an exposure row (or an update of it) for good'''
+      Apogeeql.actor.bcast.warn('text="exposure %s %d refused by the opsdb, quarantined: %s"' % (kind, localId, error))
 
    @staticmethod
    def exposureWroteSummaryCB(keyVar):
@@ -623,21 +1029,58 @@ class Apogeeql(actorcore.Actor.Actor):
       indir=Apogeeql.actor.summary_dir
       outdir = Apogeeql.actor.cdr_dir
 
+      indir  = os.path.join(indir,dayOfSurvey)
+      infile = os.path.join(indir,filename)
+      outdir = os.path.join(outdir,str(mjd))
+      outfile = os.path.join(outdir,filename)
       try:
-         indir  = os.path.join(indir,dayOfSurvey)
-         infile = os.path.join(indir,filename)
-         outdir = os.path.join(outdir,str(mjd))
-         outfile = os.path.join(outdir,filename)
          if not os.path.isdir(outdir):
             os.mkdir(outdir)
             # print 'Directory created at: ' + dest
-         # t0=time.time()
-         shutil.copy2(infile,outfile)
-         # print "shutil.copy2 took %f seconds" % (time.time()-t0)
       except:
-         #raise RuntimeError( "Failed to copy the summary file (%s)" % (filename))
          raise RuntimeError( "Failed to copy the summary file (%s -> %s)" % (infile,outfile))
 
+      # copy in the background (reflink or kernel-side copy) so keyword processing goes on
+      # (the configuration is the one of the exposure now, not once the copy is done)
+      configuration = (Apogeeql.expType, Apogeeql.config_id, Apogeeql.summary_file or None)
+      d = fileTransfer.copyFileAsync(infile,outfile)
+      d.addCallbacks(Apogeeql.summaryCopied, Apogeeql.summaryCopyFailed,
+                     callbackArgs=(configuration,), errbackArgs=(infile,outfile))
+
+   @staticmethod
+   def summaryCopied(outfile, configuration=None):
+      '''called on the reactor once a CDS summary file is in cdr_dir'''
+      Apogeeql.actor.logger.debug('APOGEEQL -> summary file copied to %s' % (outfile))
+      expType, configId, summaryFile = configuration or (None, None, None)
+      if Apogeeql.actor.snrTraces is not None and expType == 'OBJECT' and configId is not None:
+         d = threads.deferToThread(Apogeeql.actor.estimateSNR, outfile, configId, summaryFile)
+         d.addCallbacks(Apogeeql.snrEstimated, Apogeeql.snrFailed, callbackArgs=(outfile,), errbackArgs=(outfile,))
+
+   def estimateSNR(self, filename, configId, summaryFile):
+      '''worker thread: S/N of the fibers in a CDS summary file (see snrEstimate.estimate)'''
+      fibers = self.confSummaries.get(configId, summaryFile)
+      if fibers is None:
+         raise snrEstimate.SNRError('no fibers for configuration %s' % (configId))
+      return snrEstimate.estimate(filename, fibers, self.snrTraces, self.snrGain, self.snrReadNoise, self.snrRefHmag)
+
+   @staticmethod
+   def snrEstimated(result, filename):
+      '''publish the quick S/N of a CDS summary (called on the reactor)'''
+      n, snrRef, slope, intercept, median = result
+      Apogeeql.actor.bcast.inform('fastSNR=%s,%d,%.2f,%.1f,%.4f,%.4f,%.1f' %
+                                  (os.path.splitext(os.path.basename(filename))[0], n, Apogeeql.actor.snrRefHmag,
+                                   snrRef, slope, intercept, median))
+
+   @staticmethod
+   def snrFailed(failure, filename):
+      Apogeeql.actor.logger.warn('APOGEEQL -> no quick S/N for %s: %s' % (filename, failure.getErrorMessage()))
+
+   @staticmethod
+   def summaryCopyFailed(failure, infile, outfile):
+      '''called on the reactor when a CDS summary file could not be copied'''
+      Apogeeql.actor.logger.error("Failed to copy the summary file (%s -> %s): %s" % (infile,outfile,failure.getErrorMessage()))
+      Apogeeql.actor.bcast.warn('text="Failed to copy the summary file %s"' % (os.path.basename(infile)))
+
    @staticmethod
    def ditherPositionCB(keyVar):
 
@@ -653,7 +1096,7 @@ class Apogeeql(actorcore.Actor.Actor):
       Apogeeql.namedDitherPos = keyVar[1]
       #for s in Apogeeql.actor.qlSources:
       #    s.sendLine('ditherPosition=%f,%s' % (Apogeeql.ditherPos, Apogeeql.namedDitherPos))
-      Apogeeql.actor.ql_in_queue.put(('ditherPosition',Apogeeql.ditherPos, Apogeeql.namedDitherPos),block=True)
+      Apogeeql.actor.qlSend(('ditherPosition',Apogeeql.ditherPos, Apogeeql.namedDitherPos))
 
 
    def startQuickLook(self):
@@ -667,7 +1110,11 @@ class Apogeeql(actorcore.Actor.Actor):
 
       # start the quicklook python thread
       try:
-          ql_in_queue = Queue()
+          ql_in_queue = workQueue.QuicklookQueue('ql', self.qlQueueSize, self.qlQueuePolicy, onDrop=self.qlDropped,
+                                                 onGet=self.qlTaken, keep=self.readDecimator.keep)
+          if self.frameRing is not None:
+             # the frames held by the messages of the previous thread
+             self.frameRing.releaseAll()
           ql_reply_queue = Queue()
           t1 = Thread(target = quicklookThread.main, args =(ql_in_queue, ql_reply_queue))
           t1.start()
@@ -676,55 +1123,104 @@ class Apogeeql(actorcore.Actor.Actor):
           self.ql_in_queue = ql_in_queue
           self.ql_reply_queue = ql_reply_queue
           self.ql_name = t1.name
+          # the PINGs sent to the previous thread will never be answered
+          self.pongSeq = self.pingSeq
       except:
          self.logger.error("Failed to start the quicklook thread")
          traceback.print_exc()
 
 
+   def qlDropped(self, message):
+      '''a message quicklook will never see: give back its frame'''
+      if len(message) > 6 and message[6] is not None:
+         self.frameRing.release(message[6])
+
+   def qlTaken(self, message):
+      '''a message quicklook took off its queue: give back its frame (readable until its slot is reused)'''
+      if isinstance(message, tuple) and message[0] == 'UTR' and len(message) > 6 and message[6] is not None:
+         self.frameRing.release(message[6])
+
    def stopQuickLook(self):
       '''If a quicklook thread already exists - just kill it (for now)'''
-      # Send EXIT command to quicklook thread
-      self.ql_in_queue.put('EXIT',block=True)
+      # Send EXIT command to quicklook thread (without waiting for room in the queue of a stuck thread),
+      # after the UTRDONE of an exposure still being finalized
+      queue, name = self.ql_in_queue, self.ql_name
+      def exit(result=None):
+         try:
+            queue.put('EXIT',block=False)
+         except Full:
+            self.logger.warn('APOGEEQL -> quicklook queue full, abandoning the quicklook thread %s' % (name))
+      if self.qlHeld is None:
+         exit()
+      else:
+         self.qlHeld.addBoth(exit)
       # check if the thread is still alive?
       self.ql_running = False
 
-   def startBundle(self):
-      '''Open a python thread to bundling code.'''
+   def qlSend(self, message):
+      '''put a message on the quicklook queue (on the reactor), behind a held UTRDONE'''
+      if self.qlHeld is None:
+         self.ql_in_queue.put(message,block=True)
+      else:
+         self.qlHeld.addBoth(lambda result: self.ql_in_queue.put(message,block=True))
+
+   def qlHold(self):
+      '''keep the place of a message in the quicklook stream
+
+      Returns a Deferred to fire with the message (None to send nothing): the
+      messages sent meanwhile wait behind it.
+      '''
+      held = defer.Deferred()
+      def put(message):
+         if message is not None:
+            self.ql_in_queue.put(message,block=True)
+      if self.qlHeld is None:
+         held.addCallback(put)
+         tail = held
+      else:
+         tail = self.qlHeld
+         tail.addBoth(lambda result: held)
+         tail.addCallback(put)
+      tail.addBoth(self._qlReleased)
+      self.qlHeld = tail
+      self.qlHolds += 1
+      return held
+
+   def _qlReleased(self, result):
+      self.qlHolds -= 1
+      if self.qlHolds == 0:
+         self.qlHeld = None
+      if isinstance(result, Failure):
+         self.logger.error('APOGEEQL -> quicklook message not sent: %s' % (result.getErrorMessage()))
 
-      # check if an apogeeql_IDL process is already running before starting a new one
-      if self.bndl_running:
-         self.stopBundle()
+   def startBundle(self):
+      '''Start the bundling processes (forked in __init__, before any thread: they can't be restarted)'''
 
-      print('Starting the Bundling Thread')
+      print('Starting the Bundling processes')
 
-      # Start bundle python thread
       try:
-          bndl_in_queue = Queue()
-          bndl_reply_queue = Queue()
-          t2 = Thread(target = bundleThread.main, args =(bndl_in_queue, bndl_reply_queue))
-          t2.start()
+          self.bundlePool.start()
           self.bndl_running = True
-          self.bndl_thread = t2
-          self.bndl_in_queue = bndl_in_queue
-          self.bndl_reply_queue = bndl_reply_queue
-          self.bndl_name = t2.name
       except:
-         self.logger.error("Failed to start the Bundle thread")
+         self.logger.error("Failed to start the Bundle processes")
          traceback.print_exc()
 
    def stopBundle(self):
-      '''If a bundle thread already exists - just kill it (for now)'''
-      # Send EXIT command to quicklook thread
-      self.bndl_in_queue.put('EXIT',block=True)
-      # check if the thread is still alive?
+      '''Let the bundling processes finish the exposures already submitted and exit'''
+      self.bundlePool.stop()
       self.bndl_running = False
 
+   def bundleInFlightChanged(self, running, queued):
+      '''publish the number of bundling jobs running and waiting for a process'''
+      self.bcast.inform('bundleInFlight=%d,%d' % (running, queued))
+
    def kill_handler(self,signum,frame):
       ''' Kill handler.  stop quicklook and bundle threads.'''
       print('Kill signal encountered.  Stopping quicklook and bundle threads.')
       print('Signal handler called with signal', signum)
       self.stopQuickLook()
       self.stopBundle()
+      self.annotatePool.stop()
       print('Exiting apogeeql')
       #sys.exit(0)
       reactor.stop()
@@ -739,27 +1235,104 @@ class Apogeeql(actorcore.Actor.Actor):
       self.callCommand('checkdisks')
       reactor.callLater(int(self.config.get(self.name, 'diskAlarmInterval')), self.periodicDisksStatus)
 
-   def sendAliveTest(self):
-      '''Run some command periodically'''
-      self.watchDogStatus = False
-      #s.sendLine('PING')
-      self.ql_in_queue.put('PING',block=True)
-      # check for response
-      reply = self.ql_reply_queue.get(block=True)
-      if reply=='PONG':
-          self.watchDogStatus=True
-          return True
-      else:
-          return False
+   def periodicWatchDog(self):
+      '''Check periodically that the quicklook thread answers'''
+      if not self.qlRestarting:
+         self.isApqlAlive()
+      reactor.callLater(self.watchDogInterval, self.periodicWatchDog)
 
-      #reactor.callLater(int(self.watchDogTimer), self.isApqlAlive)
+   def sendAliveTest(self):
+      '''Send a PING to the quicklook thread
+
+      Returns a Deferred firing with True when it is answered, or with False if
+      it isn't within watchDogTimer seconds. The PINGs are numbered: the
+      quicklook thread answers them in order, so a late PONG of an earlier PING
+      doesn't count for this one. Never blocks the reactor.
+      '''
+      self.pingSeq += 1
+      seq = self.pingSeq
+      try:
+         #s.sendLine('PING')
+         self.ql_in_queue.put('PING',block=False)
+      except Full:
+         self.logger.warn('APOGEEQL -> quicklook queue full, cannot send PING %d' % (seq))
+         self.pongSeq = max(self.pongSeq, seq)
+         self.watchDogStatus = False
+         return defer.succeed(False)
+      d = defer.Deferred()
+      self.pings[seq] = d
+      reactor.callLater(self.watchDogTimer, self._pingTimedOut, seq)
+      if len(self.pings) == 1:
+         reactor.callLater(0.05, self._pollReplies)
+      return d
+
+   def _pollReplies(self):
+      '''Read the quicklook replies while PINGs are waiting (without blocking)'''
+      while True:
+         try:
+            reply = self.ql_reply_queue.get(block=False)
+         except Empty:
+            break
+         if reply == 'PONG':
+            self.pongSeq += 1
+            seq = self.pongSeq
+         elif isinstance(reply, tuple) and len(reply) == 2 and reply[0] == 'PONG':
+            # a thread that returns the number of the PING
+            seq = reply[1]
+            self.pongSeq = max(self.pongSeq, seq)
+         else:
+            self.logger.warn('APOGEEQL -> unexpected reply from quicklook: %s' % (reply,))
+            continue
+         d = self.pings.pop(seq, None)
+         if d is not None:
+            self.watchDogStatus = True
+            d.callback(True)
+      if self.pings:
+         reactor.callLater(0.05, self._pollReplies)
+
+   def _pingTimedOut(self, seq):
+      d = self.pings.pop(seq, None)
+      if d is not None:
+         self.logger.warn('APOGEEQL -> quicklook did not answer PING %d within %.1f s' % (seq, self.watchDogTimer))
+         self.watchDogStatus = False
+         d.callback(False)
 
    def isApqlAlive(self):
-      '''Run some command periodically'''
-      if not self.watchDogStatus:
+      '''PING quicklook, and restart its thread if it doesn't answer in time; returns a Deferred'''
+      d = self.sendAliveTest()
+      d.addCallback(self._aliveTested)
+      return d
+
+   def _aliveTested(self, alive):
+      if not alive and not self.qlRestarting:
          # APQL is not reponding - > restart it
          self.logger.warn("APOGEEQL -> quicklook thread not responding ... restarting ...")
-         self.startQuickLook()
+         self.restartQuickLook()
+      return alive
+
+   def restartQuickLook(self):
+      '''Replace a quicklook thread that does not answer, never running two of them
+
+      The queue of the old thread is emptied down to an EXIT, so it exits as soon
+      as it is done with the message it is on. The new thread is started once the
+      old one is gone, or after watchDogTimer seconds if it is stuck (it then only
+      finds the EXIT when it wakes up); the messages sent meanwhile wait for it.
+      '''
+      self.qlRestarting = True
+      self.ql_in_queue.abandon('EXIT')
+      self.ql_running = False
+      held = self.qlHold()
+      self._qlJoin(self.ql_thread, held, time.time() + self.watchDogTimer)
+
+   def _qlJoin(self, old, held, deadline):
+      if old is not None and old.is_alive() and time.time() < deadline:
+         reactor.callLater(0.1, self._qlJoin, old, held, deadline)
+         return
+      if old is not None and old.is_alive():
+         self.logger.error('APOGEEQL -> quicklook thread %s is stuck, starting a new one' % (old.name))
+      self.qlRestarting = False
+      self.startQuickLook()
+      held.callback(None)
 
    def connectionMade(self):
       '''Runs this after connection is made to the hub'''
@@ -768,8 +1341,12 @@ class Apogeeql(actorcore.Actor.Actor):
       #
       # reactor.callLater(3, self.periodicStatus)
 
-   def appendFitsKeywords(self, filename):
-      '''make a copy of the input FITS file with added keywords'''
+   def appendFitsKeywords(self, filename, telemetry=None, frame=None):
+      '''make a copy of the input FITS file with added keywords
+
+      With a frame dict (and a frame ring), the pixels are read into the ring on
+      the way and frame gets the 'handle' of the slot and the 'header' text.
+      '''
 
       # we need to form the paths where the file can be found and written
       # expecting something like: apRaw-DDDDXXXX-RRR.fits
@@ -795,48 +1372,92 @@ class Apogeeql(actorcore.Actor.Actor):
       except:
          raise RuntimeError( "The filename doesn't match expected format (%s)" % (filename))
 
-      # create directory if it doesn't exist
+      # create directory if it doesn't exist (another worker may be doing the same)
       if not os.path.isdir(outdir):
-         os.mkdir(outdir)
+         try:
+            os.mkdir(outdir)
+         except OSError:
+            if not os.path.isdir(outdir):
+               raise
       outFile = os.path.join(outdir, filename)
       filename = os.path.join(indir, filename)
 
+      cards = self.annotationCards(outFile, telemetry)
+
+      if self.annotateMode == 'header':
+         # only rewrite the header blocks and stream the data unit as is
+         sink = None
+         if frame is not None and self.frameRing is not None:
+            def sink(dtype, shape, nbytes):
+               slot = self.frameRing.acquire(nbytes, dtype, shape)
+               if slot is None:
+                  return None
+               frame['handle'] = slot[0]
+               return slot[1]
+         try:
+            header, checksumOk = utrAnnotate.annotateUTR(filename, outFile, cards, sink)
+         except Exception as e:
+            if frame and 'handle' in frame:
+               self.frameRing.release(frame.pop('handle'))
+            if not isinstance(e, (utrAnnotate.AnnotateError, UnicodeDecodeError)):
+               raise
+            self.logger.warn('APOGEEQL -> header-only annotation failed, using pyfits: %s' % (e))
+         else:
+            if frame and 'handle' in frame:
+               frame['header'] = header.tostring()
+               frame['bzero'] = header.get('BZERO', 0)
+               frame['bscale'] = header.get('BSCALE', 1)
+            if checksumOk is False:
+               self.logger.error("CHECKSUM Failed for file %s" % (filename))
+            elif checksumOk:
+               f = open(os.path.join(outdir,Apogeeql.actor.delFile),'a')
+               f.write(filename+'\n')
+               f.close()
+
+            # starttime is MJD in seconds
+            time_string = header.get('DATE-OBS')
+            starttime = Time(time_string,format='isot',scale='utc').mjd * 86400.0
+            exptime = header.get('EXPTIME')
+            return outFile, starttime, exptime
+
+      return self.appendFitsKeywordsPyfits(filename, outFile, outdir, cards)
+
+   def appendFitsKeywordsPyfits(self, filename, outFile, outdir, cards):
+      '''decode the input FITS file with pyfits and write it back with the added cards'''
+
       # Since the Java nom.tam.fits library used by the ICS has an incompatible
       # checksum calculation with pyfits, we're rolling our own here
 
-      # first extract the value of the checksum from the fits header (pyfits.getval removes
-      # any checksum or datasum keywords)
-      f=open(filename,'rb')
-      checksum = None
-      # only read the first 72 lines (which should be the whole header plus padding)
-      for p in range(72):
-          line = f.read(80)
-          if line[0:8] == 'END     ':
-              break
-          if line[0:8] == 'CHECKSUM':
-              checksum = line[11:27]
-              cs_comment = line[33:80]
+      # first extract the raw header (pyfits.getval removes any checksum or datasum keywords)
+      # and sum the data unit once: the same DATASUM validates the ICS CHECKSUM and is
+      # written in the new file (the pixels are not modified)
+      datasum = None
+      checksumOk = None
+      try:
+         f=open(filename,'rb')
+         try:
+            rawHeader, hdrlen = utrAnnotate.readHeader(f)
+         finally:
+            f.close()
+         datasum = fitsChecksum.dataSum(filename, hdrlen, utrAnnotate.dataLength(rawHeader))
+         checksumOk = utrAnnotate.verifyChecksum(rawHeader, datasum)
+      except (utrAnnotate.AnnotateError, UnicodeDecodeError, ValueError, TypeError, IOError) as e:
+         # the files the header-only path gives up on (truncated, odd layout): pyfits sums them
+         self.logger.warn('APOGEEQL -> %s: summing the data with pyfits (%s)' % (filename, e))
 
-      f.close()
       # don't touch the data, which is supposed to be uint16s.
       hdulist = pyfits.open(filename, do_not_scale_image_data=True, uint16=True)
-      if checksum != None:
-          # validate the value of the checksum found (corresponding to DATASUM in pyfits)
-          # calulate the datasum
-          ds = hdulist[0]._calculate_datasum('standard')
-
-          # add a new CHECKSUM line to the header (pyfits.open removes it) with same comment
-          hdulist[0].header.update("CHECKSUM",'0'*16, cs_comment)
-
-          # calulate a new checksum
-          cs=hdulist[0]._calculate_checksum(ds,'standard')
-          if cs != checksum:
-              self.logger.error("CHECKSUM Failed for file %s" % (filename))
-          else:
-              # self.logger.info("CHECKSUM checked ok")
-              f = open(os.path.join(outdir,Apogeeql.actor.delFile),'a')
-              f.write(filename+'\n')
-              f.close()
+
+      if datasum is None:
+         datasum = hdulist[0]._calculate_datasum('standard')
+         checksumOk = self.pyfitsChecksumOk(filename, hdulist, datasum)
+      if checksumOk is False:
+          self.logger.error("CHECKSUM Failed for file %s" % (filename))
+      elif checksumOk:
+          # self.logger.info("CHECKSUM checked ok")
+          f = open(os.path.join(outdir,Apogeeql.actor.delFile),'a')
+          f.write(filename+'\n')
+          f.close()
 
       # force these to be ints:
       # As of August 2013, the ICS writes them both as floats, but the
@@ -848,37 +1469,95 @@ class Apogeeql(actorcore.Actor.Actor):
       hdulist[0].header.update('BSCALE',bscale,after='GCOUNT')
       hdulist[0].header.update('BZERO',bzero,after='BSCALE')
 
-      hdulist[0].header.update('TELESCOP' , 'SDSS 2-5m')
-      hdulist[0].header.update('FILENAME' ,outFile)
-      hdulist[0].header.update('EXPTYPE' ,self.expType)
+      # starttime is MJD in seconds
+      time_string = hdulist[0].header['DATE-OBS']
+      starttime = Time(time_string,format='isot',scale='utc').mjd * 86400.0
+
+      exptime = hdulist[0].header['exptime']
+
+      for name, val, comment in cards:
+          try:
+              hdulist[0].header.update(name, val, comment)
+          except:
+              self.logger.warn('text="failed to add card: %s=%s (%s)"' % (name, val, comment))
+
+      # repair (if possible) any problems with the header (mainly OBSCMNT too long)
+      hdulist.verify('fix')
+
+      # only the new header needs to be summed, the DATASUM is already known
+      hdulist[0].header.update('CHECKSUM', fitsChecksum.ZEROS, 'HDU checksum')
+      hdulist[0].header.update('DATASUM', str(datasum), 'data unit checksum')
+      cs = hdulist[0]._calculate_checksum(datasum, 'standard')
+      hdulist[0].header.update('CHECKSUM', cs, 'HDU checksum')
+      hdulist.writeto(outFile, clobber=True, output_verify='warn', checksum=False)
+      os.chmod(outFile,0o444) # all read only
+      return outFile, starttime, exptime
+
+
+   def pyfitsChecksumOk(self, filename, hdulist, datasum):
+      '''test the ICS CHECKSUM of a file with the pyfits checksum (None if there is none)'''
+      # pyfits.open removes CHECKSUM from the header: read its value from the raw cards
+      f=open(filename,'rb')
+      checksum = None
+      # only read the first 72 lines (which should be the whole header plus padding)
+      for p in range(72):
+          line = f.read(80)
+          if line[0:8] == 'END     ':
+              break
+          if line[0:8] == 'CHECKSUM':
+              checksum = line[11:27]
+              cs_comment = line[33:80]
+      f.close()
+      if checksum is None:
+          return None
+      # add a new CHECKSUM line to the header with the same comment, and calculate the checksum
+      hdulist[0].header.update("CHECKSUM",'0'*16, cs_comment)
+      return hdulist[0]._calculate_checksum(datasum,'standard') == checksum
+
+   def annotationCards(self, outFile, telemetry=None):
+      '''Return the (name, value, comment) cards added to each UTR read'''
+
+      # the snapshot can only be taken on the reactor, workers get it passed along
+      if telemetry is None:
+         version, telemetry = self.cardCache.snapshot()
+      cards = list(telemetry)
+      cards.insert(1, ('FILENAME', outFile, None))
+      return cards
+
+   def telemetryCards(self):
+      '''Build the cards shared by all the UTR reads from the current keyword values'''
+
+      cards=[]
+      cards.append(('TELESCOP', 'SDSS 2-5m', None))
+      cards.append(('EXPTYPE', self.expType, None))
 
       # get the calibration box status
       lampqrtz, lampune, lampthar, lampshtr, lampcntl = self.getCalibBoxStatus()
-      hdulist[0].header.update('LAMPQRTZ',lampqrtz, 'CalBox Quartz Lamp Status')
-      hdulist[0].header.update('LAMPUNE',lampune, 'CalBox UNe Lamp Status')
-      hdulist[0].header.update('LAMPTHAR',lampthar, 'CalBox ThArNe Lamp Status')
-      hdulist[0].header.update('LAMPSHTR',lampshtr, 'CalBox Shutter Lamp Status')
-      hdulist[0].header.update('LAMPCNTL',lampcntl, 'CalBox Controller Status')
+      cards.append(('LAMPQRTZ',lampqrtz, 'CalBox Quartz Lamp Status'))
+      cards.append(('LAMPUNE',lampune, 'CalBox UNe Lamp Status'))
+      cards.append(('LAMPTHAR',lampthar, 'CalBox ThArNe Lamp Status'))
+      cards.append(('LAMPSHTR',lampshtr, 'CalBox Shutter Lamp Status'))
+      cards.append(('LAMPCNTL',lampcntl, 'CalBox Controller Status'))
 
       # add gang connector state
       gangstate,gstate = self.getGangState()
-      hdulist[0].header.update('GANGSTAT',gstate, 'APOGEE Gang Connector State')
+      cards.append(('GANGSTAT',gstate, 'APOGEE Gang Connector State'))
 
       # add shutter information
       # shutterLimitSwitch=False,True   shutter is closed
       # shutterLimitSwitch=True,False   shutter is open
       # Any other combination means there's something wrong with the shutter.
       shutterstate = self.getShutterState()
-      hdulist[0].header.update('SHUTTER',shutterstate, 'APOGEE Shutter State')
+      cards.append(('SHUTTER',shutterstate, 'APOGEE Shutter State'))
 
       # Add FPI information
-      #hdulist[0].header.update('LAMPFPI',lampfpi, 'FPI Lamp shutter status')
+      #cards.append(('LAMPFPI',lampfpi, 'FPI Lamp shutter status'))
 
       """
       # guider i refractionCorrection=1.00000
       refraction = Apogeeql.actor.models['guider'].keyVarDict['refractionCorrection'][0]
       refraction = numpy.nan_to_num(refraction)
-      hdulist[0].header.update('REFRACOR',refraction, 'guider refractionCorrection')
+      cards.append(('REFRACOR',refraction, 'guider refractionCorrection'))
       """
 
       # guider i seeing=2.09945
@@ -892,15 +1571,8 @@ class Apogeeql(actorcore.Actor.Actor):
               seeing=0.0
       except:
           seeing=0.0
-      hdulist[0].header.update('SEEING',seeing, 'RMS seeing from guide fibers')
-
-      # starttime is MJD in seconds
-      time_string = hdulist[0].header['DATE-OBS']
-      starttime = Time(time_string,format='isot',scale='utc').mjd * 86400.0
+      cards.append(('SEEING',seeing, 'RMS seeing from guide fibers'))
 
-      exptime = hdulist[0].header['exptime']
-
-      cards=[]
       cards.extend(actorFits.mcpCards(self.models, cmd=self.bcast))
 
       observatory = os.getenv("OBSERVATORY")
@@ -924,172 +1596,38 @@ class Apogeeql(actorcore.Actor.Actor):
             full_offset = float(default_ax) + float(offset_ax)
          cards.append(('OFF'+name, full_offset, 'Guider offset in '+name))
 
-      for name, val, comment in cards:
-          try:
-              hdulist[0].header.update(name, val, comment)
-          except:
-              self.logger.warn('text="failed to add card: %s=%s (%s)"' % (name, val, comment))
-
-
       # New SDSS-V FPS keywords
       # CARTID (set to FPS-N), DESIGNID, CONFID, and FIELDID.
-      hdulist[0].header.update('CARTID','FPS', 'Using FPS')
-      hdulist[0].header.update('CONFIGID',self.config_id, 'FPS configID')
-      hdulist[0].header.update('DESIGNID',self.design_id, 'DesignID')
-      hdulist[0].header.update('FIELDID',self.field_id, 'FieldID')
-      hdulist[0].header.update('CONFIGFL',self.summary_file, 'config summary file')
-
-      # repair (if possible) any problems with the header (mainly OBSCMNT too long)
-      hdulist.verify('fix')
-      hdulist.writeto(outFile, clobber=True, output_verify='warn', checksum=True)
-      os.chmod(outFile,0o444) # all read only
-      return outFile, starttime, exptime
+      cards.append(('CARTID','FPS', 'Using FPS'))
+      cards.append(('CONFIGID',self.config_id, 'FPS configID'))
+      cards.append(('DESIGNID',self.design_id, 'DesignID'))
+      cards.append(('FIELDID',self.field_id, 'FieldID'))
+      cards.append(('CONFIGFL',self.summary_file, 'config summary file'))
 
-
-   def getPlPlugMapM(self, session, cartridgeId, plateId, pointingName):
-       """Return the plPlugMapM given a plateId and pointingName"""
-
-       try:
-           pm = session.query(PlPlugMapM).join(Plugging,Plate,Cartridge,ActivePlugging).\
-                   filter(Plate.plate_id==plateId).\
-                   filter(Cartridge.number==cartridgeId).\
-                   filter(PlPlugMapM.pointing_name==pointingName).order_by(PlPlugMapM.fscan_mjd.desc()).\
-                   order_by(PlPlugMapM.fscan_id.desc()).one()
-       except sqlalchemy.orm.exc.NoResultFound:
-           raise RuntimeError("NO plugmap from for plate %d" % (plateId))
-       except sqlalchemy.orm.exc.MultipleResultsFound:
-           # raise RuntimeError, ("More than one plugmap from for plate %d" % (plateId))
-           # use thae last entry hoping all is well
-           pm = session.query(PlPlugMapM).join(Plugging,Plate,Cartridge,ActivePlugging).\
-                   filter(Plate.plate_id==plateId).\
-                   filter(Cartridge.number==cartridgeId).\
-                   filter(PlPlugMapM.pointing_name==pointingName).order_by(PlPlugMapM.fscan_mjd.desc()).\
-                   order_by(PlPlugMapM.fscan_id.desc())
-           pm=pm[0]
-
-       return pm
+      return cards
 
    def makeApogeePlugMap(self, plugmap, newfilename, plate):
-       """Return the plPlugMapM given a plateId and pointingName"""
-
-       from sqlalchemy import and_
+       """Write the plPlugMapA file of a plateDb.PlugMap"""
 
-       # replace the \r with \n to get yanny to parse the text properly
-       import re
-       data = re.sub("\r", "\n", plugmap.file)
+       # read the stored plPlugMapM (its lines end with \r) straight into columns
+       p0 = parFile.fromText(plugmap.file)
 
        # append to the standard plPlugMap to add 2mass_style and J, H, Ks mags
-       par = yanny.yanny()
-       par._contents = data
-       par._parse()
-       p0 = par
-
-       # update the definition of PLUGMAPOBJ
-       pos=0
-       for t in p0.tables():
-           if t=='PLUGMAPOBJ':
-               p0['symbols']['struct'][pos] = (p0['symbols']['struct'][pos]).replace('secTarget;','secTarget;\n char tmass_style[30];')
-               break
-           else:
-               pos+=1
-
-       p0['symbols']['PLUGMAPOBJ'].append('tmass_style')
-       p0['PLUGMAPOBJ']['tmass_style']=[]
-       for i in range(p0.size('PLUGMAPOBJ')):
-           p0['PLUGMAPOBJ']['tmass_style'].append('-')
-
-
-       # get the needed information from the plate_hole
-       #ph = self.mysession.query(Fiber).join(PlateHole).\
-       #    filter(Fiber.pl_plugmap_m_pk==plugmap.pk).order_by(Fiber.fiber_id).\
-       #    values('fiber_id','tmass_j','tmass_h','tmass_k','apogee_target1','apogee_target2')
-
-       ph = self.mysession.query(Fiber).join(PlateHole).\
-            filter(Fiber.pl_plugmap_m_pk==plugmap.pk).order_by(Fiber.fiber_id).\
-            with_entities(Fiber.fiber_id, PlateHole.tmass_j, PlateHole.tmass_h,
-                          PlateHole.tmass_k, PlateHole.apogee_target1,
-                          PlateHole.apogee_target2)
-
-       # SDSS-V plates
-       if (plate >= 15000):
-
-           # loop through the list and update the PLUGMAPOBJ
-           tmass_style = 'Unknown'
-           for fid, j_mag, h_mag, k_mag, t1, t2 in ph:
-               count = p0['PLUGMAPOBJ']['fiberId'].count(fid)
-               if count >= 1:
-                   # we have more than one entry for this fiberId -> get the APOGEE
-                   ind = -1
-                   for i in range(count):
-                       pos = p0['PLUGMAPOBJ']['fiberId'][ind+1:].index(fid)
-                       ind = pos+ind+1
-                       if p0['PLUGMAPOBJ']['spectrographId'][ind] == 2:
-                           break
-
-                   # print "fid=%d    t1=%d   t2=%d" % (fid,t1,t2)
-                   # only modify the fibers for APOGEE (2) that are not sky fibers
-                   if p0['PLUGMAPOBJ']['spectrographId'][ind] == 2 and p0['PLUGMAPOBJ']['objType'][ind] != 'SKY':
-                       if not (j_mag and h_mag and k_mag):
-                           #cmd.warn('text="some IR mags are bad: j=%s h=%s k=%s"' % (j_mag, h_mag, k_mag))
-                           logging.warn('text="some IR mags are bad: j=%s h=%s k=%s"' % (j_mag, h_mag, k_mag))
-                       p0['PLUGMAPOBJ']['mag'][ind][0] = j_mag if j_mag else 0.0
-                       p0['PLUGMAPOBJ']['mag'][ind][1] = h_mag if h_mag else 0.0
-                       p0['PLUGMAPOBJ']['mag'][ind][2] = k_mag if k_mag else 0.0
-                       p0['PLUGMAPOBJ']['tmass_style'][ind] = tmass_style
-                       if (p0['PLUGMAPOBJ']['objType'][ind] == 'STAR_BHB'):
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'STAR'
-                       elif (p0['PLUGMAPOBJ']['objType'][ind] == 'SPECTROPHOTO_STD'):
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'HOT_STD'
-
-       # APOGEE-1/2 plates
-       else:
+       obj = p0['PLUGMAPOBJ']
+       obj.addColumn('tmass_style', 'char', [30], ['-']*len(obj), after='secTarget')
 
-           # we'll use the target1 and target2 to define the type of target
-           # these are 32 bits each with each bit indicating a type
-           skymask = 16
-           hotmask = 512
-           extmask = 1024
-           starmask = skymask | hotmask
-
-           # loop through the list and update the PLUGMAPOBJ
-           tmass_style = 'Unknown'
-           for fid, j_mag, h_mag, k_mag, t1, t2 in ph:
-               count = p0['PLUGMAPOBJ']['fiberId'].count(fid)
-               if count >= 1:
-                   # we have more than one entry for this fiberId -> get the APOGEE
-                   ind = -1
-                   for i in range(count):
-                       pos = p0['PLUGMAPOBJ']['fiberId'][ind+1:].index(fid)
-                       ind = pos+ind+1
-                       if p0['PLUGMAPOBJ']['spectrographId'][ind] == 2:
-                           break
-
-                   # print "fid=%d    t1=%d   t2=%d" % (fid,t1,t2)
-                   # only modify the fibers for APOGEE (2) that are not sky fibers
-                   if p0['PLUGMAPOBJ']['spectrographId'][ind] == 2 and p0['PLUGMAPOBJ']['objType'][ind] != 'SKY':
-                       if not (j_mag and h_mag and k_mag):
-                           #cmd.warn('text="some IR mags are bad: j=%s h=%s k=%s"' % (j_mag, h_mag, k_mag))
-                           logging.warn('text="some IR mags are bad: j=%s h=%s k=%s"' % (j_mag, h_mag, k_mag))
-                       p0['PLUGMAPOBJ']['mag'][ind][0] = j_mag if j_mag else 0.0
-                       p0['PLUGMAPOBJ']['mag'][ind][1] = h_mag if h_mag else 0.0
-                       p0['PLUGMAPOBJ']['mag'][ind][2] = k_mag if k_mag else 0.0
-                       p0['PLUGMAPOBJ']['tmass_style'][ind] = tmass_style
-                       if (t2 & skymask) > 0:
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'SKY'
-                       elif (t2 & hotmask) > 0:
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'HOT_STD'
-                       elif (t1 & extmask) > 0:
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'EXTOBJ'
-                       elif (t2 & starmask) == 0 and (t1 & extmask) ==0:
-                           p0['PLUGMAPOBJ']['objType'][ind] = 'STAR'
-
-       # delete file if it already exists
-       if os.path.isfile(newfilename):
-          os.remove(newfilename)
+       # the plate_hole values came with the plugmap (plateDb.PlugMap.fibers)
+       # match the fibers to the APOGEE rows of PLUGMAPOBJ and update them, as arrays
+       plugMap.updateApogeeFibers(obj, plugmap.fibers, plate)
 
+       # written to a temporary file and renamed: replaces any previous file (and its links)
        p0.write(newfilename)
 
-       # write a copy to the archive directory
+       return
+
+   def archivePlugMap(self, filename):
+       """Link a plPlugMapA file in the archive directory of the current MJD"""
+
        # define the current mjd archive directory to store the plPlugMapA file
        mjd = astroMJD.mjdFromPyTuple(time.gmtime())
        fmjd = str(int(mjd + 0.3))
@@ -1097,11 +1635,11 @@ class Apogeeql(actorcore.Actor.Actor):
        if not os.path.isdir(arch_dir):
            os.mkdir(arch_dir, 0o0775)
 
-       res=os.path.split(newfilename)
+       res=os.path.split(filename)
        archivefile = os.path.join(arch_dir,res[1])
-       p0.write(archivefile)
+       fileTransfer.linkFile(filename, archivefile)
 
-       return
+       return archivefile
 
    def getShutterState(self):
        """ Get APOGEE shutter state."""
@@ -1120,8 +1658,7 @@ class Apogeeql(actorcore.Actor.Actor):
        else:
            shutterstate = 'Unknown'
 
-       print('shutterinfo = ',shutterinfo)
-       print('shutterstate = ',shutterstate)
+       Apogeeql.actor.logger.debug('shutterinfo = %s  shutterstate = %s' % (shutterinfo, shutterstate))
 
        return shutterstate
 
@@ -1139,8 +1676,7 @@ class Apogeeql(actorcore.Actor.Actor):
        #      labelHelp=('Unknown', 'Disconnected', 'At Cart', 'Podium?',
        #                 'Podium: dense', 'Podium + FPI', 'Podium dense + FPI'))),
 
-       print('gangstate = ',gangstate)
-       print('gstate = ',gstate)
+       Apogeeql.actor.logger.debug('gangstate = %s  gstate = %s' % (gangstate, gstate))
 
        return gangstate, gstate
 
@@ -1156,41 +1692,161 @@ class Apogeeql(actorcore.Actor.Actor):
 
        return lampqrtz, lampune, lampthar, lampshtr, lampcntl
 
-   def completeUTR(self,filebase=None):
-       """Verifies that all of the UTR files where copied from the ICS"""
+   def missingUTR(self,filebase,nReads=0,manifest=None):
+       """Return the quicklook directory and the UTR files of the ICS that were not copied to it"""
 
        # expecting something like: apRaw-DDDDXXXX
-       # make sure a filebase was passed
-       if not filebase:
-           return
-
        res=filebase.split('-')
        try:
           indir  = os.path.join(self.ics_datadir,res[1][:4])
           mjd = int(res[1][:4])+int(self.startOfSurvey)
           outdir = os.path.join(self.datadir,str(mjd))
        except:
-          raise RuntimeError( "The filename doesn't match expected format (%s)" % (filename))
-
-       lst = glob.glob(os.path.join(indir,filebase+'*.fits'))
-       lst.sort()
-       count=0
-       for infile in lst:
-           # check that the file exists in the outdir
-           outfile = os.path.join(outdir,os.path.basename(infile))
-           if not os.path.exists(outfile):
-               # need to annotate and copy the file
-               count+=1
-               # should we try this or just make a copy without the annotation?
-               newfilename, starttime, exptime = self.appendFitsKeywords(os.path.basename(infile))
-               if not os.path.exists(outfile):
-                   # copy the file if appendFitsKeywords did not work
-                   shutil.copy(infile,outdir)
-
-       if count > 0:
-           self.bcast.warn('text="%s had %d missing UTR"' % (filebase,count))
-           self.logger.info('APOGEEQL -> had %d missing UTR' % (count))
-       return
+          raise RuntimeError( "The filename doesn't match expected format (%s)" % (filebase))
+
+       if manifest is not None and nReads > 0:
+           # only look on disk for the reads that were not annotated as they came in
+           lst = [os.path.join(indir,f) for f in manifest.missing(nReads, indir)]
+       else:
+           # we don't know what was commanded (e.g. the actor was restarted during the exposure)
+           lst = glob.glob(os.path.join(indir,filebase+'*.fits'))
+           lst.sort()
+
+       # check that the file exists in the outdir
+       return outdir, [infile for infile in lst
+                       if not os.path.exists(os.path.join(outdir,os.path.basename(infile)))]
+
+   def recoverUTR(self,infile,outdir,telemetry):
+       """Annotate and copy a UTR file that was missed (runs in a thread)"""
+       try:
+           # should we try this or just make a copy without the annotation?
+           self.appendFitsKeywords(os.path.basename(infile), telemetry)
+       except:
+           self.logger.warn('APOGEEQL -> failed to annotate missing UTR %s' % (infile))
+       if not os.path.exists(os.path.join(outdir,os.path.basename(infile))):
+           # copy the file if appendFitsKeywords did not work
+           fileTransfer.copyFile(infile,outdir,preserve=False)
+       return infile
+
+   def finalizeReconcile(self, job):
+       """finalization stage: find the reads of the exposure that are missing"""
+       d = threads.deferToThread(self.reconcileUTR, job.filebase, job.nReads, job.manifest)
+       d.addCallback(self._reconciled, job)
+       return d
+
+   def reconcileUTR(self, filebase, nReads=0, manifest=None):
+       """(quicklook directory, missing UTR files, whether the exposure has any read) (runs in a thread)"""
+       outdir, missing = self.missingUTR(filebase, nReads, manifest)
+       hasReads = bool(missing) or (manifest is not None and bool(manifest.reads)) or \
+                  bool(glob.glob(os.path.join(outdir, filebase+'-*.fits')))
+       return outdir, missing, hasReads
+
+   def _reconciled(self, result, job):
+       job.outdir, job.missing, hasReads = result
+       if not hasReads:
+           # registered at EXPOSING, but ended (DONE, STOPPED or FAILED) before its first read
+           job.empty = True
+           if job.exp_pk:
+               self.bcast.warn('text="%s ended without any UTR read, its exposure row is deleted"' % (job.filebase))
+               self.exposures.delete(job.exp_pk)
+
+   def finalizeRecover(self, job):
+       """finalization stage: annotate (or copy) all the missing reads in parallel"""
+       if not job.missing:
+           return
+       count = len(job.missing)
+       self.bcast.warn('text="%s had %d missing UTR"' % (job.filebase,count))
+       self.logger.info('APOGEEQL -> had %d missing UTR' % (count))
+       version, telemetry = self.cardCache.snapshot()
+       dl = [threads.deferToThread(self.recoverUTR, infile, job.outdir, telemetry) for infile in job.missing]
+       d = defer.DeferredList(dl, consumeErrors=True)
+       d.addCallback(self._recovered, job)
+       return d
+
+   def _recovered(self, results, job):
+       failed = [f for ok, f in results if not ok]
+       for f in failed:
+           self.logger.error('APOGEEQL -> could not recover a UTR of %s: %s' % (job.filebase, f.getErrorMessage()))
+       if failed:
+           raise RuntimeError('%d of %d missing UTR could not be recovered' % (len(failed), len(results)))
+
+   def finalizeNotify(self, job):
+       """finalization stage: tell quicklook the exposure is done"""
+       # do something for the quickreduction at the end of an exposure
+       #for s in Apogeeql.qlSources:
+       #   s.sendLine('UTR=DONE')
+       #for s in Apogeeql.qrSources:
+       #   s.sendLine('UTR=DONE,%s,%d,%s' % (Apogeeql.frameid, mjd5, Apogeeql.exp_pk))
+       if job.empty:
+           job.notified.callback(None)
+           return
+       # the next exposure's reads wait behind UTRDONE: it does not wait for the exposure row,
+       # its pk (0 until the row is in the opsdb) follows with UTRDONEPK
+       exp_pk = self.exposures.resolve(job.exp_pk)
+       if exp_pk is None or exp_pk < 0:
+           job.notified.callback(('UTRDONE', self, job.frameid, job.mjd5, 0))
+           return self.withExposurePk(job, 'notify',
+                 lambda exp_pk: self.qlSend(('UTRDONEPK', self, job.frameid, job.mjd5, exp_pk)))
+       job.notified.callback(('UTRDONE', self, job.frameid, job.mjd5, exp_pk))
+
+   def finalizeBundle(self, job):
+       """finalization stage: submit the exposure for bundling (the next exposure does not wait for it)"""
+       if job.empty:
+           return
+       return self.withExposurePk(job, 'bundle', lambda exp_pk: self._submitBundle(exp_pk, job))
+
+   def withExposurePk(self, job, stage, send):
+       """call send(exp_pk) with the opsdb pk of the exposure, never with its provisional id
+
+       When the pk takes longer than exposurePkTimeout the stage fails, and send
+       is called later, once the row is in the opsdb.
+       """
+       d = self.exposures.whenResolved(job.exp_pk, self.exposurePkTimeout)
+       d.addCallback(send)
+       d.addErrback(self._pkLate, job, stage, send)
+       return d
+
+   def _pkLate(self, failure, job, stage, send):
+       failure.trap(exposureRecorder.PkTimeout)
+       self.logger.warn('APOGEEQL -> %s: %s, %s done when it is recorded' % (job.filebase, failure.getErrorMessage(), stage))
+       late = self.exposures.whenResolved(job.exp_pk)
+       late.addCallback(send)
+       late.addCallback(lambda result: self.bcast.inform('text="%s: %s done late, with exposure pk %s"' %
+                                                         (job.filebase, stage, self.exposures.resolve(job.exp_pk))))
+       late.addErrback(lambda f: self.bcast.warn('text="%s: %s not done: %s"' % (job.filebase, stage, f.getErrorMessage())))
+       return failure
+
+   def _submitBundle(self, exp_pk, job):
+       d = self.bundlePool.submit(job.frameid, job.mjd5, exp_pk)
+       d.addCallbacks(self._bundled, self._bundleFailed, callbackArgs=(job,), errbackArgs=(job,))
+
+   def _bundled(self, result, job):
+       seconds, chips = result
+       self.bcast.inform('bundleTime=%s,%.1f,%d' % (job.filebase, seconds, len(chips)))
+       # bundling has to keep up with the exposures
+       budget = job.nReads*self.utrReadTime
+       if budget > 0 and seconds > budget:
+          self.bcast.warn('text="bundling %s took %.0f s, longer than a %.0f s exposure"' % (job.filebase, seconds, budget))
+       for chip, replies in chips:
+          for reply in replies:
+             self.logger.info('APOGEEQL -> bundle %s%s: %s' % (job.filebase, '' if chip is None else ' chip '+chip, reply))
+
+   def _bundleFailed(self, failure, job):
+       self.bcast.warn('text="bundling %s failed: %s"' % (job.filebase, failure.getErrorMessage()))
+       self.logger.error('APOGEEQL -> bundling %s failed: %s' % (job.filebase, failure.getErrorMessage()))
+
+   def finalizeStageChanged(self, job):
+       """publish the finalization stage of an exposure"""
+       self.bcast.inform('finalizeState=%s,%s' % (job.filebase, job.stage))
+
+   def finalizeDone(self, job):
+       """publish the time taken by each finalization stage of an exposure"""
+       times = ','.join(['%.2f' % job.times.get(name, 0.0) for name, func in self.finalizer.stages])
+       self.bcast.inform('finalizeState=%s,%s' % (job.filebase, job.stage))
+       self.bcast.inform('finalizeTimes=%s,%s' % (job.filebase, times))
+       self.logger.info('APOGEEQL -> finalized %s in %s s' % (job.filebase, times))
+       for stage, error in job.errors:
+           self.bcast.warn('text="%s: finalization stage %s failed: %s"' % (job.filebase, stage, error))
 
 #
 
@@ -1206,6 +1862,8 @@ def main():
    apogeeql.startBundle()
    reactor.callLater(3, apogeeql.periodicStatus)
    reactor.callLater(30, apogeeql.periodicDisksStatus)
+   if apogeeql.watchDogInterval > 0:
+      reactor.callLater(apogeeql.watchDogInterval, apogeeql.periodicWatchDog)
    signal.signal(signal.SIGTERM, apogeeql.kill_handler)
    signal.signal(signal.SIGINT, apogeeql.kill_handler)
    apogeeql.run()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''Bundling of the exposures in a pool of worker processes.
+
+Each BUNDLE job runs bundleThread.main in a worker process, on a queue that
+holds just that job followed by EXIT, so bundling never takes the GIL of the
+actor away from the annotation of the UTR reads. When chips are given, an
+exposure is split into one job per chip (('BUNDLE', frameid, mjd5, exp_pk,
+chip)) bundled in parallel. The results and errors of the jobs are handed
+back on the reactor.
+
+The workers are forked once, by start(), which must be called before the
+actor starts any thread: a forked thread holding a lock would deadlock the
+child. A job whose worker died never reports back, so every job has a
+timeout after which it is failed.
+'''
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+
+from Queue import Queue, Empty
+
+from twisted.internet import defer, reactor
+
+
+def runJob(message):
+   '''Bundle one message in this (worker) process: (pid, seconds, replies, error)'''
+   start = time.time()
+   replies = []
+   error = None
+   try:
+      from apogee_mountain import bundleThread
+      inQueue = Queue()
+      replyQueue = Queue()
+      inQueue.put(message)
+      inQueue.put('EXIT')
+      bundleThread.main(inQueue, replyQueue)
+      while True:
+         try:
+            replies.append(replyQueue.get_nowait())
+         except Empty:
+            break
+   except Exception:
+      error = traceback.format_exc()
+   return os.getpid(), time.time() - start, replies, error
+
+
+class BundleError(RuntimeError):
+   pass
+
+
+class BundlePool(object):
+   '''Bundle the exposures in nWorkers processes
+
+   submit() returns a Deferred fired on the reactor with (seconds, [(chip,
+   replies)]) once all the jobs of the exposure are done, or failed with a
+   BundleError if any of them failed or took more than jobTimeout seconds (0:
+   no limit). onChange(running, queued) is called on the reactor whenever the
+   number of jobs changes.
+   '''
+
+   def __init__(self, nWorkers=2, chips=(), onChange=None, jobTimeout=1800.0):
+      self.nWorkers = max(1, nWorkers)
+      self.chips = list(chips)
+      self.onChange = onChange
+      self.jobTimeout = jobTimeout
+      self.running = 0
+      self.done = 0
+      self.failed = 0
+      self.lastSeconds = 0.0
+      self._pool = None
+      self._stopped = False
+
+   def start(self):
+      '''Fork the worker processes, before any thread is started; only once'''
+      if self._stopped:
+         raise BundleError('the bundle pool was stopped, its workers are not forked again')
+      if self._pool is None:
+         self._pool = multiprocessing.Pool(self.nWorkers)
+
+   def stop(self):
+      '''Let the workers exit once the jobs already submitted are done'''
+      self._stopped = True
+      if self._pool is not None:
+         self._pool.close()
+         self._pool = None
+
+   def queued(self):
+      '''Number of jobs waiting for a free worker'''
+      return max(0, self.running - self.nWorkers)
+
+   def submit(self, frameid, mjd5, exp_pk):
+      '''Bundle an exposure, one job per chip if chips were given'''
+      if self._pool is None:
+         raise BundleError('no bundle workers (%s)' % ('stopped' if self._stopped else 'not started'))
+      start = time.time()
+      if self.chips:
+         messages = [(chip, ('BUNDLE', frameid, mjd5, exp_pk, chip)) for chip in self.chips]
+      else:
+         messages = [(None, ('BUNDLE', frameid, mjd5, exp_pk))]
+      dl = []
+      for chip, message in messages:
+         d = defer.Deferred()
+         self.running += 1
+         self._pool.apply_async(runJob, (message,),
+                                callback=lambda result, d=d: reactor.callFromThread(self._jobDone, d, result))
+         if self.jobTimeout > 0:
+            call = reactor.callLater(self.jobTimeout, self._timedOut, d, message)
+            d.addBoth(self._cancelTimeout, call)
+         d.addCallback(lambda replies, chip=chip: (chip, replies))
+         dl.append(d)
+      self._changed()
+      d = defer.DeferredList(dl, fireOnOneErrback=False, consumeErrors=True)
+      d.addCallback(self._bundled, frameid, start)
+      return d
+
+   def _timedOut(self, d, message):
+      if d.called:
+         return
+      self.running -= 1
+      self.failed += 1
+      self._changed()
+      logging.error('bundling job %s got no result in %.0f s' % (message, self.jobTimeout))
+      d.errback(BundleError('no result in %.0f s (worker process died?)' % (self.jobTimeout)))
+
+   def _cancelTimeout(self, result, call):
+      if call.active():
+         call.cancel()
+      return result
+
+   def _jobDone(self, d, result):
+      pid, seconds, replies, error = result
+      if d.called:
+         # already failed on its timeout
+         logging.warn('bundling job of process %d done after its timeout' % (pid))
+         return
+      self.running -= 1
+      self._changed()
+      if error is not None:
+         self.failed += 1
+         d.errback(BundleError('bundling failed in process %d: %s' % (pid, error.strip().splitlines()[-1])))
+         logging.error('bundling failed in process %d:\n%s' % (pid, error))
+      else:
+         self.done += 1
+         d.callback(replies)
+
+   def _bundled(self, results, frameid, start):
+      self.lastSeconds = time.time() - start
+      errors = [r.getErrorMessage() for ok, r in results if not ok]
+      if errors:
+         raise BundleError('%d of %d bundling jobs of %s failed: %s' % (len(errors), len(results), frameid, errors[0]))
+      return self.lastSeconds, [r for ok, r in results]
+
+   def _changed(self):
+      if self.onChange is not None:
+         try:
+            self.onChange(self.running, self.queued())
+         except:
+            logging.exception('bundle pool callback failed')
+
+   def keywords(self, prefix):
+      '''The status keywords of the pool'''
+      return ['%sPool=%d,%d,%d,%d,%d,%.1f' % (prefix, self.nWorkers, self.running, self.queued(),
+                                             self.done, self.failed, self.lastSeconds)]
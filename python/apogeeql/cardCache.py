@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''Snapshot of the telemetry FITS cards added to every UTR read.
+
+The cards only change when one of the keywords they are built from changes,
+so they are rebuilt from keyword callbacks (at most once per reactor
+iteration) instead of on every read.
+'''
+
+import logging
+import traceback
+
+from twisted.internet import reactor
+
+
+def watchedKeyVars(models, watched):
+   '''Return the keyVars listed in watched: {actor: [keyword, ...] or None for all of them}
+
+   A keyword the model of its actor doesn't have is skipped (with a warning).
+   '''
+   keyVars = []
+   for actor, names in watched.items():
+      keyVarDict = models[actor].keyVarDict
+      if names is None:
+         names = list(keyVarDict.keys())
+      for name in names:
+         try:
+            keyVars.append(keyVarDict[name])
+         except KeyError:
+            logging.warn('no keyword %s.%s to watch for the telemetry cards' % (actor, name))
+   return keyVars
+
+
+class CardCache(object):
+   '''Versioned list of (name, value, comment) cards, kept current by keyword callbacks'''
+
+   def __init__(self, build, keyVars=()):
+      # build() returns the full list of cards from the current keyword values
+      self.build = build
+      self.version = 0
+      self.builtVersion = -1
+      self.cards = []
+      self._pending = False
+      for keyVar in keyVars:
+         keyVar.addCallback(self.invalidate, callNow=False)
+
+   def invalidate(self, keyVar=None):
+      '''Mark the cards as stale and schedule a single rebuild'''
+      self.version += 1
+      if not self._pending:
+         self._pending = True
+         reactor.callLater(0, self._rebuild)
+
+   def _rebuild(self):
+      self._pending = False
+      if self.builtVersion == self.version:
+         return
+      version = self.version
+      try:
+         self.cards = self.build()
+      except:
+         logging.error('failed to build the telemetry cards')
+         traceback.print_exc()
+      self.builtVersion = version
+
+   def snapshot(self):
+      '''Return (version, cards); the list is shared and must not be modified'''
+      if self.builtVersion != self.version:
+         self._rebuild()
+      return self.builtVersion, self.cards
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+'''APOGEE fibers of the FPS configuration summary (confSummary) files.
+
+The confSummary of a configuration is parsed in a thread as soon as jaeger
+reports it loaded, into a compact columnar table of its APOGEE fibers. Tables
+are kept by configuration_id, the least recently used ones being dropped, and
+are shared by reference: consumers must not modify them.
+'''
+
+import logging
+import threading
+import collections
+
+import numpy
+
+from twisted.internet import defer, threads
+
+from apogeeql import parFile
+
+
+class FiberTable(object):
+   '''Columns (NumPy arrays) of the APOGEE fibers of a configuration'''
+
+   def __init__(self, configId, filename, fiberId, holeId, mag, category, hmag=None):
+      self.configId = configId
+      self.filename = filename
+      self.fiberId = fiberId
+      self.holeId = holeId
+      self.mag = mag
+      self.category = category
+      self.hmag = numpy.full(len(fiberId), numpy.nan) if hmag is None else hmag
+
+   def __len__(self):
+      return len(self.fiberId)
+
+
+def readFiberTable(filename, configId):
+   '''Parse a confSummary file, return the FiberTable of its APOGEE fibers'''
+   fibermap = parFile.read(filename)['FIBERMAP']
+   apogee = numpy.array([str(t).upper() == 'APOGEE' for t in fibermap['fiberType']], dtype=bool)
+   hmag = fibermap.get('h_mag')
+   return FiberTable(configId, filename,
+                     fibermap['fiberId'][apogee],
+                     fibermap['holeId'][apogee],
+                     numpy.asarray(fibermap['mag'], dtype=float)[apogee],
+                     fibermap['category'][apogee],
+                     None if hmag is None else numpy.asarray(hmag, dtype=float)[apogee])
+
+
+class ConfSummaryCache(object):
+   '''FiberTables by configuration_id, at most size of them'''
+
+   def __init__(self, size=8):
+      self.size = size
+      self.tables = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+   def prefetch(self, configId, filename):
+      '''Parse the confSummary of a configuration in a thread; returns a Deferred firing with its table'''
+      table = self._cached(configId, filename)
+      if table is not None:
+         return defer.succeed(table)
+      d = threads.deferToThread(readFiberTable, filename, configId)
+      d.addCallbacks(self._loaded, self._failed, errbackArgs=(configId, filename))
+      return d
+
+   def get(self, configId, filename=None):
+      '''The table of a configuration; if it isn't cached, parse filename now (None without one)'''
+      table = self._cached(configId, filename)
+      if table is None and filename is not None:
+         table = self._loaded(readFiberTable(filename, configId))
+      return table
+
+   def _cached(self, configId, filename):
+      with self.lock:
+         table = self.tables.get(configId)
+         if table is None or (filename is not None and table.filename != filename):
+            return None
+         # most recently used last
+         del self.tables[configId]
+         self.tables[configId] = table
+         return table
+
+   def _loaded(self, table):
+      with self.lock:
+         self.tables.pop(table.configId, None)
+         self.tables[table.configId] = table
+         while len(self.tables) > self.size:
+            self.tables.popitem(last=False)
+      return table
+
+   def _failed(self, failure, configId, filename):
+      logging.error('could not parse the confSummary %s of configuration %s: %s' %
+                    (filename, configId, failure.getErrorMessage()))
+      return failure
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''Write-behind recording of the exposure rows in the operations database.
+
+An exposure gets a provisional (negative) id at once; the row is inserted in
+a thread and retried with backoff while the database is unreachable. Later
+changes to the row are queued behind its insert. Operations not yet done are
+kept in a local journal (one JSON object per line) that is replayed when the
+actor restarts, so no exposure is lost with the database.
+
+Only transient errors (database unreachable, connection lost) are retried.
+An operation the database refuses for good (one of the permanent exception
+types, e.g. an integrity or data error) is moved out of the journal to a
+quarantine file next to it, reported, and the operations behind it go on.
+'''
+
+import os
+import json
+import time
+import logging
+import datetime
+import collections
+
+from twisted.internet import reactor, defer, threads
+
+TIMEFORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class PkTimeout(RuntimeError):
+   '''An exposure was not in the database within the time allowed'''
+   pass
+
+
+class ExposureRejected(RuntimeError):
+   '''The database refused the row of an exposure: it will never have a pk'''
+   pass
+
+
+def _encode(row):
+   out = {}
+   for key, val in row.items():
+      if isinstance(val, datetime.datetime):
+         val = {'datetime': val.strftime(TIMEFORMAT)}
+      out[key] = val
+   return out
+
+
+def _decode(row):
+   out = {}
+   for key, val in row.items():
+      if isinstance(val, dict) and 'datetime' in val:
+         val = datetime.datetime.strptime(val['datetime'], TIMEFORMAT)
+      out[str(key)] = val
+   return out
+
+
+class ExposureRecorder(object):
+   '''Insert exposure rows in the background, handing out provisional ids meanwhile
+
+   insert(row) is called in a thread with a dict of column values and must
+   return the new pk, update(pk, fields) changes some columns of a row and
+   delete(pk) removes it. An exception of one of the permanent types they raise quarantines the
+   operation instead of retrying it. onResolved(localId, pk) is called on the
+   reactor when a provisional id gets its database pk, onRejected(kind, id,
+   data, error) when an operation is quarantined.
+   '''
+
+   def __init__(self, insert, update, journalFile, retryInterval=5.0, maxRetryInterval=300.0, onResolved=None,
+                permanent=(), onRejected=None, delete=None):
+      self.insert = insert
+      self.updateRow = update
+      self.deleteRow = delete
+      self.journalFile = journalFile
+      self.quarantineFile = journalFile + '.rejected'
+      self.permanent = tuple(permanent)
+      self.onRejected = onRejected
+      self.retryInterval = retryInterval
+      self.maxRetryInterval = maxRetryInterval
+      self.onResolved = onResolved
+      # ('insert', localId) -> row, ('update', n) -> (id, fields) and ('delete', n) -> (id, None),
+      # in the order they were queued
+      self.pending = collections.OrderedDict()
+      self.resolved = {}                        # localId -> pk
+      self.rejected = set()                     # localIds whose insert was quarantined
+      self._waiters = {}                        # localId -> [Deferred]
+      self._busy = None                         # key of the operation being done
+      self._nextOp = 0
+      self._delay = retryInterval
+      self._retry = None
+      # provisional ids are negative, and unique across restarts
+      self._nextId = -int(time.time())
+      self._replay()
+
+   def record(self, row):
+      '''Queue a row for insertion, return its provisional id'''
+      localId = self._nextId
+      self._nextId -= 1
+      self.pending[('insert', localId)] = row
+      self._journal({'local': localId, 'row': _encode(row)})
+      self._flush()
+      return localId
+
+   def update(self, expPk, fields):
+      '''Change some columns of a recorded row (given its provisional or database id)'''
+      key = ('insert', expPk)
+      if key in self.pending and key != self._busy:
+         # not inserted yet: insert the updated row instead
+         self.pending[key].update(fields)
+         self._journal({'local': expPk, 'row': _encode(self.pending[key])})
+      else:
+         key = ('update', self._nextOp)
+         self._nextOp += 1
+         self.pending[key] = (expPk, fields)
+         self._journal({'update': key[1], 'local': expPk, 'fields': _encode(fields)})
+      self._flush()
+
+   def delete(self, expPk):
+      '''Remove a recorded row (given its provisional or database id)'''
+      key = ('insert', expPk)
+      if key in self.pending and key != self._busy:
+         # never inserted: forget it, and the updates queued behind it
+         del self.pending[key]
+         self._journal({'local': expPk, 'deleted': True})
+         for other, data in list(self.pending.items()):
+            if other[0] != 'insert' and data[0] == expPk:
+               del self.pending[other]
+               self._journal({'updated': other[1]})
+         for d in self._waiters.pop(expPk, []):
+            d.errback(ExposureRejected('exposure %d was deleted before it was recorded' % (expPk)))
+         if not self.pending:
+            self._compact()
+      else:
+         key = ('delete', self._nextOp)
+         self._nextOp += 1
+         self.pending[key] = (expPk, None)
+         self._journal({'delete': key[1], 'local': expPk})
+      self._flush()
+
+   def resolve(self, expPk):
+      '''The database pk for an id (provisional ids that are not inserted yet are returned as is)'''
+      return self.resolved.get(expPk, expPk)
+
+   def whenResolved(self, expPk, timeout=None):
+      '''Deferred firing with the database pk of an id
+
+      It fails with PkTimeout if the row is not inserted within timeout seconds,
+      and with ExposureRejected if its insert was quarantined.
+      '''
+      pk = self.resolve(expPk)
+      if pk is None or pk >= 0:
+         return defer.succeed(pk)
+      if ('insert', expPk) not in self.pending:
+         return defer.fail(ExposureRejected('exposure %d was not recorded in the database' % (expPk)))
+      d = defer.Deferred()
+      self._waiters.setdefault(expPk, []).append(d)
+      if timeout is not None:
+         call = reactor.callLater(timeout, self._timedOut, expPk, d, timeout)
+         d.addBoth(self._cancelTimeout, call)
+      return d
+
+   def _timedOut(self, localId, d, timeout):
+      if not d.called:
+         self._waiters.get(localId, []).remove(d)
+         d.errback(PkTimeout('exposure %d still not in the database after %.0f s' % (localId, timeout)))
+
+   def _cancelTimeout(self, result, call):
+      if call.active():
+         call.cancel()
+      return result
+
+   def _flush(self):
+      '''Do the pending operations, oldest first, one at a time'''
+      while self._busy is None and self.pending and (self._retry is None or not self._retry.active()):
+         key, data = next(iter(self.pending.items()))
+         if key[0] == 'insert':
+            self._busy = key
+            d = threads.deferToThread(self.insert, data)
+            d.addCallbacks(self._inserted, self._failed, callbackArgs=(key,), errbackArgs=(key,))
+         else:
+            expPk, fields = data
+            pk = self.resolve(expPk)
+            if pk < 0:
+               logging.error('dropping %s %s of unknown exposure %d' % (key[0], fields, expPk))
+               del self.pending[key]
+               self._journal({'updated': key[1]})
+               continue
+            self._busy = key
+            if key[0] == 'delete':
+               d = threads.deferToThread(self.deleteRow, pk)
+            else:
+               d = threads.deferToThread(self.updateRow, pk, fields)
+            d.addCallbacks(self._updated, self._failed, callbackArgs=(key,), errbackArgs=(key,))
+
+   def _done(self, key, entry):
+      self._busy = None
+      self._delay = self.retryInterval
+      del self.pending[key]
+      self._journal(entry)
+      if not self.pending:
+         self._compact()
+
+   def _inserted(self, pk, key):
+      localId = key[1]
+      self.resolved[localId] = pk
+      self._done(key, {'local': localId, 'pk': pk})
+      for d in self._waiters.pop(localId, []):
+         d.callback(pk)
+      if self.onResolved is not None:
+         self.onResolved(localId, pk)
+      self._flush()
+
+   def _updated(self, result, key):
+      self._done(key, {'updated': key[1]})
+      self._flush()
+
+   def _failed(self, failure, key):
+      if self.permanent and failure.check(*self.permanent):
+         self._reject(key, failure.getErrorMessage())
+         self._flush()
+         return
+      self._busy = None
+      logging.error('failed to %s exposure operation %d (%d pending), retrying in %.0f s: %s' %
+                    (key[0], key[1], len(self.pending), self._delay, failure.getErrorMessage()))
+      self._retry = reactor.callLater(self._delay, self._flush)
+      self._delay = min(2*self._delay, self.maxRetryInterval)
+
+   def _reject(self, key, error):
+      '''Move an operation the database refuses for good from the journal to the quarantine file'''
+      data = self.pending[key]
+      if key[0] == 'insert':
+         entry = {'local': key[1], 'row': _encode(data), 'error': error}
+         done = {'local': key[1], 'rejected': True}
+      else:
+         entry = {key[0]: key[1], 'local': data[0], 'fields': data[1] and _encode(data[1]), 'error': error}
+         done = {'updated': key[1]}
+      logging.error('exposure operation %s %d refused by the database, quarantined in %s: %s' %
+                    (key[0], key[1], self.quarantineFile, error))
+      self._write(self.quarantineFile, entry)
+      self._done(key, done)
+      if key[0] == 'insert':
+         self.rejected.add(key[1])
+         for d in self._waiters.pop(key[1], []):
+            d.errback(ExposureRejected('exposure %d refused by the database: %s' % (key[1], error)))
+      if self.onRejected is not None:
+         self.onRejected(key[0], key[1], data, error)
+
+   def _journal(self, entry):
+      self._write(self.journalFile, entry)
+
+   def _write(self, filename, entry):
+      try:
+         f = open(filename, 'a')
+         try:
+            f.write(json.dumps(entry) + '\n')
+         finally:
+            f.close()
+      except (IOError, OSError) as e:
+         logging.error('could not write the exposure journal %s: %s' % (filename, e))
+
+   def _compact(self):
+      '''Everything is in the database: the journal can be emptied'''
+      try:
+         open(self.journalFile, 'w').close()
+      except (IOError, OSError) as e:
+         logging.error('could not reset the exposure journal %s: %s' % (self.journalFile, e))
+
+   def _replay(self):
+      '''Queue again the operations a previous run could not do'''
+      if not os.path.exists(self.journalFile):
+         return
+      ops = collections.OrderedDict()
+      for line in open(self.journalFile):
+         try:
+            entry = json.loads(line)
+         except ValueError:
+            continue
+         if 'row' in entry:
+            # a row updated before its insert keeps its place in the queue
+            ops[('insert', entry['local'])] = _decode(entry['row'])
+         elif 'pk' in entry:
+            ops.pop(('insert', entry['local']), None)
+            self.resolved[entry['local']] = entry['pk']
+         elif 'rejected' in entry or 'deleted' in entry:
+            ops.pop(('insert', entry['local']), None)
+            if 'rejected' in entry:
+               self.rejected.add(entry['local'])
+         elif 'fields' in entry:
+            ops[('update', entry['update'])] = (entry['local'], _decode(entry['fields']))
+         elif 'delete' in entry:
+            ops[('delete', entry['delete'])] = (entry['local'], None)
+         elif 'updated' in entry:
+            ops.pop(('update', entry['updated']), None)
+            ops.pop(('delete', entry['updated']), None)
+      for key, data in ops.items():
+         self.pending[key] = data
+         if key[0] == 'insert':
+            self._nextId = min(self._nextId, key[1] - 1)
+         else:
+            self._nextOp = max(self._nextOp, key[1] + 1)
+      if ops:
+         logging.warn('replaying %d exposure operations from %s' % (len(ops), self.journalFile))
+         reactor.callLater(0, self._flush)
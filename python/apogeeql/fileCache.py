@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''Content-addressed cache of the files the actor generates.
+
+A file is stored once under the SHA-1 of its content and found again from
+the tuple identifying what it was made from, e.g. (plate, fscan_mjd, fscan_id)
+for a plPlugMapA file. Cached files are handed out as hard links, so a plugmap
+that comes back is neither queried nor written again.
+'''
+
+import os
+import json
+import errno
+import hashlib
+import logging
+import tempfile
+
+from apogeeql import fileTransfer
+
+INDEX = 'index.json'
+
+
+def digest(filename):
+   '''SHA-1 of the content of a file'''
+   sha = hashlib.sha1()
+   f = open(filename, 'rb')
+   try:
+      while True:
+         buf = f.read(fileTransfer.CHUNK)
+         if not buf:
+            break
+         sha.update(buf)
+   finally:
+      f.close()
+   return sha.hexdigest()
+
+
+def keyString(key):
+   return '/'.join([str(k) for k in key])
+
+
+class FileCache(object):
+   '''Files of cachedir indexed by a key tuple; the index is kept in cachedir/index.json'''
+
+   def __init__(self, cachedir):
+      self.cachedir = cachedir
+      self.index = {}
+      try:
+         os.makedirs(cachedir)
+      except OSError as e:
+         if e.errno != errno.EEXIST:
+            raise
+      path = os.path.join(cachedir, INDEX)
+      if os.path.exists(path):
+         try:
+            self.index = json.load(open(path))
+         except ValueError:
+            logging.warn('ignoring the corrupted file cache index %s' % (path))
+
+   def path(self, sha):
+      return os.path.join(self.cachedir, sha[:2], sha)
+
+   def get(self, key):
+      '''The cached file for key, or None'''
+      entry = self.index.get(keyString(key))
+      if entry is None:
+         return None
+      filename = self.path(entry['sha1'])
+      if not os.path.exists(filename):
+         return None
+      return filename
+
+   def install(self, key, dst):
+      '''Link the cached file for key to dst; False if it isn't cached'''
+      filename = self.get(key)
+      if filename is None:
+         return False
+      fileTransfer.linkFile(filename, dst)
+      return True
+
+   def put(self, key, filename):
+      '''Add a file under key, return its SHA-1'''
+      sha = digest(filename)
+      cached = self.path(sha)
+      if not os.path.exists(cached):
+         if not os.path.isdir(os.path.dirname(cached)):
+            os.mkdir(os.path.dirname(cached))
+         fileTransfer.linkFile(filename, cached)
+      self.index[keyString(key)] = {'sha1': sha, 'name': os.path.basename(filename)}
+      self._save()
+      return sha
+
+   def _save(self):
+      fd, tmpfile = tempfile.mkstemp(prefix='.'+INDEX, dir=self.cachedir)
+      try:
+         f = os.fdopen(fd, 'w')
+         try:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+         finally:
+            f.close()
+         os.rename(tmpfile, os.path.join(self.cachedir, INDEX))
+      except:
+         if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+         raise
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+'''File copies that stay in the kernel.
+
+A copy is first tried as a reflink (shared extents, on btrfs/xfs), then with
+copy_file_range, then sendfile, and only as a last resort through python
+buffers. Python 2 has neither os.copy_file_range nor os.sendfile: the libc
+functions are then called through ctypes. copyFileAsync runs the copy in the reactor thread pool. linkFile
+makes a hard link instead, when the file will not be modified in place.
+'''
+
+import os
+import errno
+import fcntl
+import shutil
+import ctypes
+import ctypes.util
+import tempfile
+
+from twisted.internet import threads
+
+# number of bytes moved per system call
+CHUNK = 8*1024*1024
+
+# ioctl asking the filesystem to share the extents of another file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+try:
+   _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+except OSError:
+   _libc = None
+
+
+def _libcCall(name, restype, argtypes):
+   '''The libc function name, None if this libc doesn't have it'''
+   func = getattr(_libc, name, None) if _libc is not None else None
+   if func is not None:
+      func.restype = restype
+      func.argtypes = argtypes
+   return func
+
+
+_copy_file_range = _libcCall('copy_file_range', ctypes.c_ssize_t,
+                             [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libcCall('sendfile64', ctypes.c_ssize_t,
+                      [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t])
+
+
+def _checked(n):
+   if n < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+   return n
+
+
+def copyFileRange(infd, outfd, count, offset):
+   '''copy_file_range(2) of count bytes at offset of infd to the position of outfd'''
+   if hasattr(os, 'copy_file_range'):
+      return os.copy_file_range(infd, outfd, count, offset)
+   if _copy_file_range is None:
+      raise OSError(errno.ENOSYS, 'no copy_file_range')
+   return _checked(_copy_file_range(infd, ctypes.byref(ctypes.c_longlong(offset)), outfd, None, count, 0))
+
+
+def sendFile(outfd, infd, offset, count):
+   '''sendfile(2) of count bytes at offset of infd to the position of outfd'''
+   if hasattr(os, 'sendfile'):
+      return os.sendfile(outfd, infd, offset, count)
+   if _sendfile is None:
+      raise OSError(errno.ENOSYS, 'no sendfile')
+   return _checked(_sendfile(outfd, infd, ctypes.byref(ctypes.c_longlong(offset)), count))
+
+
+def reflink(fin, fout):
+   '''Make fout share all the extents of fin; False if the filesystem can't'''
+   try:
+      fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+      return True
+   except (IOError, OSError):
+      return False
+
+
+def copyRange(fin, fout, offset, count):
+   '''Copy count bytes at offset of fin to the current end of fout, return the bytes copied'''
+   infd = fin.fileno()
+   outfd = fout.fileno()
+   done = 0
+   try:
+      while done < count:
+         n = copyFileRange(infd, outfd, min(CHUNK, count-done), offset+done)
+         if n == 0:
+            break
+         done += n
+   except OSError:
+      # cross-device copies are refused on older kernels (or no such call), go on with sendfile
+      pass
+   if done < count:
+      try:
+         while done < count:
+            n = sendFile(outfd, infd, offset+done, min(CHUNK, count-done))
+            if n == 0:
+               break
+            done += n
+      except OSError:
+         pass
+   if done < count:
+      # plain read/write loop
+      fin.seek(offset+done)
+      while done < count:
+         buf = fin.read(min(CHUNK, count-done))
+         if not buf:
+            break
+         fout.write(buf)
+         done += len(buf)
+      fout.flush()
+   return done
+
+
+def copyFile(src, dst, preserve=True):
+   '''Copy src to dst (a file name or a directory), return the destination file name
+
+   The copy is written to a temporary file and renamed, so readers of dst never
+   see a partial file. With preserve the permissions and times are copied too
+   (as shutil.copy2 does).
+   '''
+   if os.path.isdir(dst):
+      dst = os.path.join(dst, os.path.basename(src))
+   fd, tmpfile = tempfile.mkstemp(prefix='.'+os.path.basename(dst), dir=os.path.dirname(dst) or '.')
+   try:
+      fin = open(src, 'rb')
+      try:
+         fout = os.fdopen(fd, 'wb')
+         try:
+            size = os.fstat(fin.fileno()).st_size
+            if not reflink(fin, fout):
+               done = copyRange(fin, fout, 0, size)
+               if done != size:
+                  raise IOError(errno.EIO, 'only %d of %d bytes copied' % (done, size), src)
+         finally:
+            fout.close()
+      finally:
+         fin.close()
+      if preserve:
+         shutil.copystat(src, tmpfile)
+      else:
+         shutil.copymode(src, tmpfile)
+      os.rename(tmpfile, dst)
+   except:
+      if os.path.exists(tmpfile):
+         os.remove(tmpfile)
+      raise
+   return dst
+
+
+def linkFile(src, dst):
+   '''Hard link src to dst (a file name or a directory), replacing dst; copy if it can't be linked
+
+   Returns the destination file name.
+   '''
+   if os.path.isdir(dst):
+      dst = os.path.join(dst, os.path.basename(src))
+   if os.path.exists(dst) and os.path.samefile(src, dst):
+      # already linked (renaming a link over itself would leave the temporary link behind)
+      return dst
+   # the link goes to a name derived from a file mkstemp reserved for us, so no one else uses it
+   fd, reserved = tempfile.mkstemp(prefix='.'+os.path.basename(dst), dir=os.path.dirname(dst) or '.')
+   os.close(fd)
+   tmpfile = reserved + '.link'
+   try:
+      os.link(src, tmpfile)
+   except OSError:
+      # another filesystem, or links not supported
+      return copyFile(src, dst)
+   finally:
+      os.remove(reserved)
+   try:
+      os.rename(tmpfile, dst)
+   except:
+      os.remove(tmpfile)
+      raise
+   return dst
+
+
+def copyFileAsync(src, dst, preserve=True):
+   '''copyFile in a thread; returns a Deferred firing (on the reactor) with the destination'''
+   return threads.deferToThread(copyFile, src, dst, preserve)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''Staged end-of-exposure processing.
+
+Each finished exposure goes through a fixed list of stages (reconcile the
+reads, recover the missing ones, notify quicklook, bundle). A stage is a
+function called on the reactor that does its work in threads and returns a
+Deferred, so the reactor and the reads of the next exposure never wait for
+the cleanup of the previous one. Exposures are finalized one at a time, in
+the order they ended.
+'''
+
+import time
+import logging
+import collections
+
+from twisted.internet import defer
+
+
+class Finalization(object):
+   '''State of one exposure going through the pipeline'''
+
+   def __init__(self, filebase, **kwargs):
+      self.filebase = filebase
+      self.stage = 'queued'
+      self.stageStart = time.time()
+      self.times = collections.OrderedDict()
+      self.errors = []
+      self.__dict__.update(kwargs)
+
+   def elapsed(self):
+      return time.time() - self.stageStart
+
+
+class Pipeline(object):
+   '''Run the stages of each Finalization in order, one exposure after the other
+
+   stages is a list of (name, func); func(job) may return a Deferred, the next
+   stage starts when it fires. A failed stage is logged in job.errors and the
+   following stages still run (the exposure must still get bundled). onStage(job)
+   is called at every stage change and onDone(job) when the last stage is over.
+   '''
+
+   def __init__(self, stages, onStage=None, onDone=None):
+      self.stages = stages
+      self.onStage = onStage
+      self.onDone = onDone
+      self.current = None
+      self.waiting = collections.deque()
+
+   def submit(self, job):
+      '''Queue an exposure for finalization'''
+      self.waiting.append(job)
+      self._notify(self.onStage, job)
+      if self.current is None:
+         self._next()
+
+   def jobs(self):
+      '''The exposure being finalized (if any) followed by the ones waiting'''
+      return ([self.current] if self.current else []) + list(self.waiting)
+
+   def _next(self):
+      if not self.waiting:
+         self.current = None
+         return
+      self.current = self.waiting.popleft()
+      self._runStage(self.current, 0)
+
+   def _runStage(self, job, i):
+      if i == len(self.stages):
+         self._finish(job, 'done')
+         return
+      name, func = self.stages[i]
+      job.stage = name
+      job.stageStart = time.time()
+      self._notify(self.onStage, job)
+      d = defer.maybeDeferred(func, job)
+      d.addCallbacks(self._stageDone, self._stageFailed, callbackArgs=(job, i), errbackArgs=(job, i))
+
+   def _stageDone(self, result, job, i):
+      job.times[job.stage] = job.elapsed()
+      self._runStage(job, i+1)
+
+   def _stageFailed(self, failure, job, i):
+      job.times[job.stage] = job.elapsed()
+      job.errors.append((job.stage, failure.getErrorMessage()))
+      logging.error('finalization of %s failed in stage %s: %s' % (job.filebase, job.stage, failure.getErrorMessage()))
+      failure.printTraceback()
+      self._runStage(job, i+1)
+
+   def _finish(self, job, stage):
+      job.stage = stage
+      job.stageStart = time.time()
+      self._notify(self.onDone, job)
+      self._next()
+
+   def _notify(self, func, job):
+      if func is not None:
+         try:
+            func(job)
+         except:
+            logging.exception('finalization callback failed for %s' % (job.filebase))
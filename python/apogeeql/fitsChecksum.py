@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''FITS CHECKSUM/DATASUM computation over memory-mapped data units.
+
+The data unit of a read is summed once: the same DATASUM is used to check the
+CHECKSUM written by the ICS and to produce the CHECKSUM of the annotated file,
+for which only the new header has to be summed again.
+'''
+
+import numpy
+
+# characters the FITS checksum encoding must avoid (punctuation between 0-9, A-Z, a-z)
+_EXCLUDE = (0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40,
+            0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60)
+
+ZEROS = '0'*16
+
+
+def _fold(total):
+   '''Fold the carries of a wide sum back into 32 bits (ones' complement addition)'''
+   total = int(total)
+   while total >> 32:
+      total = (total & 0xffffffff) + (total >> 32)
+   return total
+
+
+def onesComplementSum(buf, sum32=0):
+   '''Add the big-endian 32 bit words of buf to sum32'''
+   words = numpy.frombuffer(buf, dtype='>u4')
+   return _fold(int(words.sum(dtype=numpy.uint64)) + sum32)
+
+
+def dataSum(filename, offset, count):
+   '''Ones' complement sum (DATASUM) of the count byte data unit at offset of a file
+
+   The data unit is memory-mapped and summed in a single vectorized pass; a
+   uint64 accumulator can't overflow for any data unit that fits in memory.
+   '''
+   if count == 0:
+      return 0
+   words = numpy.memmap(filename, dtype='>u4', mode='r', offset=offset, shape=(count//4,))
+   try:
+      return _fold(words.sum(dtype=numpy.uint64))
+   finally:
+      del words
+
+
+def encode(value):
+   '''ASCII encoding of the complement of a 32 bit sum, as written in CHECKSUM'''
+   value = 0xffffffff - value
+   asc = [0]*16
+   for i in range(4):
+      byte = (value >> (24 - 8*i)) & 0xff
+      ch = [byte // 4 + 0x30]*4
+      ch[0] += byte % 4
+      check = True
+      while check:
+         check = False
+         for j in (0, 2):
+            if ch[j] in _EXCLUDE or ch[j+1] in _EXCLUDE:
+               ch[j] += 1
+               ch[j+1] -= 1
+               check = True
+      for j in range(4):
+         asc[4*j+i] = ch[j]
+   s = ''.join([chr(c) for c in asc])
+   # rotate right by one character
+   return s[-1:] + s[:-1]
+
+
+def checksum(headerText, datasum):
+   '''CHECKSUM value for a padded header (with a zeroed CHECKSUM card) and its DATASUM'''
+   return encode(onesComplementSum(headerText.encode('ascii'), datasum))
+
+
+def verify(headerText, value, datasum):
+   '''True if value is the CHECKSUM of headerText (where it's already zeroed) and datasum'''
+   return checksum(headerText, datasum) == value
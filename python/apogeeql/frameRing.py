@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''Shared-memory ring of the last UTR frames, handed from the annotator to quicklook.
+
+The annotator reads the data unit of a read from disk straight into a free
+slot of the ring (a file in /dev/shm mapped by every process that uses it)
+and writes the annotated file from there. The quicklook message then carries
+a FrameHandle instead of making quicklook decode the file again: frame(handle)
+gives the pixels, in this process or in any other one.
+
+Slots are reference counted in the shared header. The annotator holds one
+reference from acquire() until the message is taken off the quicklook queue
+(or dropped from it), and then releases it: the consumer needs no release.
+A slot is only reused once its count is back to 0, and after the other slots
+(acquire() goes round the ring). The generation number of a slot changes
+every time it is reused, so an outdated handle is detected (StaleFrame)
+rather than read.
+
+As the slot of a taken message can be reused at any time, the module-level
+frame(handle) returns a copy, made with the ring locked. The zero-copy view
+of FrameRing.frame() is only safe while a reference is held (incref/release);
+otherwise check(handle) after using it tells whether the slot was reused
+meanwhile.
+'''
+
+import os
+import mmap
+import fcntl
+import threading
+import contextlib
+
+import numpy
+
+MAGIC = b'APQLRING'
+HEADERLEN = 4096
+# per slot: references, generation, bytes used
+SLOT = numpy.dtype([('refs', '<i8'), ('generation', '<i8'), ('nbytes', '<i8')])
+PAGE = mmap.PAGESIZE
+
+_rings = {}
+_ringsLock = threading.Lock()
+
+
+class StaleFrame(Exception):
+   '''The slot of a handle has been released and reused'''
+   pass
+
+
+class FrameHandle(object):
+   '''Where a frame is: ring file, slot and generation, with its dtype and shape'''
+
+   def __init__(self, path, slot, generation, dtype, shape):
+      self.path = path
+      self.slot = slot
+      self.generation = generation
+      self.dtype = dtype
+      self.shape = tuple(shape)
+
+   def __repr__(self):
+      return 'FrameHandle(%s, %d, %d, %s, %s)' % (self.path, self.slot, self.generation, self.dtype, self.shape)
+
+
+class FrameRing(object):
+   '''nSlots frames in the shared file path, created for frames of slotSize bytes on the first acquire()'''
+
+   def __init__(self, path, nSlots=8):
+      self.path = path
+      self.nSlots = nSlots
+      self.slotSize = None
+      self._fd = None
+      self._map = None
+      self._slots = None
+      self._next = 0
+      self._lock = threading.Lock()
+
+   @classmethod
+   def attach(cls, path):
+      '''The ring in path, as created by another process'''
+      ring = cls(path)
+      ring._open()
+      return ring
+
+   def _create(self, slotSize):
+      slotSize += -slotSize % PAGE
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+      try:
+         os.ftruncate(fd, HEADERLEN + self.nSlots*slotSize)
+         os.write(fd, MAGIC + numpy.array([self.nSlots, slotSize], dtype='<i8').tobytes())
+      except:
+         os.close(fd)
+         raise
+      self._map = mmap.mmap(fd, HEADERLEN + self.nSlots*slotSize)
+      self._fd = fd
+      self.slotSize = slotSize
+      self._slots = numpy.frombuffer(self._map, dtype=SLOT, count=self.nSlots, offset=len(MAGIC)+16)
+
+   def _open(self):
+      fd = os.open(self.path, os.O_RDWR)
+      try:
+         head = os.read(fd, len(MAGIC)+16)
+         if head[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a frame ring' % (self.path))
+         self.nSlots, self.slotSize = [int(v) for v in numpy.frombuffer(head[len(MAGIC):], dtype='<i8')]
+         self._map = mmap.mmap(fd, HEADERLEN + self.nSlots*self.slotSize)
+      except:
+         os.close(fd)
+         raise
+      self._fd = fd
+      self._slots = numpy.frombuffer(self._map, dtype=SLOT, count=self.nSlots, offset=len(MAGIC)+16)
+
+   @contextlib.contextmanager
+   def _locked(self):
+      # the thread lock for the threads of this process, flock for the other processes
+      with self._lock:
+         if self._fd is None:
+            yield
+            return
+         fcntl.flock(self._fd, fcntl.LOCK_EX)
+         try:
+            yield
+         finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+   def _buffer(self, slot, nbytes):
+      offset = HEADERLEN + slot*self.slotSize
+      return numpy.frombuffer(self._map, dtype=numpy.uint8, count=nbytes, offset=offset)
+
+   def acquire(self, nbytes, dtype, shape):
+      '''(handle, writable uint8 array of nbytes) in the next free slot, None if there is none'''
+      with self._locked():
+         if self._map is None:
+            self._create(nbytes)
+            register(self)
+         if nbytes > self.slotSize:
+            return None
+         for i in range(self.nSlots):
+            slot = (self._next + i) % self.nSlots
+            if self._slots['refs'][slot] == 0:
+               self._slots['refs'][slot] = 1
+               self._slots['generation'][slot] += 1
+               self._slots['nbytes'][slot] = nbytes
+               self._next = slot + 1
+               handle = FrameHandle(self.path, slot, int(self._slots['generation'][slot]), numpy.dtype(dtype).str, shape)
+               return handle, self._buffer(slot, nbytes)
+         return None
+
+   def incref(self, handle):
+      '''Take one more reference on the frame (e.g. for a second consumer)'''
+      with self._locked():
+         self._check(handle)
+         self._slots['refs'][handle.slot] += 1
+
+   def release(self, handle):
+      '''Give a reference back; a stale handle is ignored'''
+      with self._locked():
+         if self._slots['generation'][handle.slot] == handle.generation and self._slots['refs'][handle.slot] > 0:
+            self._slots['refs'][handle.slot] -= 1
+
+   def releaseAll(self):
+      '''Drop all the references (when the consumer holding them is gone)'''
+      with self._locked():
+         if self._slots is not None:
+            self._slots['refs'] = 0
+
+   def _check(self, handle):
+      # released frames stay valid until acquire() reuses their slot (and changes its generation)
+      if self._slots['generation'][handle.slot] != handle.generation:
+         raise StaleFrame('slot %d of %s was reused' % (handle.slot, self.path))
+
+   def check(self, handle):
+      '''Raise StaleFrame if the slot of handle was reused (e.g. while a view of it was read)'''
+      with self._locked():
+         self._check(handle)
+
+   def frame(self, handle, copy=False):
+      '''Array of the frame of a handle: a read-only view of the slot, or a copy of it'''
+      dtype = numpy.dtype(handle.dtype)
+      count = int(numpy.prod(handle.shape))
+      with self._locked():
+         self._check(handle)
+         arr = numpy.frombuffer(self._map, dtype=dtype, count=count,
+                                offset=HEADERLEN + handle.slot*self.slotSize).reshape(handle.shape)
+         if copy:
+            # acquire() can't reuse the slot while it is copied
+            return arr.copy()
+      arr.flags.writeable = False
+      return arr
+
+   def used(self):
+      '''Number of slots holding a referenced frame'''
+      with self._locked():
+         return 0 if self._slots is None else int((self._slots['refs'] > 0).sum())
+
+   def close(self):
+      with self._lock:
+         self._slots = None
+         if self._map is not None:
+            try:
+               self._map.close()
+            except BufferError:
+               # frames still viewed: the mapping goes away with them
+               pass
+            self._map = None
+         if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def register(ring):
+   '''Make ring the one frame() and release() use for its path in this process'''
+   with _ringsLock:
+      _rings[ring.path] = ring
+
+
+def ring(path):
+   '''The ring of path in this process, attached on first use'''
+   with _ringsLock:
+      if path not in _rings:
+         _rings[path] = FrameRing.attach(path)
+      return _rings[path]
+
+
+def frame(handle):
+   '''Copy of the frame of a handle (quicklook side: its message released it)'''
+   return ring(handle.path).frame(handle, copy=True)
+
+
+def check(handle):
+   '''Raise StaleFrame if the slot of handle was reused'''
+   ring(handle.path).check(handle)
+
+
+def release(handle):
+   '''Give back the reference of a handle (quicklook side)'''
+   ring(handle.path).release(handle)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''Access to the operations database (opsdb) exposure table.
+
+Nothing connects at import time: the database is created on first use from
+the parameters given to configure(), connections come from a pool and are
+checked before being used, and a database that can't be reached is retried
+with a growing delay. configure(sqlite=path) replaces the server by a local
+SQLite file (tests, offline tools).
+'''
+
+import os
+import time
+import datetime
+import threading
+import contextlib
+
+from peewee import DatabaseProxy, Model, SqliteDatabase, OperationalError, IntegrityError, DataError
+from peewee import AutoField, BigIntegerField, TextField, DateTimeField, FloatField, IntegerField
+
+# first and longest delay between connection attempts to an unreachable database
+MINDELAY = 1.0
+MAXDELAY = 60.0
+
+database = DatabaseProxy()
+
+_params = dict(name='sdss5db', user='sdss', host='sdss5-db', sqlite=None,
+               max_connections=8, stale_timeout=300)
+_lock = threading.Lock()
+_nextAttempt = 0.0
+_delay = MINDELAY
+
+# errors a row gets whatever the state of the database: retrying does not help
+PERMANENT = (IntegrityError, DataError)
+
+
+class Exposure(Model):
+
+    pk = AutoField()
+    configuration_id = BigIntegerField()
+    survey_pk = IntegerField()
+    exposure_no = BigIntegerField()
+    comment = TextField(null=True)
+    start_time = DateTimeField(default=datetime.datetime.now())
+    exposure_time = FloatField()
+    # exposure_status = ForeignKeyField(column_name='exposure_status_pk',
+    #                                   field='pk',
+    #                                   model=ExposureStatus)
+    exposure_flavor_pk = IntegerField()
+
+    class Meta:
+        database = database
+        # schema = 'opsdb'
+        observatory = os.getenv("OBSERVATORY")
+        if observatory == "APO":
+            schema = 'opsdb_apo'
+        else:
+            schema = 'opsdb_lco'
+        table_name = 'exposure'
+
+
+# schema used on the real server (SQLite has none)
+_schema = Exposure._meta.schema
+
+def configure(**kwargs):
+   '''Set the connection parameters (name, user, host, sqlite, max_connections, stale_timeout)'''
+   _params.update(kwargs)
+   if database.obj is not None:
+      # the next use creates the database again with the new parameters
+      if hasattr(database.obj, 'close_all'):
+         database.obj.close_all()
+      else:
+         database.obj.close()
+      database.initialize(None)
+
+
+def _initialize():
+   '''Create the database object the first time it's needed'''
+   with _lock:
+      if database.obj is not None:
+         return database.obj
+      if _params['sqlite']:
+         db = SqliteDatabase(_params['sqlite'], check_same_thread=False)
+         # SQLite has no schemas: the stand-in table lives in the main database
+         Exposure._meta.schema = None
+         database.initialize(db)
+         db.create_tables([Exposure], safe=True)
+      else:
+         from playhouse.pool import PooledPostgresqlDatabase
+         Exposure._meta.schema = _schema
+         db = PooledPostgresqlDatabase(_params['name'], user=_params['user'], host=_params['host'],
+                                       max_connections=_params['max_connections'],
+                                       stale_timeout=_params['stale_timeout'])
+         database.initialize(db)
+      return db
+
+
+def _discard(db):
+   '''Drop the connection of this thread, without putting it back in the pool'''
+   try:
+      if hasattr(db, 'manual_close'):
+         db.manual_close()
+      else:
+         db.close()
+   except Exception:
+      pass
+
+
+def connect():
+   '''Return the database with a checked connection for this thread
+
+   Raises OperationalError without trying while a previous failure's backoff
+   delay hasn't expired.
+   '''
+   global _nextAttempt, _delay
+   db = _initialize()
+   with _lock:
+      wait = _nextAttempt - time.time()
+   if wait > 0:
+      raise OperationalError('database unreachable, next attempt in %.0f s' % (wait))
+
+   # a pooled connection may have been dropped by the server: check it, and try a fresh one once
+   for attempt in range(2):
+      try:
+         db.connect(reuse_if_open=True)
+         db.execute_sql('SELECT 1')
+         break
+      except Exception:
+         _discard(db)
+         if attempt == 1:
+            with _lock:
+               _nextAttempt = time.time() + _delay
+               _delay = min(2*_delay, MAXDELAY)
+            raise
+   with _lock:
+      _delay = MINDELAY
+   return db
+
+
+@contextlib.contextmanager
+def transaction():
+   '''Context manager: a checked connection in a transaction, given back to the pool afterwards'''
+   db = connect()
+   try:
+      with db.atomic():
+         yield db
+   finally:
+      db.close()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''Worker threads whose results are handed back to the reactor in submission order.
+
+Used to annotate the UTR reads without blocking the twisted reactor (and with
+it the hub connection) while still feeding the quicklook in read order.
+'''
+
+import sys
+import logging
+import traceback
+import collections
+
+from Queue import Queue
+from threading import Thread
+
+from twisted.internet import reactor
+
+
+class PoolFull(RuntimeError):
+   '''A job was refused because the backlog was full'''
+   pass
+
+
+class OrderedPool(object):
+   '''Run jobs in worker threads, deliver their results on the reactor in submission order
+
+   At most maxInFlight jobs are handed to the workers; further jobs wait in a
+   backlog on the reactor side, so a slow disk never blocks the reactor and
+   never queues an unbounded amount of work in the threads. The backlog holds
+   at most maxBacklog jobs (0: no limit): a job submitted when it is full is
+   not run, its errback gets a PoolFull in its turn and it is counted in
+   dropped, since blocking would stall the reactor. onChange(running, queued)
+   is called on the reactor whenever these counts change.
+   '''
+
+   def __init__(self, name='pool', nWorkers=2, maxInFlight=8, onChange=None, maxBacklog=0):
+      self.name = name
+      self.maxInFlight = max(1, maxInFlight)
+      self.maxBacklog = maxBacklog
+      self.onChange = onChange
+      self.running = 0
+      self.dropped = 0
+      self._jobs = Queue()
+      self._backlog = collections.deque()
+      self._done = {}
+      self._nextSeq = 0
+      self._nextDeliver = 0
+      self._threads = []
+      for i in range(max(1, nWorkers)):
+         t = Thread(target=self._work, name='%s-%d' % (name, i))
+         t.daemon = True
+         t.start()
+         self._threads.append(t)
+
+   def queued(self):
+      '''Number of jobs waiting for a free worker'''
+      return len(self._backlog)
+
+   def submit(self, func, args=(), callback=None, errback=None):
+      '''Schedule func(*args); callback(result) or errback(excInfo) is called on the reactor
+
+      With func=None nothing is run: callback(None) is called as soon as all the
+      jobs submitted before it have been delivered.
+      '''
+      seq = self._nextSeq
+      self._nextSeq += 1
+      job = (seq, func, args, callback, errback)
+      if func is None:
+         self._done[seq] = (job, True, None)
+         self._deliver()
+         return seq
+      if self.running < self.maxInFlight:
+         self._start(job)
+      elif self.maxBacklog > 0 and len(self._backlog) >= self.maxBacklog:
+         self.dropped += 1
+         try:
+            raise PoolFull('%s: %d jobs already waiting, job %d dropped' % (self.name, len(self._backlog), seq))
+         except PoolFull:
+            self._done[seq] = (job, False, sys.exc_info())
+         self._deliver()
+      else:
+         self._backlog.append(job)
+      self._changed()
+      return seq
+
+   def stop(self):
+      '''Let the workers exit once the jobs already handed to them are done'''
+      for t in self._threads:
+         self._jobs.put(None)
+
+   def _start(self, job):
+      self.running += 1
+      self._jobs.put(job)
+
+   def _work(self):
+      while True:
+         job = self._jobs.get(block=True)
+         if job is None:
+            return
+         seq, func, args, callback, errback = job
+         try:
+            result = func(*args)
+            ok = True
+         except:
+            result = sys.exc_info()
+            ok = False
+         reactor.callFromThread(self._finished, job, ok, result)
+
+   def _finished(self, job, ok, result):
+      self.running -= 1
+      self._done[job[0]] = (job, ok, result)
+      while self._backlog and self.running < self.maxInFlight:
+         self._start(self._backlog.popleft())
+      self._deliver()
+      self._changed()
+
+   def _deliver(self):
+      while self._nextDeliver in self._done:
+         job, ok, result = self._done.pop(self._nextDeliver)
+         self._nextDeliver += 1
+         seq, func, args, callback, errback = job
+         try:
+            if ok:
+               if callback is not None:
+                  callback(result)
+            elif errback is not None:
+               errback(result)
+            else:
+               logging.error('%s: job %d failed' % (self.name, seq))
+               traceback.print_exception(*result)
+         except:
+            logging.error('%s: failed to deliver job %d' % (self.name, seq))
+            traceback.print_exc()
+
+   def _changed(self):
+      if self.onChange is not None:
+         try:
+            self.onChange(self.running, len(self._backlog))
+         except:
+            traceback.print_exc()
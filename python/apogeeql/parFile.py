@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+'''Streaming reader and writer of yanny parameter (.par) files.
+
+The file (or text, with any line ending) is read one line at a time: each
+data row is tokenized once and its values go straight into typed columns,
+which become NumPy arrays when the file is read. Comments, keywords and enum
+definitions are kept as they are; struct definitions and data rows are
+written back from the columns, so a column added with addColumn is written
+directly, without going through the text again.
+'''
+
+import os
+import re
+import tempfile
+import collections
+
+import numpy
+
+INTTYPES = ('short', 'int', 'long')
+FLOATTYPES = ('float', 'double')
+
+# a row token: a quoted string, a brace, or anything else up to a blank
+_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\{)|(\})|([^\s{}"]+)')
+_MEMBER = re.compile(r'(\w+)\s+(\w+)((?:\[\d*\])*)\s*;')
+_TYPEDEF = re.compile(r'typedef\s+(struct|enum)\s*\{(.*)\}\s*(\w+)\s*;', re.DOTALL)
+_NEEDQUOTES = re.compile(r'[\s{}"#]')
+
+LBRACE = object()
+RBRACE = object()
+
+
+class ParError(ValueError):
+   pass
+
+
+def _tokens(line):
+   tokens = []
+   for m in _TOKEN.finditer(line):
+      if m.group(1) is not None:
+         tokens.append(m.group(1).replace('\\"', '"'))
+      elif m.group(2):
+         tokens.append(LBRACE)
+      elif m.group(3):
+         tokens.append(RBRACE)
+      else:
+         tokens.append(m.group(4))
+   return tokens
+
+
+def _quote(value):
+   value = str(value)
+   if value == '' or _NEEDQUOTES.search(value):
+      return '"%s"' % (value.replace('"', '\\"'))
+   return value
+
+
+class Column(object):
+   '''A struct member: C type, name and dimensions (the last one of a char is its length)'''
+
+   def __init__(self, ctype, name, dims):
+      self.ctype = ctype
+      self.name = name
+      self.dims = dims
+
+   def isArray(self):
+      return len(self.dims) > (1 if self.ctype == 'char' else 0)
+
+   def size(self):
+      return self.dims[0] if self.isArray() else 1
+
+   def convert(self, token):
+      if self.ctype in INTTYPES:
+         return int(token)
+      if self.ctype in FLOATTYPES:
+         return float(token)
+      return token
+
+   def format(self, value):
+      if self.ctype in INTTYPES:
+         return str(int(value))
+      if self.ctype in FLOATTYPES:
+         return repr(float(value))
+      if self.ctype == 'char':
+         return _quote(value)
+      return str(value)
+
+   def array(self, values):
+      if self.ctype in INTTYPES:
+         arr = numpy.array(values, dtype=numpy.int64)
+      elif self.ctype in FLOATTYPES:
+         arr = numpy.array(values, dtype=numpy.float64)
+      else:
+         # strings stay str objects
+         arr = numpy.empty((len(values), self.size()) if self.isArray() else len(values), dtype=object)
+         arr[...] = values
+      if not len(values) and self.isArray():
+         arr = arr.reshape(0, self.size())
+      return arr
+
+   def definition(self):
+      return '%s %s%s;' % (self.ctype, self.name, ''.join(['[%s]' % (d if d else '') for d in self.dims]))
+
+
+class ParTable(object):
+   '''The rows of one struct, by column: table[name] is an array with one entry per row'''
+
+   def __init__(self, name, columns):
+      self.name = name
+      self.columns = columns
+      self.data = collections.OrderedDict([(c.name, []) for c in columns])
+
+   def __len__(self):
+      return len(self.data[self.columns[0].name]) if self.columns else 0
+
+   def __getitem__(self, name):
+      return self.data[name]
+
+   def __setitem__(self, name, values):
+      if name not in self.data:
+         raise KeyError(name)
+      self.data[name] = values
+
+   def __contains__(self, name):
+      return name in self.data
+
+   def get(self, name, default=None):
+      return self.data.get(name, default)
+
+   def column(self, name):
+      for col in self.columns:
+         if col.name == name:
+            return col
+      raise KeyError(name)
+
+   def addColumn(self, name, ctype, dims, values, after=None):
+      '''Add a column (written after the column named after, or last)'''
+      if len(values) != len(self):
+         raise ParError('%d values for the %d rows of %s' % (len(values), len(self), self.name))
+      col = Column(ctype, name, list(dims))
+      pos = len(self.columns)
+      if after is not None:
+         pos = self.columns.index(self.column(after)) + 1
+      self.columns.insert(pos, col)
+      self.data[name] = col.array(list(values))
+
+   def addRow(self, tokens, lineno):
+      pos = 0
+      try:
+         for col in self.columns:
+            if col.isArray():
+               if tokens[pos] is LBRACE:
+                  end = tokens.index(RBRACE, pos)
+                  values = tokens[pos+1:end]
+                  pos = end + 1
+               else:
+                  values = tokens[pos:pos+col.size()]
+                  pos += col.size()
+               self.data[col.name].append([col.convert(v) for v in values])
+            else:
+               if tokens[pos] is LBRACE:
+                  # a scalar written as a one-element array
+                  self.data[col.name].append(col.convert(tokens[pos+1]))
+                  pos += 3
+               else:
+                  self.data[col.name].append(col.convert(tokens[pos]))
+                  pos += 1
+      except (IndexError, ValueError) as e:
+         raise ParError('line %d: bad %s row (%s)' % (lineno, self.name, e))
+
+   def finish(self):
+      '''Turn the column lists into arrays'''
+      for col in self.columns:
+         if isinstance(self.data[col.name], list):
+            self.data[col.name] = col.array(self.data[col.name])
+
+   def typedef(self):
+      yield 'typedef struct {'
+      for col in self.columns:
+         yield '   ' + col.definition()
+      yield '} %s;' % (self.name)
+
+   def rows(self):
+      cols = [(col, self.data[col.name]) for col in self.columns]
+      for i in range(len(self)):
+         out = [self.name]
+         for col, values in cols:
+            if col.isArray():
+               out.append('{ ' + ' '.join([col.format(v) for v in values[i]]) + ' }')
+            else:
+               out.append(col.format(values[i]))
+         yield ' '.join(out)
+
+
+class ParFile(object):
+   '''A yanny file: keywords, enums and tables (par['TABLE'] is a ParTable)'''
+
+   def __init__(self):
+      self.keywords = collections.OrderedDict()
+      self.tables = collections.OrderedDict()
+      self.enums = collections.OrderedDict()
+      self.items = []           # what to write, in order: ('raw', line), ('struct', name) or ('rows', name)
+
+   def __getitem__(self, name):
+      table = self.table(name)
+      if table is None:
+         raise KeyError(name)
+      return table
+
+   def table(self, name):
+      for key, table in self.tables.items():
+         if key.upper() == name.upper():
+            return table
+      return None
+
+   def read(self, lines):
+      '''Parse an iterable of lines'''
+      typedef = None
+      cont = ''
+      lineno = 0
+      for line in lines:
+         lineno += 1
+         line = line.rstrip('\r\n')
+         if cont:
+            line = cont + line
+            cont = ''
+         if line.endswith('\\'):
+            cont = line[:-1] + ' '
+            continue
+         if typedef is not None:
+            typedef.append(line)
+            if re.search(r'\}\s*\w+\s*;', line):
+               self._typedef('\n'.join(typedef), lineno)
+               typedef = None
+            continue
+         stripped = line.strip()
+         if not stripped or stripped.startswith('#'):
+            self.items.append(('raw', line))
+            continue
+         if stripped.startswith('typedef'):
+            typedef = [line]
+            if re.search(r'\}\s*\w+\s*;', line):
+               self._typedef(line, lineno)
+               typedef = None
+            continue
+         first = stripped.split(None, 1)
+         table = self.table(first[0])
+         if table is not None:
+            if not len(table):
+               self.items.append(('rows', table.name))
+            table.addRow(_tokens(stripped)[1:], lineno)
+         else:
+            value = first[1].strip() if len(first) > 1 else ''
+            if len(value) > 1 and value[0] == value[-1] == '"':
+               value = value[1:-1]
+            self.keywords[first[0]] = value
+            self.items.append(('raw', line))
+      if typedef is not None:
+         raise ParError('unterminated typedef at the end of the file')
+      for table in self.tables.values():
+         table.finish()
+      return self
+
+   def _typedef(self, text, lineno):
+      m = _TYPEDEF.search(text)
+      if m is None:
+         raise ParError('line %d: bad typedef' % (lineno))
+      kind, body, name = m.groups()
+      if kind == 'enum':
+         self.enums[name] = [v.strip() for v in body.split(',') if v.strip()]
+         self.items.append(('raw', text))
+         return
+      columns = []
+      for ctype, member, dims in _MEMBER.findall(body):
+         columns.append(Column(ctype, member, [int(d) if d else 0 for d in re.findall(r'\[(\d*)\]', dims)]))
+      self.tables[name] = ParTable(name, columns)
+      self.items.append(('struct', name))
+
+   def lines(self):
+      '''The lines of the file (without line ends)'''
+      for kind, value in self.items:
+         if kind == 'raw':
+            yield value
+         elif kind == 'struct':
+            for line in self.tables[value].typedef():
+               yield line
+         else:
+            for line in self.tables[value].rows():
+               yield line
+
+   def write(self, filename):
+      '''Write the file; it is written to a temporary file and renamed, never seen half written'''
+      fd, tmpfile = tempfile.mkstemp(prefix='.'+os.path.basename(filename), dir=os.path.dirname(filename) or '.')
+      try:
+         f = os.fdopen(fd, 'w')
+         try:
+            for line in self.lines():
+               f.write(line + '\n')
+         finally:
+            f.close()
+         os.chmod(tmpfile, 0o644)
+         os.rename(tmpfile, filename)
+      except:
+         if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+         raise
+
+
+def read(filename):
+   '''Parse a yanny file'''
+   f = open(filename, 'r')
+   try:
+      return ParFile().read(f)
+   finally:
+      f.close()
+
+
+def fromText(text):
+   '''Parse yanny text (e.g. a plugmap stored in the database), with any line ends'''
+   return ParFile().read(text.splitlines())
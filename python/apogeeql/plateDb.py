@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''Plugmaps of the plate database (platedb), in one round trip.
+
+The newest plPlugMapM of the active plugging of a plate, and the fiber and
+plate_hole columns makeApogeePlugMap needs, come from a single ordered query:
+the plugmap row first, then one row per fiber. Nothing connects before the
+first plugmap is asked for. A local SQLite file with the same tables can
+stand in for the server (tests, offline tools).
+'''
+
+import threading
+
+import numpy
+import sqlalchemy
+
+# the plugmap text is sent once, in the first row; the fibers follow in fiber_id order
+PLUGMAPQUERY = '''
+WITH pm AS (
+   SELECT m.pk, m.filename, m.fscan_mjd, m.fscan_id, m.plugging_pk, m.file
+   FROM %(s)spl_plugmap_m m
+   JOIN %(s)splugging p ON m.plugging_pk = p.pk
+   JOIN %(s)splate pl ON p.plate_pk = pl.pk
+   JOIN %(s)scartridge c ON p.cartridge_pk = c.pk
+   JOIN %(s)sactive_plugging a ON a.plugging_pk = p.pk
+   WHERE pl.plate_id = :plate AND c.number = :cartridge AND m.pointing_name = :pointing
+   ORDER BY m.fscan_mjd DESC, m.fscan_id DESC
+   LIMIT 1)
+SELECT 0 AS part, pm.pk, pm.filename, pm.fscan_mjd, pm.fscan_id, pm.plugging_pk, pm.file,
+       NULL AS fiber_id, NULL AS tmass_j, NULL AS tmass_h, NULL AS tmass_k,
+       NULL AS apogee_target1, NULL AS apogee_target2
+FROM pm
+UNION ALL
+SELECT 1, pm.pk, NULL, NULL, NULL, NULL, NULL,
+       f.fiber_id, ph.tmass_j, ph.tmass_h, ph.tmass_k, ph.apogee_target1, ph.apogee_target2
+FROM pm
+JOIN %(s)sfiber f ON f.pl_plugmap_m_pk = pm.pk
+JOIN %(s)splate_hole ph ON f.plate_hole_pk = ph.pk
+ORDER BY part, fiber_id
+'''
+
+# the tables (and columns) of the query, for the SQLite stand-in
+STANDIN = [
+   'CREATE TABLE IF NOT EXISTS plate (pk INTEGER PRIMARY KEY, plate_id INTEGER)',
+   'CREATE TABLE IF NOT EXISTS cartridge (pk INTEGER PRIMARY KEY, number INTEGER)',
+   'CREATE TABLE IF NOT EXISTS plugging (pk INTEGER PRIMARY KEY, plate_pk INTEGER, cartridge_pk INTEGER)',
+   'CREATE TABLE IF NOT EXISTS active_plugging (pk INTEGER PRIMARY KEY, plugging_pk INTEGER)',
+   'CREATE TABLE IF NOT EXISTS pl_plugmap_m (pk INTEGER PRIMARY KEY, plugging_pk INTEGER, pointing_name TEXT, '
+   'filename TEXT, fscan_mjd INTEGER, fscan_id INTEGER, file TEXT)',
+   'CREATE TABLE IF NOT EXISTS plate_hole (pk INTEGER PRIMARY KEY, tmass_j REAL, tmass_h REAL, tmass_k REAL, '
+   'apogee_target1 INTEGER, apogee_target2 INTEGER)',
+   'CREATE TABLE IF NOT EXISTS fiber (pk INTEGER PRIMARY KEY, pl_plugmap_m_pk INTEGER, plate_hole_pk INTEGER, '
+   'fiber_id INTEGER)',
+]
+
+
+class PlugMap(object):
+   '''A plPlugMapM row, with the fiber/plate_hole columns as arrays in fibers
+
+   fibers has fiber_id, tmass_j, tmass_h, tmass_k (NaN where NULL) and
+   apogee_target1, apogee_target2 (0 where NULL).
+   '''
+
+   def __init__(self, pk, filename, fscan_mjd, fscan_id, plugging_pk, file, fibers):
+      self.pk = pk
+      self.filename = filename
+      self.fscan_mjd = fscan_mjd
+      self.fscan_id = fscan_id
+      self.plugging_pk = plugging_pk
+      self.file = file
+      self.fibers = fibers
+
+
+def _column(rows, i, dtype, null):
+   return numpy.array([null if r[i] is None else r[i] for r in rows], dtype=dtype)
+
+
+class PlateDb(object):
+   '''Connection to the platedb, made on first use
+
+   url is a SQLAlchemy database URL; with sqlite a local file with the
+   STANDIN tables (created if needed) replaces the server.
+   '''
+
+   def __init__(self, url=None, sqlite=None, schema='platedb'):
+      self.url = url
+      self.sqlite = sqlite
+      self.schema = None if sqlite else schema
+      self._engine = None
+      self._lock = threading.Lock()
+
+   def engine(self):
+      with self._lock:
+         if self._engine is None:
+            if self.sqlite:
+               self._engine = sqlalchemy.create_engine('sqlite:///%s' % (self.sqlite))
+               with self._engine.begin() as conn:
+                  for sql in STANDIN:
+                     conn.execute(sqlalchemy.text(sql))
+            elif self.url:
+               self._engine = sqlalchemy.create_engine(self.url, pool_pre_ping=True)
+            else:
+               raise RuntimeError('no platedb configured (platedbUrl or platedbSqlite)')
+         return self._engine
+
+   def plugMap(self, cartridgeId, plateId, pointingName):
+      '''The newest plugmap of the active plugging of a plate, with its fibers'''
+      sql = PLUGMAPQUERY % {'s': self.schema + '.' if self.schema else ''}
+      with self.engine().connect() as conn:
+         rows = conn.execute(sqlalchemy.text(sql), {'plate': plateId, 'cartridge': cartridgeId,
+                                                    'pointing': pointingName}).fetchall()
+      if not rows:
+         raise RuntimeError("NO plugmap from for plate %d" % (plateId))
+      fibers = rows[1:]
+      return PlugMap(rows[0][1], rows[0][2], rows[0][3], rows[0][4], rows[0][5], rows[0][6],
+                     {'fiber_id': _column(fibers, 7, int, 0),
+                      'tmass_j': _column(fibers, 8, float, numpy.nan),
+                      'tmass_h': _column(fibers, 9, float, numpy.nan),
+                      'tmass_k': _column(fibers, 10, float, numpy.nan),
+                      'apogee_target1': _column(fibers, 11, numpy.int64, 0),
+                      'apogee_target2': _column(fibers, 12, numpy.int64, 0)})
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+'''APOGEE fibers of a plPlugMapM PLUGMAPOBJ table.
+
+The PLUGMAPOBJ columns are loaded once in a NumPy structured array with an
+index from (fiberId, spectrographId) to the row, so the plate_hole values of
+all the fibers are matched and assigned with array operations instead of
+searching the yanny lists fiber by fiber.
+'''
+
+import logging
+
+import numpy
+
+APOGEE = 2
+
+# APOGEE-1/2 targeting bits
+SKYMASK = 16        # apogee_target2
+HOTMASK = 512       # apogee_target2
+EXTMASK = 1024      # apogee_target1
+
+# objType of the SDSS-V plates that quicklook knows under another name
+OBJTYPES = {'STAR_BHB': 'STAR', 'SPECTROPHOTO_STD': 'HOT_STD'}
+
+
+def objTable(plugmapobj):
+   '''The columns of PLUGMAPOBJ needed for the APOGEE fibers, as a structured array'''
+   mag = numpy.array(plugmapobj['mag'], dtype=float)
+   tab = numpy.zeros(len(plugmapobj['fiberId']), dtype=[('fiberId', int), ('spectrographId', int),
+                                                       ('objType', object), ('mag', float, mag.shape[1:])])
+   tab['fiberId'] = plugmapobj['fiberId']
+   tab['spectrographId'] = plugmapobj['spectrographId']
+   tab['objType'] = plugmapobj['objType']
+   tab['mag'] = mag
+   return tab
+
+
+def rowIndex(tab):
+   '''(fiberId, spectrographId) -> first row of tab with these values'''
+   keys = list(zip(tab['fiberId'].tolist(), tab['spectrographId'].tolist()))
+   index = {}
+   for row in range(len(keys)-1, -1, -1):
+      index[keys[row]] = row
+   return index
+
+
+def fiberColumns(fibers):
+   '''Arrays of the plate hole values (NaN for a NULL magnitude)
+
+   fibers is either a dict of columns (as plateDb.PlugMap.fibers, NaN for a
+   NULL magnitude) or (fiber_id, tmass_j, tmass_h, tmass_k, apogee_target1,
+   apogee_target2) rows (None for NULL).
+   '''
+   if not isinstance(fibers, dict):
+      rows = list(fibers)
+      fibers = {'fiber_id': [r[0] for r in rows],
+                'apogee_target1': [r[4] or 0 for r in rows],
+                'apogee_target2': [r[5] or 0 for r in rows]}
+      for i, name in enumerate(['tmass_j', 'tmass_h', 'tmass_k']):
+         fibers[name] = [numpy.nan if r[i+1] is None else r[i+1] for r in rows]
+   fid = numpy.asarray(fibers['fiber_id'], dtype=int)
+   mags = numpy.column_stack([numpy.asarray(fibers[name], dtype=float) for name in ['tmass_j', 'tmass_h', 'tmass_k']])
+   t1 = numpy.asarray(fibers['apogee_target1'], dtype=numpy.int64)
+   t2 = numpy.asarray(fibers['apogee_target2'], dtype=numpy.int64)
+   return fid, mags, t1, t2
+
+
+def updateApogeeFibers(plugmapobj, fibers, plate, tmassStyle='Unknown'):
+   '''Set the 2MASS magnitudes and the objType of the APOGEE fibers of plugmapobj
+
+   fibers gives (fiber_id, tmass_j, tmass_h, tmass_k, apogee_target1,
+   apogee_target2) for the plate holes, as rows or columns (see fiberColumns). Sky fibers are left alone. The PLUGMAPOBJ
+   mag, objType and tmass_style columns (lists or arrays, e.g. of a
+   parFile.ParTable) are replaced by arrays. Returns the number of fibers
+   updated.
+   '''
+   tab = objTable(plugmapobj)
+   index = rowIndex(tab)
+   fid, mags, t1, t2 = fiberColumns(fibers)
+
+   rows = numpy.array([index.get((f, APOGEE), -1) for f in fid.tolist()], dtype=int)
+   use = rows >= 0
+   use[use] = tab['objType'][rows[use]] != 'SKY'
+   rows = rows[use]
+   t1 = t1[use]
+   t2 = t2[use]
+
+   # missing magnitudes (and zeros) of the APOGEE fibers are bad
+   mags = mags[use]
+   good = numpy.isfinite(mags) & (mags != 0)
+   for row in mags[~good.all(axis=1)].tolist():
+      j, h, k = [None if numpy.isnan(m) else m for m in row]
+      logging.warn('text="some IR mags are bad: j=%s h=%s k=%s"' % (j, h, k))
+   mags[~good] = 0.0
+   tab['mag'][rows, :3] = mags
+   tmass = plugmapobj.get('tmass_style')
+   tmass = numpy.array(['-']*len(tab) if tmass is None else tmass, dtype=object)
+   tmass[rows] = tmassStyle
+
+   objType = tab['objType'][rows]
+   if plate >= 15000:
+      # SDSS-V plates
+      for old, new in OBJTYPES.items():
+         objType[objType == old] = new
+   else:
+      # APOGEE-1/2 plates: the type of target comes from the targeting bits
+      sky = (t2 & SKYMASK) > 0
+      hot = (t2 & HOTMASK) > 0
+      ext = (t1 & EXTMASK) > 0
+      objType = numpy.select([sky, hot, ext], ['SKY', 'HOT_STD', 'EXTOBJ'], 'STAR').astype(object)
+   tab['objType'][rows] = [str(t) for t in objType]
+
+   plugmapobj['mag'] = tab['mag']
+   plugmapobj['objType'] = tab['objType']
+   plugmapobj['tmass_style'] = tmass
+   return len(rows)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''Choice of the UTR reads forwarded to quicklook, following its measured lag.
+
+When quicklook keeps up every read is forwarded. When it takes longer than
+the time between reads, or messages wait in its queue, only one read every
+stride is, the stride following the load. The first and last reads of an
+exposure and the milestone reads (every milestone-th read, where quicklook
+does its intermediate reductions) are always forwarded, and the quicklook
+queue never lets a later read supersede them (see keep()).
+'''
+
+import math
+import time
+
+
+class ReadDecimator(object):
+   '''Decide, read by read, which reads of an exposure go to quicklook'''
+
+   def __init__(self, milestone=6, maxStride=6, readTime=10.6, headroom=1.25):
+      self.milestone = milestone
+      self.maxStride = maxStride
+      self.readTime = readTime
+      self.headroom = headroom
+      self.exposure = None
+      self.lastForwarded = 0
+      self.lastRead = None
+      self.readInterval = readTime
+
+   def stride(self, serviceTime, lag):
+      '''One read forwarded out of stride, for quicklook taking serviceTime per read and lag seconds behind'''
+      interval = max(self.readInterval, 1e-3)
+      stride = int(math.ceil(self.headroom*serviceTime/interval))
+      if lag > interval:
+         # catch up with a backlog: skip as many reads as quicklook is behind
+         stride = max(stride, int(math.ceil(lag/interval)) + 1)
+      return min(max(stride, 1), self.maxStride)
+
+   def always(self, readnum, nReads):
+      '''True for the reads that are always forwarded: first, last and milestones'''
+      return (readnum <= 1 or readnum >= nReads or
+              (self.milestone > 0 and readnum % self.milestone == 0))
+
+   def keep(self, message):
+      '''True for a ('UTR', actor, filename, exp_pk, readnum, nReads, ...) message of such a read'''
+      try:
+         return self.always(int(message[4]), int(message[5]))
+      except (IndexError, TypeError, ValueError):
+         return False
+
+   def decide(self, exposure, readnum, nReads, serviceTime, lag, now=None):
+      '''Return (forward, stride) for read readnum (of nReads commanded) of exposure'''
+      if now is None:
+         now = time.time()
+      if exposure != self.exposure:
+         self.exposure = exposure
+         self.lastForwarded = 0
+      elif self.lastRead is not None and now > self.lastRead:
+         # time between reads, from the reads themselves
+         self.readInterval += 0.3*(now - self.lastRead - self.readInterval)
+      self.lastRead = now
+
+      stride = self.stride(serviceTime, lag)
+      forward = self.always(readnum, nReads) or readnum - self.lastForwarded >= stride
+      if forward:
+         self.lastForwarded = readnum
+      return forward, stride
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''Record of the UTR reads of an exposure that have already been annotated.
+
+At the end of an exposure only the reads missing from the manifest have to be
+looked for on the (network mounted) ICS disk, instead of globbing the whole
+day directory.
+'''
+
+import os
+
+
+class ReadManifest(object):
+   '''Read numbers of one exposure (apRaw-DDDDXXXX) copied to the quicklook directory'''
+
+   def __init__(self, filebase):
+      self.filebase = filebase
+      self.reads = set()
+
+   def add(self, readnum):
+      self.reads.add(readnum)
+
+   def lastRead(self):
+      return max(self.reads) if self.reads else 0
+
+   def readFile(self, readnum):
+      '''File name of a read, as written by the ICS'''
+      return '%s-%03d.fits' % (self.filebase, readnum)
+
+   def missing(self, nReads, indir):
+      '''File names of the reads (up to nReads) that exist in indir but weren't annotated
+
+      Only the missing reads are checked on disk. Past the last annotated read
+      the ICS writes reads in order, so the first absent one ends the search
+      (an exposure that was stopped early).
+      '''
+      lastRead = self.lastRead()
+      lst = []
+      for readnum in range(1, nReads+1):
+         if readnum in self.reads:
+            continue
+         filename = self.readFile(readnum)
+         if os.path.exists(os.path.join(indir, filename)):
+            lst.append(filename)
+         elif readnum > lastRead:
+            break
+      return lst
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+'''Detector health statistics of a UTR read, cheap enough for every read.
+
+Each chip (a, b, c: column blocks of the read) is sampled every stride rows
+and columns. The median, a robust sigma (half the 15.87-84.13 percentile
+range, which is sigma for Gaussian noise) and the number of pixels above a
+threshold come from that sample, the count scaled back to the whole chip.
+Integer pixels are never sorted: their percentiles are read from the
+cumulative histogram of the sample, in one pass.
+'''
+
+import numpy
+
+# the percentiles of the median and of +/- 1 sigma
+PERCENTILES = [15.87, 50.0, 84.13]
+
+
+def percentiles(sample):
+   '''PERCENTILES of an array, as stored'''
+   if sample.dtype.kind in 'iu':
+      sample = sample.astype(numpy.int64).ravel()
+      lo = sample.min()
+      counts = numpy.cumsum(numpy.bincount(sample - lo))
+      return numpy.searchsorted(counts, numpy.array(PERCENTILES)/100.0*counts[-1]) + lo
+   return numpy.percentile(sample, PERCENTILES)
+
+
+def chipStats(data, bzero=0, bscale=1, nChips=3, stride=8, threshold=60000.0):
+   '''[(median, robust sigma, pixels above threshold)] of each chip of a read (data as stored), in DN'''
+   stats = []
+   # the threshold on the stored values (BSCALE is positive)
+   raw = (threshold - bzero)/float(bscale)
+   for block in numpy.array_split(data, nChips, axis=-1):
+      sample = block[::stride, ::stride]
+      if sample.size == 0:
+         stats.append((0.0, 0.0, 0))
+         continue
+      lo, med, hi = [float(p)*bscale + bzero for p in percentiles(sample)]
+      above = int(numpy.count_nonzero(sample > raw)) * block.size // sample.size
+      stats.append((med, (hi - lo)/2.0, above))
+   return stats
+
+
+def keyword(filebase, readnum, stats):
+   '''utrStats=filebase,read,median,sigma,above of each chip'''
+   values = ','.join(['%.1f,%.2f,%d' % s for s in stats])
+   return 'utrStats=%s,%d,%s' % (filebase, readnum, values)
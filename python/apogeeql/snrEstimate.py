@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''Quick S/N of the fibers from the CDS summary of an exposure.
+
+The first image of the summary file is memory-mapped, and every APOGEE fiber
+of the configuration is summed over a fixed window of rows around its trace
+(the traces are taken as straight rows, first + (fiberId-1)*spacing). The S/N
+of each fiber is the median over the columns of one chip of flux / noise,
+with the photon noise of the flux and the CDS read noise of the window. A
+straight line fit of log10(S/N) against H magnitude over the science fibers
+gives the S/N at a reference magnitude, the number the observers look at.
+'''
+
+import numpy
+
+from apogeeql import utrAnnotate
+
+
+class SNRError(RuntimeError):
+   pass
+
+
+def firstImage(filename):
+   '''(data memory-mapped as stored, BZERO, BSCALE) of the first HDU of a FITS file with data'''
+   offset = 0
+   f = open(filename, 'rb')
+   try:
+      while True:
+         f.seek(offset)
+         header, hdrlen = utrAnnotate.readHeader(f)
+         if header.get('NAXIS', 0) > 0:
+            break
+         offset += hdrlen + utrAnnotate.dataLength(header)
+   finally:
+      f.close()
+   dtype, shape = utrAnnotate.dataLayout(header)
+   data = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset+hdrlen, shape=shape)
+   return data, header.get('BZERO', 0), header.get('BSCALE', 1)
+
+
+class TraceModel(object):
+   '''Fixed trace windows: fiber f is centered on row first + (f-1)*spacing, halfWidth rows each side'''
+
+   def __init__(self, first=2040.0, spacing=-6.8, halfWidth=2, chip=1, nChips=3):
+      self.first = first
+      self.spacing = spacing
+      self.halfWidth = halfWidth
+      self.chip = chip
+      self.nChips = nChips
+
+   def rows(self, fiberId, nrows):
+      '''(fibers, window) array of the rows of each fiber'''
+      centers = numpy.rint(self.first + (numpy.asarray(fiberId, dtype=float) - 1)*self.spacing).astype(int)
+      rows = centers[:, None] + numpy.arange(-self.halfWidth, self.halfWidth+1)[None, :]
+      return numpy.clip(rows, 0, nrows-1)
+
+   def columns(self, ncols):
+      '''The columns used: the middle half of the chip, away from its edges'''
+      width = ncols // self.nChips
+      start = self.chip*width
+      return slice(start + width//4, start + width - width//4)
+
+
+def fiberSNR(data, fiberId, traces, bzero=0, bscale=1, gain=1.9, readNoise=10.0):
+   '''S/N of each fiber (NaN for a fiber with no flux)'''
+   if data.ndim == 3:
+      # a cube of CDS images: the last one
+      data = data[-1]
+   rows = traces.rows(fiberId, data.shape[0])
+   cols = traces.columns(data.shape[1])
+   window = numpy.asarray(data[:, cols], dtype=numpy.float64)[rows]     # (fibers, window, columns)
+   if bscale != 1:
+      window *= bscale
+   if bzero:
+      window += bzero
+   flux = window.sum(axis=1)
+   npix = rows.shape[1]
+   noise = numpy.sqrt(numpy.maximum(flux, 0.0)/gain + npix*2.0*readNoise**2)
+   snr = numpy.median(flux/noise, axis=1)
+   snr[snr <= 0] = numpy.nan
+   return snr
+
+
+def fitSNR(snr, hmag, use, refMag=11.0):
+   '''(fibers fitted, S/N at refMag, slope, intercept) of log10(S/N) = intercept + slope*H'''
+   good = use & numpy.isfinite(snr) & numpy.isfinite(hmag) & (hmag > 0) & (hmag < 25)
+   if good.sum() < 2:
+      raise SNRError('%d fibers with a S/N and an H magnitude' % (good.sum()))
+   slope, intercept = numpy.polyfit(hmag[good], numpy.log10(snr[good]), 1)
+   return int(good.sum()), float(10**(intercept + slope*refMag)), float(slope), float(intercept)
+
+
+def estimate(filename, fibers, traces, gain=1.9, readNoise=10.0, refMag=11.0):
+   '''(fibers fitted, S/N at refMag, slope, intercept, median S/N) of a summary file and confSummary.FiberTable'''
+   data, bzero, bscale = firstImage(filename)
+   snr = fiberSNR(data, fibers.fiberId, traces, bzero, bscale, gain, readNoise)
+   science = numpy.array([str(c).lower().startswith('science') for c in fibers.category], dtype=bool)
+   n, snrRef, slope, intercept = fitSNR(snr, fibers.hmag, science, refMag)
+   return n, snrRef, slope, intercept, float(numpy.nanmedian(snr[science]))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+'''Header-only annotation of the UTR reads written by the ICS.
+
+The pixel data of a UTR read is never decoded: the primary header is parsed
+from its raw 2880 byte blocks, the new cards are merged in, and the data unit
+is streamed unchanged from the ICS file into the new file.
+'''
+
+import os
+import logging
+import datetime
+import numbers
+import tempfile
+
+import numpy
+
+from apogeeql import fileTransfer, fitsChecksum
+
+BLOCKLEN = 2880
+CARDLEN = 80
+ENDCARD = 'END' + ' '*77
+
+
+class AnnotateError(Exception):
+   '''Raised when a file can't be annotated without touching the data'''
+   pass
+
+
+def parseValue(card):
+   '''Return the python value of a fixed-format header card (None if undefined)'''
+   if card[8:10] != '= ':
+      return None
+   val = card[10:].strip()
+   if val.startswith("'"):
+      # string value, with '' standing for a single quote
+      out = []
+      i = 1
+      while i < len(val):
+         if val[i] == "'":
+            if val[i+1:i+2] == "'":
+               out.append("'")
+               i += 2
+               continue
+            break
+         out.append(val[i])
+         i += 1
+      return ''.join(out).rstrip()
+
+   val = val.split('/')[0].strip()
+   if val == '':
+      return None
+   if val == 'T':
+      return True
+   if val == 'F':
+      return False
+   try:
+      return int(val)
+   except ValueError:
+      pass
+   try:
+      return float(val.replace('D', 'E'))
+   except ValueError:
+      return val
+
+
+def formatValue(value):
+   '''Format a value the way pyfits writes it in a fixed-format card'''
+   if value is None:
+      return ' '*20
+   if isinstance(value, (bool, numpy.bool_)):
+      return '%20s' % ('T' if value else 'F')
+   if isinstance(value, numbers.Integral):
+      return '%20d' % value
+   if isinstance(value, numbers.Real):
+      if value != value or value in (float('inf'), float('-inf')):
+         raise ValueError('non-finite value %r can not be written to a FITS card' % value)
+      s = '%.16G' % value
+      if '.' not in s and 'E' not in s:
+         s += '.0'
+      elif '.' not in s:
+         s = s.replace('E', '.0E')
+      return '%20s' % s
+   s = "'%-8s'" % str(value).replace("'", "''")
+   if len(s) > 70:
+      # too long for a single card, this is what verify('fix') used to do for OBSCMNT
+      s = s[:69] + "'"
+   return '%-20s' % s
+
+
+def formatCard(key, value, comment=None):
+   '''Return the 80 character card for key = value / comment'''
+   card = '%-8s= %s' % (key.upper()[:8], formatValue(value))
+   if comment:
+      card += ' / ' + str(comment)
+   return ('%-80s' % card)[:CARDLEN]
+
+
+class Header(object):
+   '''A primary header held as the list of its raw cards'''
+
+   def __init__(self, cards):
+      self.cards = list(cards)
+
+   def keys(self):
+      return [c[:8].rstrip() for c in self.cards]
+
+   def index(self, key):
+      key = key.upper()
+      for i, c in enumerate(self.cards):
+         if c[:8].rstrip() == key:
+            return i
+      return -1
+
+   def __contains__(self, key):
+      return self.index(key) >= 0
+
+   def get(self, key, default=None):
+      i = self.index(key)
+      if i < 0:
+         return default
+      val = parseValue(self.cards[i])
+      return default if val is None else val
+
+   def set(self, key, value, comment=None, after=None):
+      '''Replace the card in place or, when new, append it (or insert it after another key)'''
+      card = formatCard(key, value, comment)
+      i = self.index(key)
+      if i >= 0:
+         self.cards[i] = card
+         return
+      pos = self.index(after) if after else -1
+      if pos >= 0:
+         self.cards.insert(pos+1, card)
+      else:
+         self.cards.append(card)
+
+   def remove(self, key):
+      key = key.upper()
+      self.cards = [c for c in self.cards if c[:8].rstrip() != key]
+
+   def tostring(self):
+      '''Return the header padded to a whole number of blocks'''
+      s = ''.join(self.cards) + ENDCARD
+      return s + ' '*(-len(s) % BLOCKLEN)
+
+
+def readHeader(f):
+   '''Read the primary header from an open file, return (Header, header length in bytes)'''
+   cards = []
+   nbytes = 0
+   while True:
+      block = f.read(BLOCKLEN)
+      if len(block) < BLOCKLEN:
+         raise AnnotateError('truncated header in %s' % getattr(f, 'name', '?'))
+      nbytes += BLOCKLEN
+      try:
+         block = block.decode('ascii')
+      except UnicodeDecodeError as e:
+         # not a valid FITS header: leave it to pyfits
+         raise AnnotateError('non-ASCII header in %s: %s' % (getattr(f, 'name', '?'), e))
+      for p in range(0, BLOCKLEN, CARDLEN):
+         card = block[p:p+CARDLEN]
+         if card[:8] == 'END     ':
+            return Header(cards), nbytes
+         cards.append(card)
+
+
+def dataLength(header):
+   '''Length of the (padded) primary data unit described by the header'''
+   naxis = header.get('NAXIS', 0)
+   if naxis == 0:
+      return 0
+   size = abs(header.get('BITPIX')) // 8
+   for i in range(1, naxis+1):
+      size *= header.get('NAXIS%d' % i)
+   return size + (-size % BLOCKLEN)
+
+
+def dataLayout(header):
+   '''(dtype, shape) of the primary data unit, as stored (big-endian, before BSCALE/BZERO)'''
+   bitpix = header.get('BITPIX')
+   kinds = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+   if bitpix not in kinds:
+      raise AnnotateError('unknown BITPIX %s' % (bitpix))
+   shape = [header.get('NAXIS%d' % i) for i in range(header.get('NAXIS', 0), 0, -1)]
+   return numpy.dtype(kinds[bitpix]), tuple(shape)
+
+
+def readInto(f, buf):
+   '''Fill the writable array buf from the current position of f'''
+   view = memoryview(buf)
+   done = 0
+   while done < len(buf):
+      n = f.readinto(view[done:])
+      if not n:
+         break
+      done += n
+   return done
+
+
+def verifyChecksum(header, datasum):
+   '''True if the CHECKSUM card of the ICS header matches datasum, None if there is none'''
+   i = header.index('CHECKSUM')
+   if i < 0:
+      return None
+   value = header.cards[i][11:27]
+   test = Header(header.cards)
+   test.cards[i] = test.cards[i][:11] + fitsChecksum.ZEROS + test.cards[i][27:]
+   return fitsChecksum.verify(test.tostring(), value, datasum)
+
+
+def annotateUTR(infile, outfile, cards, sink=None):
+   '''Write outfile as infile plus the (key, value, comment) cards, copying the data unit as is
+
+   Returns (header, checksumOk) where checksumOk is the result of the ICS checksum test
+   (None if the ICS didn't write one). Raises AnnotateError when the file can't be
+   handled without decoding its pixels, in which case nothing is written.
+
+   With sink, sink(dtype, shape, nbytes) may return a writable uint8 array of
+   nbytes (e.g. a frameRing slot): the data unit is then read into it once,
+   summed and written from there, and left in it for quicklook.
+   '''
+   fin = open(infile, 'rb')
+   try:
+      header, hdrlen = readHeader(fin)
+      if header.get('SIMPLE') is not True:
+         raise AnnotateError('%s is not a standard FITS file' % infile)
+
+      # BSCALE and BZERO have to be rewritten as integers: only allowed if that
+      # doesn't change the meaning of the (untouched) stored pixels
+      bscale = header.get('BSCALE', 1)
+      bzero = header.get('BZERO', 32768)
+      if int(bscale) != bscale or int(bzero) != bzero:
+         raise AnnotateError('non integer BSCALE/BZERO in %s' % infile)
+
+      datalen = dataLength(header)
+      fsize = os.fstat(fin.fileno()).st_size
+      if fsize < hdrlen + datalen:
+         raise AnnotateError('%s is truncated (%d < %d bytes)' % (infile, fsize, hdrlen+datalen))
+
+      buf = None
+      if sink is not None and datalen > 0:
+         dtype, shape = dataLayout(header)
+         buf = sink(dtype, shape, datalen)
+      if buf is not None:
+         # the only read of the pixels: into the buffer, written out from there
+         fin.seek(hdrlen)
+         if readInto(fin, buf) != datalen:
+            raise AnnotateError('could not read the %d data bytes of %s' % (datalen, infile))
+         datasum = fitsChecksum.onesComplementSum(buf)
+      else:
+         # the only pass over the pixels: used both for the ICS check and the new CHECKSUM
+         datasum = fitsChecksum.dataSum(infile, hdrlen, datalen)
+      checksumOk = verifyChecksum(header, datasum)
+
+      header.remove('BSCALE')
+      header.remove('BZERO')
+      header.set('BSCALE', int(bscale), after='GCOUNT')
+      header.set('BZERO', int(bzero), after='BSCALE')
+      for name, val, comment in cards:
+         try:
+            header.set(name, val, comment)
+         except ValueError:
+            logging.warn('text="failed to add card: %s=%s (%s)"' % (name, val, comment))
+
+      now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+      header.remove('CHECKSUM')
+      header.remove('DATASUM')
+      header.set('CHECKSUM', fitsChecksum.ZEROS, 'HDU checksum updated %s' % now)
+      header.set('DATASUM', str(datasum), 'data unit checksum updated %s' % now)
+      header.set('CHECKSUM', fitsChecksum.checksum(header.tostring(), datasum),
+                 'HDU checksum updated %s' % now)
+
+      # write to a temporary file next to the output, so nobody sees a partial file
+      outdir = os.path.dirname(outfile)
+      fd, tmpfile = tempfile.mkstemp(prefix='.'+os.path.basename(outfile), dir=outdir)
+      try:
+         fout = os.fdopen(fd, 'wb')
+         try:
+            fout.write(header.tostring().encode('ascii'))
+            fout.flush()
+            if buf is not None:
+               fout.write(memoryview(buf))
+               done = datalen
+            else:
+               done = fileTransfer.copyRange(fin, fout, hdrlen, datalen)
+            if done != datalen:
+               raise AnnotateError('only %d of %d data bytes copied from %s' % (done, datalen, infile))
+         finally:
+            fout.close()
+         if os.path.getsize(tmpfile) != len(header.tostring()) + datalen:
+            raise AnnotateError('wrong size for annotated copy of %s' % infile)
+         os.chmod(tmpfile, 0o444)
+         os.rename(tmpfile, outfile)
+      except:
+         if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+         raise
+   finally:
+      fin.close()
+
+   return header, checksumOk
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+'''Running up-the-ramp fit of the exposures, updated read by read.
+
+Every annotated read is added to per-pixel running sums (sum y, sum ty) of
+its exposure, with t the read number counted from the first read, so the
+least-squares slope of every pixel (DN per read) and the mask of the
+saturated pixels are available at any read for O(pixels) work, instead of
+refitting all the reads so far. The ramps only go up: a pixel leaves the fit
+at the first read at or above the saturation level, and that read number is
+all that is kept per pixel. Its number of reads, sum t and sum t^2 follow
+from it and from the list of the reads of the exposure fitted so far, so they
+are not stored. The sums are float32; with t counted from the first read
+their rounding changes the slope by less than 0.01 DN per read.
+
+The reads are also checked for jumps (cosmic rays): the difference per read
+of every pixel since the previous read is compared with the running mean of
+its differences so far, and flagged when it is above it by more than nSigma
+times the read noise and photon noise expected. A jump is left out of the
+running mean. A read that arrives after a later one (annotated concurrently)
+is neither fitted nor checked. Every RampSums holds a fixed number of images
+(22 bytes per pixel), whatever the number of reads.
+'''
+
+import threading
+import collections
+
+import numpy
+
+from apogeeql import utrAnnotate
+
+# rows of the images done at a time when fitting, to bound the float64 temporaries
+FITROWS = 256
+
+
+class RampSums(object):
+   '''The running sums of one exposure (readNoise in DN, gain in e-/DN)'''
+
+   def __init__(self, exposure, shape, saturation, readNoise=10.0, gain=1.9, nSigma=5.0):
+      self.exposure = exposure
+      self.shape = shape
+      self.saturation = saturation
+      self.readNoise = readNoise
+      self.gain = gain
+      self.nSigma = nSigma
+      self.reads = set()
+      # the reads in the sums, in order, and the first fitted read at or above saturation of each pixel (0: none)
+      self.fitted = []
+      self.firstSat = numpy.zeros(shape, dtype=numpy.uint16)
+      self.sumY = numpy.zeros(shape, dtype=numpy.float32)
+      self.sumTY = numpy.zeros(shape, dtype=numpy.float32)
+      # jump detection: the previous read, and the running mean of the differences per read
+      self.last = numpy.zeros(shape, dtype=numpy.float32)
+      self.nDiff = numpy.zeros(shape, dtype=numpy.uint16)
+      self.meanDiff = numpy.zeros(shape, dtype=numpy.float32)
+      self.jumps = numpy.zeros(shape, dtype=numpy.uint16)
+      self.lock = threading.Lock()
+
+   def add(self, readnum, y):
+      '''Add read readnum (y: the pixel values, in DN)
+
+      Returns the (jumps, newly saturated) masks of the read, None if it was already added.
+      '''
+      with self.lock:
+         if readnum in self.reads:
+            return None
+         self.reads.add(readnum)
+         if self.fitted and readnum < self.fitted[-1]:
+            # arrived after a later read: the fit goes on without it
+            none = numpy.zeros(self.shape, dtype=bool)
+            return none, none
+         unsat = self.firstSat == 0
+         good = unsat & (y < self.saturation)
+         newSat = unsat & ~good
+         self.firstSat[newSat] = readnum
+         jumps = self._jumps(readnum, y, good)
+         self.fitted.append(readnum)
+         t = numpy.float32(readnum - self.fitted[0])
+         numpy.add(self.sumY, y, out=self.sumY, where=good)
+         if t:
+            numpy.add(self.sumTY, t*y, out=self.sumTY, where=good)
+      return jumps, newSat
+
+   def _jumps(self, readnum, y, good):
+      '''Jumps since the previous read, and update of the running differences (lock held)'''
+      jumps = numpy.zeros(self.shape, dtype=bool)
+      if self.fitted:
+         dt = numpy.float32(readnum - self.fitted[-1])
+         diff = (y - self.last)/dt
+         # good pixels were not saturated in the previous read either
+         # noise of the difference: read noise of the two reads, photon noise of the mean signal,
+         # and the uncertainty of the mean itself
+         var = (2.0*self.readNoise**2 + numpy.maximum(self.meanDiff, 0.0)*dt/self.gain)/(dt*dt)
+         var *= 1.0 + numpy.float32(1.0)/numpy.maximum(self.nDiff, 1)
+         jumps = good & (self.nDiff > 0) & (diff - self.meanDiff > self.nSigma*numpy.sqrt(var))
+         self.jumps += jumps
+         update = good & ~jumps
+         self.nDiff += update
+         numpy.add(self.meanDiff, (diff - self.meanDiff)/numpy.maximum(self.nDiff, 1), out=self.meanDiff, where=update)
+      self.last[...] = y
+      return jumps
+
+   def _tables(self):
+      '''(n, sum t, sum t^2) of a pixel, indexed by its firstSat (lock held)'''
+      fitted = numpy.array(self.fitted, dtype=numpy.int64)
+      t = (fitted - fitted[0]).astype(numpy.float64)
+      size = int(fitted[-1]) + 1 if len(fitted) else 1
+      # a pixel saturated at fitted read k has the reads before it; one never saturated (0) has them all
+      pos = numpy.full(size, len(fitted), dtype=numpy.int64)
+      pos[fitted] = numpy.arange(len(fitted))
+      pos[0] = len(fitted)
+      cumT = numpy.concatenate([[0.0], numpy.cumsum(t)])
+      cumTT = numpy.concatenate([[0.0], numpy.cumsum(t*t)])
+      return pos.astype(numpy.float64), cumT[pos], cumTT[pos]
+
+   def slope(self):
+      '''Least-squares slope of every pixel in DN per read (NaN with less than 2 unsaturated reads)'''
+      out = numpy.full(self.shape, numpy.nan)
+      with self.lock:
+         if not self.fitted:
+            return out
+         nTable, sumTTable, sumTTTable = self._tables()
+         for start in range(0, self.shape[0], FITROWS):
+            rows = slice(start, start + FITROWS)
+            firstSat = self.firstSat[rows]
+            n = nTable[firstSat]
+            sumT = sumTTable[firstSat]
+            den = n*sumTTTable[firstSat] - sumT*sumT
+            num = n*self.sumTY[rows] - sumT*self.sumY[rows]
+            ok = (n >= 2) & (den > 0)
+            out[rows][ok] = num[ok]/den[ok]
+      return out
+
+   def nReads(self):
+      '''Number of unsaturated reads in the fit of every pixel'''
+      with self.lock:
+         if not self.fitted:
+            return numpy.zeros(self.shape, dtype=numpy.uint16)
+         return self._tables()[0].astype(numpy.uint16)[self.firstSat]
+
+   def snapshot(self):
+      '''(last read added, slope image, saturation mask, number of unsaturated reads per pixel)'''
+      slope = self.slope()
+      n = self.nReads()
+      with self.lock:
+         return max(self.reads) if self.reads else 0, slope, self.firstSat > 0, n
+
+
+class RampCache(object):
+   '''RampSums of the last size exposures, shared by the annotator and quicklook'''
+
+   def __init__(self, size=1, saturation=65000.0, readNoise=10.0, gain=1.9, nSigma=5.0, chips=('a', 'b', 'c')):
+      self.size = size
+      self.saturation = saturation
+      self.readNoise = readNoise
+      self.gain = gain
+      self.nSigma = nSigma
+      self.chips = chips
+      self.exposures = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+   def get(self, exposure):
+      '''The RampSums of an exposure (apRaw-DDDDXXXX), None if it is not here'''
+      with self.lock:
+         return self.exposures.get(exposure)
+
+   def add(self, exposure, readnum, data, bzero=0, bscale=1):
+      '''Add a read given as stored (data) with its BZERO/BSCALE
+
+      Returns the numbers of (jumps, newly saturated pixels) of the read in each
+      chip (column blocks, in the order of chips), None if it was already added.
+      '''
+      # float32 holds the 16-bit reads exactly, at half the size of float64
+      y = data.astype(numpy.float32)
+      if bscale != 1:
+         y *= bscale
+      if bzero:
+         y += bzero
+      with self.lock:
+         sums = self.exposures.get(exposure)
+         if sums is None or sums.shape != y.shape:
+            sums = RampSums(exposure, y.shape, self.saturation, self.readNoise, self.gain, self.nSigma)
+            self.exposures[exposure] = sums
+            while len(self.exposures) > self.size:
+               self.exposures.popitem(last=False)
+      flags = sums.add(readnum, y)
+      if flags is None:
+         return None
+      return chipCounts(flags[0], len(self.chips)), chipCounts(flags[1], len(self.chips))
+
+
+def chipCounts(mask, nChips):
+   '''Number of pixels set in each of the nChips column blocks of mask'''
+   return [int(block.sum()) for block in numpy.array_split(mask, nChips, axis=-1)]
+
+
+def readFrame(filename):
+   '''(data, BZERO, BSCALE) of a FITS file, the data memory-mapped as stored'''
+   f = open(filename, 'rb')
+   try:
+      header, hdrlen = utrAnnotate.readHeader(f)
+   finally:
+      f.close()
+   dtype, shape = utrAnnotate.dataLayout(header)
+   data = numpy.memmap(filename, dtype=dtype, mode='r', offset=hdrlen, shape=shape)
+   return data, header.get('BZERO', 0), header.get('BSCALE', 1)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+'''Bounded queues between the actor and the quicklook/bundle threads.
+
+A WorkQueue is a Queue the consumer threads use as before, that also keeps
+what is needed to see lag build up: the time every message waited in the
+queue, the number of messages of each type (the first element of a tuple
+message, or the message itself) queued and dropped, and an estimate of the
+time the consumer takes per message (of the timed types): from the get() of
+a message to the consumer's next call to get(), so its idle time is never
+counted. A message that arrives while the consumer is waiting for one shows
+it keeps up, and its time replaces the average instead of being folded in.
+
+With the 'block' policy a full queue blocks put() as a Queue does. With
+'dropOldest' a full queue first drops its oldest message of a droppable type
+(e.g. intermediate quicklook UTR reads), and only blocks when there is none.
+
+A QuicklookQueue also schedules the messages so that quicklook works on the
+newest read of the exposure being taken rather than on a backlog.
+
+onDrop(message), when given, is called (with the queue mutex held) for every
+message dropped, e.g. to release the resources it holds, and onGet(message)
+for every message the consumer takes (in its thread, without the mutex).
+'''
+
+import os
+import time
+import logging
+import threading
+import collections
+
+from Queue import Queue, Full
+
+BLOCK = 'block'
+DROPOLDEST = 'dropOldest'
+POLICIES = (BLOCK, DROPOLDEST)
+
+# weight of the last message in the service time average
+SERVICEWEIGHT = 0.3
+
+
+def messageType(item):
+   if isinstance(item, tuple) and item:
+      return str(item[0])
+   return str(item)
+
+
+class WorkQueue(Queue):
+   '''Queue(maxsize) with an overflow policy and statistics (see stats())
+
+   serviceTime only counts the messages of the timed types (None: all of them).
+   '''
+
+   def __init__(self, name, maxsize=0, policy=BLOCK, droppable=(), onDrop=None, timed=None, onGet=None):
+      if policy not in POLICIES:
+         raise ValueError('unknown queue policy %s (one of %s)' % (policy, ', '.join(POLICIES)))
+      Queue.__init__(self, maxsize)
+      self.name = name
+      self.policy = policy
+      self.droppable = set(droppable)
+      self.onDrop = onDrop
+      self.onGet = onGet
+      self.timed = None if timed is None else set(timed)
+      self.statsLock = threading.Lock()
+      self.resetStats()
+
+   def resetStats(self):
+      with self.statsLock:
+         self.puts = collections.defaultdict(int)
+         self.dropped = collections.defaultdict(int)
+         self.gets = 0
+         self.totalWait = 0.0
+         self.maxWait = 0.0
+         self.lastGet = None        # (time, type) of the last message the consumer got
+         self.getCalled = None      # when the consumer last called get()
+         self.serviceTime = 0.0     # moving average of the consumer time per message
+
+   def put(self, item, block=True, timeout=None):
+      if self.policy == DROPOLDEST and self.maxsize > 0:
+         while True:
+            try:
+               return Queue.put(self, item, False)
+            except Full:
+               if not self._dropOldest():
+                  break
+      return Queue.put(self, item, block, timeout)
+
+   def _dropOldest(self):
+      '''Drop the oldest droppable message; False if there is none'''
+      with self.mutex:
+         for entry in self.queue:
+            kind = messageType(entry[1])
+            if kind in self.droppable:
+               self.queue.remove(entry)
+               self.unfinished_tasks -= 1
+               if self.unfinished_tasks == 0:
+                  self.all_tasks_done.notify_all()
+               self.not_full.notify()
+               with self.statsLock:
+                  self.dropped[kind] += 1
+               self._dropped(entry[1])
+               return True
+      return False
+
+   def _dropped(self, item):
+      if self.onDrop is not None:
+         try:
+            self.onDrop(item)
+         except:
+            logging.exception('%s queue: onDrop failed' % (self.name))
+
+   # the Queue hooks, called with the queue mutex held: entries are (time queued, message)
+   def _put(self, item):
+      self.queue.append((time.time(), item))
+      with self.statsLock:
+         self.puts[messageType(item)] += 1
+
+   def get(self, block=True, timeout=None):
+      with self.statsLock:
+         self.getCalled = time.time()
+      item = Queue.get(self, block, timeout)
+      if self.onGet is not None:
+         try:
+            self.onGet(item)
+         except:
+            logging.exception('%s queue: onGet failed' % (self.name))
+      return item
+
+   def _get(self):
+      queued, item = self.queue.popleft()
+      now = time.time()
+      wait = now - queued
+      with self.statsLock:
+         self.gets += 1
+         self.totalWait += wait
+         self.maxWait = max(self.maxWait, wait)
+         if self.lastGet is not None and (self.timed is None or self.lastGet[1] in self.timed):
+            # the consumer was busy with the previous message until it asked for this one
+            busy = max(0.0, self.getCalled - self.lastGet[0])
+            if queued > self.getCalled:
+               # it was idle when this message came: it keeps up
+               self.serviceTime = busy
+            else:
+               self.serviceTime += SERVICEWEIGHT*(busy - self.serviceTime)
+         self.lastGet = (now, messageType(item))
+      return item
+
+   def abandon(self, item):
+      '''Drop all the queued messages and queue item alone (e.g. EXIT for a consumer that is replaced)'''
+      with self.mutex:
+         while self.queue:
+            queued, message = self.queue.popleft()
+            with self.statsLock:
+               self.dropped[messageType(message)] += 1
+            self._dropped(message)
+         self._put(item)
+         self.unfinished_tasks = 1
+         self.not_empty.notify()
+         self.not_full.notify_all()
+
+   def oldest(self):
+      '''Seconds the oldest message has been waiting (0 when empty)'''
+      with self.mutex:
+         if not self.queue:
+            return 0.0
+         return time.time() - self.queue[0][0]
+
+   def stats(self):
+      '''(depth, maxsize, queued, dropped, mean wait, max wait, oldest wait, {type: (queued, dropped)})'''
+      depth = self.qsize()
+      oldest = self.oldest()
+      with self.statsLock:
+         types = dict([(kind, (n, self.dropped.get(kind, 0))) for kind, n in self.puts.items()])
+         return (depth, self.maxsize, sum(self.puts.values()), sum(self.dropped.values()),
+                 self.totalWait/self.gets if self.gets else 0.0, self.maxWait, oldest, types)
+
+   def keywords(self, prefix):
+      '''The status keywords of the queue'''
+      depth, maxsize, queued, dropped, meanWait, maxWait, oldest, types = self.stats()
+      counts = ','.join(['%s:%d:%d' % (kind, types[kind][0], types[kind][1]) for kind in sorted(types)])
+      return ['%sQueue=%d,%d,%d,%d,%.3f,%.3f,%.3f' % (prefix, depth, maxsize, queued, dropped, meanWait, maxWait, oldest),
+              '%sQueueTypes="%s"' % (prefix, counts)]
+
+
+class QuicklookQueue(WorkQueue):
+   '''WorkQueue of the quicklook thread
+
+   Urgent messages (PING) go ahead of everything else, so the watchdog
+   measures whether quicklook is alive and not how far behind it is. A UTR
+   read replaces the reads of the same exposure still waiting at the end of
+   the queue: only the newest read is worth showing, except the reads for
+   which keep(message) is True (e.g. the first, milestone and last reads,
+   see readDecimation.ReadDecimator.keep). All the other messages
+   (configInfo, plugMapInfo, ditherPosition, UTRDONE, UTRDONEPK, EXIT) are
+   never dropped nor reordered, and the reads before them stay where they are
+   (EXIT lets quicklook finish the exposures it was given).
+   '''
+
+   def __init__(self, name, maxsize=0, policy=DROPOLDEST, urgent=('PING',), coalesce=('UTR',), onDrop=None,
+                onGet=None, keep=None):
+      # the time per read is what the decimation of the reads needs
+      WorkQueue.__init__(self, name, maxsize, policy, droppable=coalesce, onDrop=onDrop, timed=coalesce, onGet=onGet)
+      self.urgent = set(urgent)
+      self.coalesce = set(coalesce)
+      self.keep = keep
+
+   def _put(self, item):
+      kind = messageType(item)
+      if kind in self.urgent:
+         # after the urgent messages already waiting
+         pos = 0
+         while pos < len(self.queue) and messageType(self.queue[pos][1]) in self.urgent:
+            pos += 1
+         self.queue.rotate(-pos)
+         self.queue.appendleft((time.time(), item))
+         self.queue.rotate(pos)
+         with self.statsLock:
+            self.puts[kind] += 1
+         return
+      if kind in self.coalesce:
+         self._coalesce(kind, item)
+      WorkQueue._put(self, item)
+
+   def _coalesce(self, kind, item):
+      '''Remove the waiting messages item supersedes (called with the mutex held)'''
+      exposure = utrExposure(item)
+      superseded = []
+      for entry in reversed(self.queue):
+         other = entry[1]
+         if messageType(other) != kind:
+            break
+         if utrExposure(other) == exposure and not (self.keep is not None and self.keep(other)):
+            superseded.append(entry)
+      for entry in superseded:
+         self.queue.remove(entry)
+      if superseded:
+         # they will never be task_done()
+         self.unfinished_tasks -= len(superseded)
+         self.not_full.notify(len(superseded))
+         with self.statsLock:
+            self.dropped[kind] += len(superseded)
+         for entry in superseded:
+            self._dropped(entry[1])
+
+
+def utrExposure(item):
+   '''apRaw-DDDDXXXX of a ('UTR', actor, filename, ...) message'''
+   try:
+      return os.path.basename(item[2]).rsplit('-', 1)[0]
+   except (IndexError, AttributeError, TypeError):
+      return None
@@ -10,4 +10,4 @@ setup(name='apogeeql',
       url='https://github.com/sdss/apogeeql',
       packages=find_packages(exclude=["tests"]),
       scripts=['bin/apogeeql','bin/apogeeql','bin/runQuickLook.py'],
-      install_requires=['numpy','astropy(>=4.0)','scipy','apogee_mountain'])
+      install_requires=['numpy','astropy(>=4.0)','scipy','peewee','sqlalchemy','apogee_mountain'])
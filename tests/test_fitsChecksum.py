@@ -0,0 +1,63 @@
+'''CHECKSUM/DATASUM of fitsChecksum against astropy.io.fits'''
+
+import numpy
+import pytest
+
+from astropy.io import fits
+
+from apogeeql import fitsChecksum, utrAnnotate
+
+
+@pytest.fixture
+def icsFile(tmpdir):
+   '''A UTR-like file (uint16 pixels stored with BZERO 32768) written by astropy with its checksums'''
+   rng = numpy.random.RandomState(3)
+   data = rng.randint(0, 65536, size=(64, 96)).astype(numpy.uint16)
+   hdu = fits.PrimaryHDU(data)
+   hdu.header['EXPTIME'] = (10.6, 'exposure time')
+   hdu.header['OBSCMNT'] = "it's a test"
+   filename = str(tmpdir.join('apRaw-00010001-001.fits'))
+   hdu.writeto(filename, checksum=True)
+   return filename, data
+
+
+def rawHeader(filename):
+   with open(filename, 'rb') as f:
+      return utrAnnotate.readHeader(f)
+
+
+# encode() writes the complement of the sum, as astropy does with _char_encode(~sum)
+@pytest.mark.parametrize('value', [0, 1, 0x7fffffff, 0x80000000, 0xfffffffe, 0xffffffff, 0x12345678, 0xdeadbeef])
+def test_encode(value):
+   hdu = fits.PrimaryHDU()
+   assert fitsChecksum.encode(value) == hdu._char_encode(~value & 0xffffffff)
+
+
+def test_encodeRandom():
+   hdu = fits.PrimaryHDU()
+   for value in numpy.random.RandomState(1).randint(0, 2**32, size=2000, dtype=numpy.uint64):
+      assert fitsChecksum.encode(int(value)) == hdu._char_encode(~int(value) & 0xffffffff)
+
+
+def test_onesComplementSum():
+   hdu = fits.PrimaryHDU()
+   rng = numpy.random.RandomState(2)
+   for n in (4, 2880, 2880*7):
+      buf = rng.randint(0, 256, size=n).astype(numpy.uint8).tobytes()
+      for sum32 in (0, 0xffffffff, 12345):
+         assert fitsChecksum.onesComplementSum(buf, sum32) == hdu._compute_checksum(numpy.frombuffer(buf, dtype='ubyte'), sum32)
+
+
+def test_dataSum(icsFile):
+   filename, data = icsFile
+   header, hdrlen = rawHeader(filename)
+   datasum = fitsChecksum.dataSum(filename, hdrlen, utrAnnotate.dataLength(header))
+   assert datasum == int(fits.getheader(filename)['DATASUM'])
+
+
+def test_verifyChecksum(icsFile):
+   filename, data = icsFile
+   header, hdrlen = rawHeader(filename)
+   datasum = fitsChecksum.dataSum(filename, hdrlen, utrAnnotate.dataLength(header))
+   assert utrAnnotate.verifyChecksum(header, datasum) is True
+   assert utrAnnotate.verifyChecksum(header, datasum ^ 1) is False
@@ -0,0 +1,92 @@
+'''Header-only annotation of utrAnnotate against astropy.io.fits'''
+
+import io
+import warnings
+
+import numpy
+import pytest
+
+from astropy.io import fits
+
+from apogeeql import utrAnnotate
+
+CARDS = [('TELESCOP', 'apo25m', 'telescope'),
+         ('RA', 123.45678901234567, 'RA of the boresight'),
+         ('DEC', -0.000012345678901, None),
+         ('AIRMASS', 1.0, ''),
+         ('NREAD', 47, 'number of reads'),
+         ('BIG', 2**40, None),
+         ('LAMPQRTZ', False, 'quartz lamp'),
+         ('SHUTTER', True, None),
+         ('OBJECT', "Plate 'A' with quotes", None),
+         ('OBSCMNT', 'x'*100, 'truncated'),
+         ('EMPTY', '', None),
+         ('NOVALUE', None, 'undefined')]
+
+
+@pytest.fixture
+def icsFile(tmpdir):
+   rng = numpy.random.RandomState(4)
+   data = rng.randint(0, 65536, size=(32, 48)).astype(numpy.uint16)
+   hdu = fits.PrimaryHDU(data)
+   hdu.header['EXPTIME'] = (10.6, 'exposure time')
+   hdu.header['DATE-OBS'] = '2026-10-18T03:00:00.000'
+   filename = str(tmpdir.join('apRaw-00010001-001.fits'))
+   hdu.writeto(filename, checksum=True)
+   return filename, data
+
+
+def test_formatCardRoundTrip():
+   for key, value, comment in CARDS:
+      card = fits.Card.fromstring(utrAnnotate.formatCard(key, value, comment))
+      parsed = card.value
+      if value is None:
+         assert isinstance(parsed, fits.card.Undefined)
+      elif isinstance(value, float):
+         assert parsed == pytest.approx(value, rel=1e-15)
+      elif isinstance(value, str):
+         assert parsed == value[:68]
+      else:
+         assert parsed == value and type(parsed) == type(value)
+      assert utrAnnotate.parseValue(card.image) == (None if value is None else parsed)
+
+
+def test_annotateUTR(icsFile, tmpdir):
+   filename, data = icsFile
+   outfile = str(tmpdir.join('out.fits'))
+   header, checksumOk = utrAnnotate.annotateUTR(filename, outfile, CARDS)
+   assert checksumOk is True
+
+   with warnings.catch_warnings():
+      warnings.simplefilter('error')
+      hdulist = fits.open(outfile, checksum=True, do_not_scale_image_data=True, uint16=True)
+      hdulist.verify('exception')
+   try:
+      hdu = hdulist[0]
+      assert hdu.verify_checksum() == 1
+      assert hdu.verify_datasum() == 1
+      ref = fits.getheader(filename)
+      for key in ('SIMPLE', 'BITPIX', 'NAXIS1', 'NAXIS2', 'EXPTIME', 'DATE-OBS'):
+         assert hdu.header[key] == ref[key]
+      assert hdu.header['BZERO'] == 32768 and hdu.header['BSCALE'] == 1
+      for key, value, comment in CARDS:
+         if value is None:
+            assert hdu.header[key] is None or isinstance(hdu.header[key], fits.card.Undefined)
+         elif isinstance(value, float):
+            assert hdu.header[key] == pytest.approx(value, rel=1e-15)
+         elif isinstance(value, str):
+            assert hdu.header[key] == value[:68]
+         else:
+            assert hdu.header[key] == value
+      numpy.testing.assert_array_equal(fits.getdata(outfile), data)
+      # the header astropy reads back is the one written
+      assert hdu.header.tostring() == header.tostring()
+   finally:
+      hdulist.close()
+
+
+def test_nonAsciiHeader():
+   block = bytearray(fits.Card('SIMPLE', True).image.encode('ascii') + b' '*2800)
+   block[100] = 0xe9
+   with pytest.raises(utrAnnotate.AnnotateError):
+      utrAnnotate.readHeader(io.BytesIO(bytes(block)))